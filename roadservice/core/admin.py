@@ -2,7 +2,8 @@ from django.contrib import admin
 
 from core.models import Province, County, Speciality, Machinery, ServiceTeam, Citizen, Serviceman, Issue, \
     SpecialityRequirement, MachineryRequirement, MissionType, Mission, CountyExpert, Country, CountryModerator, \
-    ProvinceModerator, CountyModerator, MachineryType, Region
+    ProvinceModerator, CountyModerator, MachineryType, Region, PendingAssignment, \
+    TeamAvailability, MachineryReservation, MachinerySlot
 
 admin.site.register(Region)
 admin.site.register(Country)
@@ -20,6 +21,10 @@ admin.site.register(Citizen)
 admin.site.register(Issue)
 admin.site.register(SpecialityRequirement)
 admin.site.register(MachineryRequirement)
+admin.site.register(PendingAssignment)
+admin.site.register(TeamAvailability)
+admin.site.register(MachineryReservation)
+admin.site.register(MachinerySlot)
 admin.site.register(MissionType)
 admin.site.register(Mission)
 admin.site.register(CountyExpert)
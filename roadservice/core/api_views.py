@@ -1,15 +1,24 @@
+import gzip
+
 from django.core.exceptions import ValidationError
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from accounts.exceptions import WeakPasswordError
+from core import push
 from core.exceptions import AccessDeniedError, IllegalOperationInStateError, InvalidArgumentError, DuplicatedInfoError
-from core.models import Location, Issue, Country, Speciality, MachineryType, MissionType, Citizen
+from core.models import Location, Issue, Speciality, MachineryType, MissionType, Citizen, RegionTree, Serviceman, \
+    LocationFix, ServiceTeam, Mission
 from core.permissions import IsCitizen, IsServiceman, IsCountyExpert
 from core.serializers import IssueAcceptanceSerializer, LocationSerializer, IssueSerializer, NestedCountrySerializer, \
     IssueReportingSerializer, IssueRatingSerializer, ServiceTeamSerializer, MissionSerializer, MissionReportSerializer, \
-    SpecialitySerializer, MachineryTypeSerializer, IssueRejectionSerializer, MissionTypeSerializer, SignUpSerializer
+    SpecialitySerializer, MachineryTypeSerializer, IssueRejectionSerializer, MissionTypeSerializer, SignUpSerializer, \
+    LocationBatchSerializer, IssueFilterSerializer
 
 
 class SignUpView(APIView):
@@ -29,9 +38,45 @@ class SignUpView(APIView):
 
 
 class RegionsListView(APIView):
+    """Serves the region tree from a payload that is rendered and compressed once per region data version"""
+
+    @staticmethod
+    def build_payload(tree):
+        country = tree.get_roots()[0]
+        content = JSONRenderer().render(NestedCountrySerializer(country, context={'tree': tree}).data)
+        return content, gzip.compress(content)
+
+    @staticmethod
+    def accepts_gzip(accept_encoding):
+        """returns whether the Accept-Encoding header gives gzip, by name or through *, a nonzero quality"""
+        qualities = {}
+        for coding in accept_encoding.split(','):
+            name, *params = [part.strip() for part in coding.split(';')]
+            quality = 1.0
+            for param in params:
+                key, _, value = param.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[name.lower()] = quality
+        return qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0))) > 0
+
     def get(self, request):
-        country = Country.objects.get()
-        return Response(NestedCountrySerializer(country).data)
+        tree = RegionTree.get_instance()
+        content, compressed_content = tree.get_derived('regions_payload', self.build_payload)
+        use_gzip = self.accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        etag = '"regions-%d%s"' % (tree.version, '-gzip' if use_gzip else '')
+        if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(compressed_content if use_gzip else content, content_type='application/json')
+            if use_gzip:
+                response['Content-Encoding'] = 'gzip'
+        response['ETag'] = etag
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return response
 
 
 class SpecialitiesView(APIView):
@@ -59,7 +104,7 @@ class CurrentIssueView(APIView):
         issue_qs = Issue.objects.filter(reporter=request.user.role.citizen).order_by('-created_at')
         if not issue_qs.exists():
             return Response({'state': Issue.State.SCORED.value})
-        issue = issue_qs.first()
+        issue = IssueSerializer.optimize(issue_qs).first()
         return Response(IssueSerializer(issue).data)
 
 
@@ -116,14 +161,15 @@ class ServiceTeamView(APIView):
     permission_classes = [IsAuthenticated, IsServiceman]
 
     def get(self, request):
-        return Response(ServiceTeamSerializer(request.user.role.serviceman.team).data)
+        team = ServiceTeamSerializer.optimize(ServiceTeam.objects.filter(members=request.user.role.pk)).first()
+        return Response(ServiceTeamSerializer(team).data)
 
 
 class CurrentMissionView(APIView):
     permission_classes = [IsAuthenticated, IsServiceman]
 
     def get(self, request):
-        mission = request.user.role.serviceman.team.active_mission
+        mission = MissionSerializer.optimize(Mission.objects.filter(serviceteam__members=request.user.role.pk)).first()
         if not mission:
             return Response({'status': False}, status=404)
         return Response(MissionSerializer(mission).data)
@@ -139,6 +185,26 @@ class UpdateLocationView(APIView):
             long = serializer.validated_data['long']
             serviceman = request.user.role.serviceman
             serviceman.update_location(Location(lat, long))
+            LocationFix.record(serviceman.pk, serviceman.team_id, [(timezone.now(), Location(lat, long))])
+            push.publish_location(serviceman.pk, serviceman.team_id, Location(lat, long))
+            return Response({'status': True})
+        return Response(serializer.errors)
+
+
+class UpdateLocationsView(APIView):
+    """Takes a batch of location fixes into the location history, the newest of them becoming the location of the
+    serviceman"""
+    permission_classes = [IsAuthenticated, IsServiceman]
+
+    def post(self, request, format=None):
+        serializer = LocationBatchSerializer(data=request.data)
+        if serializer.is_valid():
+            fixes = serializer.validated_data['fixes']
+            recorded_at, location = max(fixes, key=lambda fix: fix[0])
+            serviceman = request.user.role.serviceman
+            Serviceman.set_location(serviceman.pk, location)
+            LocationFix.record(serviceman.pk, serviceman.team_id, fixes)
+            push.publish_location(serviceman.pk, serviceman.team_id, location)
             return Response({'status': True})
         return Response(serializer.errors)
 
@@ -160,11 +226,23 @@ class FinishMissionView(APIView):
 
 
 class ReportedIssuesView(APIView):
+    """Serves the issues of the county of the expert, the reported ones unless filtered otherwise, newest first a
+    page at a time, linking the next page in the Link header"""
     permission_classes = [IsAuthenticated, IsCountyExpert]
 
     def get(self, request):
-        issues = request.user.role.countyexpert.get_reported_issues().order_by('-created_at')
-        return Response(IssueSerializer(issues, many=True).data)
+        serializer = IssueFilterSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors)
+        issues = Issue.objects.filter(county=request.user.role.countyexpert.county_id)
+        issues = list(IssueSerializer.optimize(serializer.get_page(issues)))
+        page_size = serializer.validated_data['page_size']
+        response = Response(IssueSerializer(issues[:page_size], many=True).data)
+        if len(issues) > page_size:
+            query = request.query_params.copy()
+            query['cursor'] = IssueFilterSerializer.encode_cursor(issues[page_size - 1])
+            response['Link'] = '<%s>; rel="next"' % request.build_absolute_uri('?' + query.urlencode())
+        return response
 
 
 class AcceptIssueView(APIView):
@@ -0,0 +1,59 @@
+from django.core.checks import Error, Tags, register
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F, Q
+
+
+def is_migrated(database):
+    """returns whether every migration of core is applied to the database, since the checks query its latest schema
+    and may run before migrate"""
+    executor = MigrationExecutor(connections[database])
+    return not executor.migration_plan([node for node in executor.loader.graph.leaf_nodes() if node[0] == 'core'])
+
+
+@register(Tags.database)
+def check_region_keys(app_configs, databases=None, **kwargs):
+    """Report the county-bound rows whose province or country keys disagree with their county"""
+    from core.models import Issue, ServiceTeam, Machinery
+
+    errors = []
+    for database in databases or []:
+        if not is_migrated(database):
+            continue
+        for model in [Issue, ServiceTeam, Machinery]:
+            stale_count = model.objects.using(database).filter(
+                ~Q(province_id=F('county__super_region_id')) |
+                ~Q(country_id=F('county__super_region__super_region_id'))
+            ).count()
+            if stale_count:
+                errors.append(Error(
+                    '%d %s rows have province or country keys that disagree with their county.' % (
+                        stale_count, model._meta.verbose_name),
+                    hint='Call update_region_keys() on the regions that include them.',
+                    obj=model,
+                    id='core.E001',
+                ))
+    return errors
+
+
+@register(Tags.database)
+def check_machinery_counts(app_configs, databases=None, **kwargs):
+    """Report the machineries whose slots disagree with their active reservations"""
+    from core.models import Machinery
+
+    errors = []
+    for database in databases or []:
+        if not is_migrated(database):
+            continue
+        machineries = Machinery.annotate_available_count(Machinery.objects.using(database))
+        stale_count = Machinery.annotate_reserved_count(machineries).exclude(
+            available_count=F('total_count') - F('reserved_count')
+        ).count()
+        if stale_count:
+            errors.append(Error(
+                '%d machinery rows have slots that disagree with their reservations.' % stale_count,
+                hint='Call refresh_available_count() on them.',
+                obj=Machinery,
+                id='core.E002',
+            ))
+    return errors
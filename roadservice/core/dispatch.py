@@ -0,0 +1,66 @@
+import time
+
+import numpy as np
+
+from core.exceptions import TimeBudgetExceededError
+
+
+def min_cost_assignment(costs, deadline=None):
+    """returns the column assigned to every row of the (rows, columns) cost matrix, minimizing the total cost.
+
+    There may not be more rows than columns. This is the Hungarian algorithm with the shortest augmenting paths, in
+    O(rows^2 * columns) with the inner loops vectorized. TimeBudgetExceededError is raised once time.monotonic()
+    passes the deadline.
+    """
+    costs = np.asarray(costs, dtype=float)
+    row_count, column_count = costs.shape
+    if row_count > column_count:
+        raise ValueError('there are more rows than columns')
+    # Rows and columns are 1-based here, column 0 being the virtual start of every augmenting path
+    row_potentials = np.zeros(row_count + 1)
+    column_potentials = np.zeros(column_count + 1)
+    column_rows = np.zeros(column_count + 1, dtype=int)  # the row matched to each column, 0 if none
+    previous_columns = np.zeros(column_count + 1, dtype=int)
+    for row in range(1, row_count + 1):
+        column_rows[0] = row
+        column = 0
+        min_reduced_costs = np.full(column_count + 1, np.inf)
+        visited = np.zeros(column_count + 1, dtype=bool)
+        while column_rows[column] != 0:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeBudgetExceededError()
+            visited[column] = True
+            current_row = column_rows[column]
+            reduced_costs = costs[current_row - 1] - row_potentials[current_row] - column_potentials[1:]
+            improved = ~visited[1:] & (reduced_costs < min_reduced_costs[1:])
+            min_reduced_costs[1:][improved] = reduced_costs[improved]
+            previous_columns[1:][improved] = column
+            candidates = np.where(visited[1:], np.inf, min_reduced_costs[1:])
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+            row_potentials[column_rows[visited]] += delta
+            column_potentials[visited] -= delta
+            min_reduced_costs[1:][~visited[1:]] -= delta
+            column = next_column
+        while column != 0:
+            previous_column = previous_columns[column]
+            column_rows[column] = column_rows[previous_column]
+            column = previous_column
+    assignment = np.zeros(row_count, dtype=int)
+    matched_columns = np.nonzero(column_rows[1:])[0]
+    assignment[column_rows[matched_columns + 1] - 1] = matched_columns
+    return assignment.tolist()
+
+
+def greedy_assignment(costs):
+    """returns the column assigned to every row of the (rows, columns) cost matrix, giving each row in turn its
+    cheapest free column. There may not be more rows than columns."""
+    costs = np.array(costs, dtype=float)
+    if costs.shape[0] > costs.shape[1]:
+        raise ValueError('there are more rows than columns')
+    assignment = []
+    for row_costs in costs:
+        column = int(np.argmin(row_costs))
+        assignment.append(column)
+        costs[:, column] = np.inf
+    return assignment
@@ -0,0 +1,188 @@
+import heapq
+from math import radians, degrees, sin, cos, asin, sqrt, pi
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+from geopy.distance import geodesic
+
+EARTH_RADIUS_MILES = 3958.7613
+
+# The ellipsoidal (geodesic) distance of two points stays within 0.7% of their spherical (haversine) distance, so
+# these factors turn a haversine distance into bounds of the geodesic one
+HAVERSINE_LOWER_BOUND_FACTOR = 0.99
+HAVERSINE_UPPER_BOUND_FACTOR = 1.01
+
+# Farther than any two points on earth, the distance of the points whose coordinates are missing
+UNKNOWN_DISTANCE = 2 * np.pi * EARTH_RADIUS_MILES
+
+
+def haversine(lat1, long1, lat2, long2):
+    """returns the great-circle distance of two points, given in degrees, in miles"""
+    lat1, long1, lat2, long2 = map(radians, (float(lat1), float(long1), float(lat2), float(long2)))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * asin(sqrt(a))
+
+
+def equirectangular(lat1, long1, lat2, long2):
+    """returns the distance of two points, given in degrees, in miles on the equirectangular projection around them"""
+    lat1, long1, lat2, long2 = map(radians, (float(lat1), float(long1), float(lat2), float(long2)))
+    x = (long2 - long1) * cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+    return EARTH_RADIUS_MILES * sqrt(x * x + y * y)
+
+
+class DistanceBackend:
+    """A way of measuring the distance of two points in miles.
+
+    haversine_lower_bound_factor is a factor that turns the haversine distance of two points into a lower bound of
+    the distance measured by the backend, which lets the vectorized haversine kernels prune candidates for it.
+    """
+    name = None
+    haversine_lower_bound_factor = None
+
+    def distance(self, lat1, long1, lat2, long2):
+        raise NotImplementedError
+
+
+class GeodesicBackend(DistanceBackend):
+    """The distance on the WGS-84 ellipsoid; the most accurate and the slowest backend"""
+    name = 'geodesic'
+    haversine_lower_bound_factor = HAVERSINE_LOWER_BOUND_FACTOR
+
+    def distance(self, lat1, long1, lat2, long2):
+        return geodesic((lat1, long1), (lat2, long2)).miles
+
+
+class HaversineBackend(DistanceBackend):
+    """The great-circle distance on a sphere, within 0.7% of the geodesic distance"""
+    name = 'haversine'
+    haversine_lower_bound_factor = 1
+
+    def distance(self, lat1, long1, lat2, long2):
+        return haversine(lat1, long1, lat2, long2)
+
+
+class EquirectangularBackend(DistanceBackend):
+    """The distance on the equirectangular projection for nearby points, and the haversine distance otherwise.
+
+    Within MAX_SPAN_DEGREES of each other and below MAX_LATITUDE, the projected distance is never shorter than the
+    haversine distance and at most 0.01% longer, so the backend stays within 0.71% of the geodesic distance.
+    """
+    name = 'equirectangular'
+    haversine_lower_bound_factor = 1
+    MAX_SPAN_DEGREES = 1
+    MAX_LATITUDE = 70
+
+    def distance(self, lat1, long1, lat2, long2):
+        lat1, long1, lat2, long2 = float(lat1), float(long1), float(lat2), float(long2)
+        if abs(lat2 - lat1) <= self.MAX_SPAN_DEGREES and abs(long2 - long1) <= self.MAX_SPAN_DEGREES and \
+                abs(lat1) <= self.MAX_LATITUDE and abs(lat2) <= self.MAX_LATITUDE:
+            return equirectangular(lat1, long1, lat2, long2)
+        return haversine(lat1, long1, lat2, long2)
+
+
+DISTANCE_BACKENDS = {backend.name: backend for backend in [GeodesicBackend, HaversineBackend, EquirectangularBackend]}
+
+_backends = {}
+
+
+def get_distance_backend(name=None):
+    """returns the backend with the given name, or the one set by the DISTANCE_BACKEND setting.
+
+    The name may also be the dotted path of a DistanceBackend subclass.
+    """
+    name = name or settings.DISTANCE_BACKEND
+    if name not in _backends:
+        backend_class = DISTANCE_BACKENDS[name] if name in DISTANCE_BACKENDS else import_string(name)
+        _backends[name] = backend_class()
+    return _backends[name]
+
+
+def bounding_box(lat, long, radius):
+    """Returns the (min_lat, max_lat, min_long, max_long) of a box, in degrees, that holds every point within radius
+    miles of the given one by the great-circle distance, or None if the box spans the whole earth.
+
+    The longitudes are None if the box spans them all, when it holds a pole or crosses the antimeridian.
+    """
+    angle = radius / EARTH_RADIUS_MILES
+    if angle >= pi:
+        return None
+    lat, long = float(lat), float(long)
+    min_lat, max_lat = lat - degrees(angle), lat + degrees(angle)
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90), min(max_lat, 90), None, None
+    # The widest longitude difference within the circle, reached north or south of its center
+    delta = degrees(asin(sin(angle) / cos(radians(lat))))
+    if long - delta < -180 or long + delta > 180:
+        return min_lat, max_lat, None, None
+    return min_lat, max_lat, long - delta, long + delta
+
+
+def haversine_distances(lats, longs, target_lats, target_longs):
+    """returns the (targets, points) matrix of the great-circle distances in miles from every target to every point.
+
+    The coordinates are given in degrees, as sequences or as single values for the targets.
+    """
+    lats = np.radians(np.asarray(lats, dtype=float))[np.newaxis, :]
+    longs = np.radians(np.asarray(longs, dtype=float))[np.newaxis, :]
+    target_lats = np.radians(np.atleast_1d(np.asarray(target_lats, dtype=float)))[:, np.newaxis]
+    target_longs = np.radians(np.atleast_1d(np.asarray(target_longs, dtype=float)))[:, np.newaxis]
+    a = np.sin((lats - target_lats) / 2) ** 2 + \
+        np.cos(lats) * np.cos(target_lats) * np.sin((longs - target_longs) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def farthest_distances(lats, longs, group_starts, target_lats, target_longs):
+    """returns the (targets, groups) matrix of the great-circle distances in miles from every target to the farthest
+    point of every group.
+
+    The points of each group are contiguous, group i being the points from group_starts[i] up to the start of the
+    next group. Groups may not be empty. The groups with a point whose coordinates are NaN are UNKNOWN_DISTANCE away.
+    """
+    distances = haversine_distances(lats, longs, target_lats, target_longs)
+    farthest = np.maximum.reduceat(distances, np.asarray(group_starts, dtype=int), axis=1)
+    return np.where(np.isnan(farthest), UNKNOWN_DISTANCE, farthest)
+
+
+def nearest_neighbours(lats, longs, amount, chunk_size=1024):
+    """returns the (points, amount) matrix of the indices of the amount nearest other points of every point by the
+    great-circle distance, nearest first.
+
+    The distances are computed chunk_size points at a time so that the memory used stays linear in the points.
+    """
+    count = len(lats)
+    amount = min(amount, count - 1)
+    neighbours = np.empty((count, max(amount, 0)), dtype=np.int32)
+    if amount <= 0:
+        return neighbours
+    for start in range(0, count, chunk_size):
+        end = min(start + chunk_size, count)
+        distances = haversine_distances(lats, longs, lats[start:end], longs[start:end])
+        distances[np.arange(end - start), np.arange(start, end)] = np.inf
+        nearest = np.argpartition(distances, amount - 1, axis=1)[:, :amount]
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1, kind='stable')
+        neighbours[start:end] = np.take_along_axis(nearest, order, axis=1)
+    return neighbours
+
+
+def select_nearest(lower_bounds, get_distance, amount):
+    """returns the indices of the amount items with the smallest exact distances, nearest first.
+
+    The items are visited in the order of their lower bounds, and the exact distance is computed with
+    get_distance(index) only until no unvisited item can beat the farthest of the nearest items found so far.
+    Ties are broken by index.
+    """
+    candidates = [(lower_bound, index) for index, lower_bound in enumerate(lower_bounds)]
+    heapq.heapify(candidates)
+    nearest = []  # a max-heap of (-distance, -index) holding the nearest items found so far
+    while candidates and amount > 0:
+        lower_bound, index = heapq.heappop(candidates)
+        if len(nearest) == amount and (lower_bound, index) >= (-nearest[0][0], -nearest[0][1]):
+            break
+        item = (-get_distance(index), -index)
+        if len(nearest) < amount:
+            heapq.heappush(nearest, item)
+        elif item > nearest[0]:
+            heapq.heapreplace(nearest, item)
+    return [-index for _, index in sorted(nearest, reverse=True)]
@@ -24,3 +24,7 @@ class IllegalOperationInStateError(Exception):
 
 class InvalidArgumentError(Exception):
     pass
+
+
+class TimeBudgetExceededError(Exception):
+    pass
@@ -2,7 +2,7 @@ from django import forms
 
 from accounts.models import Role, User
 from core.exceptions import ResourceNotFoundError
-from core.models import Region, Speciality
+from core.models import Speciality, RegionTree
 
 
 class AssignExpertForm(forms.Form):
@@ -16,7 +16,7 @@ class AssignModeratorForm(forms.Form):
     def __init__(self, *args, **kwargs):
         moderator = kwargs.pop('moderator')
         super().__init__(*args, **kwargs)
-        regions = moderator.region.sub_regions.all()
+        regions = RegionTree.get_instance().get_children(moderator.region_id)
         region_choices = [(region.id, region.full_name) for region in regions]
         self.fields['region'].choices = region_choices
         self.fields['region'].widget.attrs['class'] = 'ui fluid right aligned search dropdown'
@@ -31,7 +31,7 @@ class RegionMultipleFilterForm(forms.Form):
         if user.role.type == Role.Type.COUNTY_EXPERT:
             regions = []
         else:
-            regions = user.role.get_concrete().region.get_included_regions()
+            regions = RegionTree.get_instance().get_descendants(user.role.get_concrete().region_id)
         region_choices = [(region.id, region.full_name) for region in regions]
         self.fields['regions'].choices = region_choices
         self.fields['regions'].widget.attrs['class'] = 'ui fluid right aligned search dropdown'
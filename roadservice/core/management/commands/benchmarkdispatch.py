@@ -0,0 +1,425 @@
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction, IntegrityError, OperationalError
+from django.db.models import Count, F, ProtectedError, Q
+from django.test.utils import CaptureQueriesContext
+
+from accounts.models import User, Role
+from core.models import Country, Province, County, ServiceTeam, Serviceman, CountyExpert, Machinery, MachineryType, \
+    Issue, Speciality, MissionType, RegionVersion, Mission, TeamAvailability, MachinerySlot
+
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic country and reports the latencies and query counts of accept/assign/finish cycles ' \
+           'as JSON. The generated data is rolled back unless --keep is given. With --workers the cycles run in ' \
+           'parallel threads against committed data, checking that no resource is double-booked.'
+
+    # The area the synthetic counties are drawn from, roughly the bounding box of Iran
+    LAT_RANGE = (25, 40)
+    LONG_RANGE = (44, 63)
+    # The spread of the servicemen and issues around the center of their county in degrees
+    COUNTY_SPREAD = 0.2
+    PERCENTILES = [50, 90, 99]
+    # Attempts of an operation failing with lock errors in the stress mode, and the base of their backoff in seconds
+    MAX_ATTEMPTS = 8
+    RETRY_BACKOFF = 0.01
+    # Seconds between the invariant checks made while the stress workers run
+    CHECK_INTERVAL = 0.2
+
+    def add_arguments(self, parser):
+        parser.add_argument('--provinces', type=int, default=10)
+        parser.add_argument('--counties', type=int, default=10, help='counties per province')
+        parser.add_argument('--teams', type=int, default=20, help='teams per county')
+        parser.add_argument('--members', type=int, default=3, help='servicemen per team')
+        parser.add_argument('--specialities', type=int, default=4)
+        parser.add_argument('--machinery-types', type=int, default=3)
+        parser.add_argument('--machinery', type=int, default=10, help='machinery of each type per county')
+        parser.add_argument('--issues', type=int, default=20, help='reported issues per county')
+        parser.add_argument('--cycles', type=int, default=500, help='issues accepted in the benchmark')
+        parser.add_argument('--finish-rate', type=float, default=0.8,
+                            help='the chance of finishing a random active mission after each accept')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true', help='keep the generated data')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='run the cycles in this many threads, committing the generated data and deleting it '
+                                 'afterwards; use a PostgreSQL or SQLite file database')
+
+    def handle(self, *args, **options):
+        generator = random.Random(options['seed'])
+        if options['workers']:
+            return self.handle_stress(generator, options)
+        with transaction.atomic():
+            start = time.perf_counter()
+            counties, experts = self.generate_country(generator, options)
+            setup_seconds = time.perf_counter() - start
+            report = self.run_cycles(generator, counties, experts, options)
+            report['setup_seconds'] = round(setup_seconds, 3)
+            report['config'] = self.get_config(options)
+            if not options['keep']:
+                transaction.set_rollback(True)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def handle_stress(self, generator, options):
+        start = time.perf_counter()
+        with transaction.atomic():
+            counties, experts = self.generate_country(generator, options)
+        setup_seconds = time.perf_counter() - start
+        try:
+            report = StressRun(self, generator, counties, experts, options).run()
+        finally:
+            if not options['keep']:
+                self.delete_country(counties)
+        report['setup_seconds'] = round(setup_seconds, 3)
+        report['config'] = self.get_config(options)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    @staticmethod
+    def get_config(options):
+        return {name: options[name] for name in [
+            'provinces', 'counties', 'teams', 'members', 'specialities', 'machinery_types', 'machinery', 'issues',
+            'cycles', 'finish_rate', 'seed', 'workers']}
+
+    def generate_country(self, generator, options):
+        self.specialities = [Speciality.objects.get_or_create(name='bench-s%d' % index)[0]
+                             for index in range(options['specialities'])]
+        self.machinery_types = [MachineryType.objects.get_or_create(name='bench-m%d' % index)[0]
+                                for index in range(options['machinery_types'])]
+        self.mission_type = MissionType.objects.create(name='bench')
+
+        # Regions are saved one by one to build their paths, there are only a few hundred of them
+        country = Country.objects.create(name='Bench')
+        counties = []
+        centers = {}
+        for province_index in range(options['provinces']):
+            province = Province.objects.create(name='P%d' % province_index, super_region=country)
+            for county_index in range(options['counties']):
+                county = County.objects.create(name='C%d-%d' % (province_index, county_index), super_region=province)
+                counties.append(county)
+                centers[county.pk] = (generator.uniform(*self.LAT_RANGE), generator.uniform(*self.LONG_RANGE))
+        region_keys = {county.pk: {'province_id': county.super_region_id, 'country_id': country.pk}
+                       for county in counties}
+
+        team_count = len(counties) * options['teams']
+        users = self.create_users('bench-e', len(counties) + team_count * options['members'])
+        self.user_ids = [user.pk for user in users]
+        roles = self.create_roles(users[:len(counties)], Role.Type.COUNTY_EXPERT)
+        self.insert_children(CountyExpert, [{'role_ptr': role.pk, 'county': county.pk}
+                                            for role, county in zip(roles, counties)])
+        experts = {expert.county_id: expert for expert in CountyExpert.objects.filter(county__in=counties)}
+
+        ServiceTeam.objects.bulk_create([
+            ServiceTeam(county=county, speciality=generator.choice(self.specialities), **region_keys[county.pk])
+            for county in counties for _ in range(options['teams'])
+        ])
+        teams = list(ServiceTeam.objects.filter(county__in=counties).order_by('pk'))
+        roles = self.create_roles(users[len(counties):], Role.Type.SERVICEMAN)
+        members = []
+        for index, role in enumerate(roles):
+            team = teams[index // options['members']]
+            lat, long = self.scatter(generator, centers[team.county_id])
+            members.append({'role_ptr': role.pk, 'team': team.pk, 'lat': lat, 'long': long})
+        self.insert_children(Serviceman, members)
+        TeamAvailability.recount(counties)
+
+        Machinery.objects.bulk_create([
+            Machinery(county=county, type=machinery_type, total_count=options['machinery'], **region_keys[county.pk])
+            for county in counties for machinery_type in self.machinery_types
+        ])
+        machinery_ids = Machinery.objects.filter(county__in=counties).values_list('pk', flat=True)
+        MachinerySlot.create_slots([(pk, options['machinery']) for pk in machinery_ids])
+        issues = []
+        for county in counties:
+            for index in range(options['issues']):
+                lat, long = self.scatter(generator, centers[county.pk])
+                issues.append(Issue(title='Bench %d' % index, description='Synthetic issue', county=county,
+                                    lat=lat, long=long, **region_keys[county.pk]))
+        Issue.objects.bulk_create(issues)
+        return counties, experts
+
+    @transaction.atomic
+    def delete_country(self, counties):
+        ServiceTeam.objects.filter(county__in=counties).update(active_mission=None)
+        Mission.objects.filter(issue__county__in=counties).delete()
+        Issue.objects.filter(county__in=counties).delete()
+        User.objects.filter(pk__in=self.user_ids).delete()
+        ServiceTeam.objects.filter(county__in=counties).delete()
+        Machinery.objects.filter(county__in=counties).delete()
+        province_ids = set(county.super_region_id for county in counties)
+        country_ids = set(Province.objects.filter(pk__in=province_ids).values_list('super_region_id', flat=True))
+        County.objects.filter(pk__in=[county.pk for county in counties]).delete()
+        Province.objects.filter(pk__in=province_ids).delete()
+        Country.objects.filter(pk__in=country_ids).delete()
+        RegionVersion.bump()
+        self.mission_type.delete()
+        for resource_type in self.specialities + self.machinery_types:
+            try:
+                resource_type.delete()
+            except ProtectedError:
+                pass  # used outside the benchmark
+
+    def run_cycles(self, generator, counties, experts, options):
+        reported_issues = defaultdict(list)
+        for issue in Issue.objects.filter(county__in=counties).select_related('county'):
+            reported_issues[issue.county_id].append(issue)
+        latencies = defaultdict(list)
+        query_counts = defaultdict(list)
+        outcomes = defaultdict(int)
+        active_missions = []
+        for _ in range(options['cycles']):
+            county_ids = [county_id for county_id, issues in reported_issues.items() if issues]
+            if not county_ids:
+                break
+            county_id = generator.choice(county_ids)
+            issue = reported_issues[county_id].pop(generator.randrange(len(reported_issues[county_id])))
+            speciality_requirements, machinery_requirements = self.random_requirements(generator)
+            mission = self.measure('accept', latencies, query_counts, experts[county_id].accept_issue, issue,
+                                   self.mission_type, speciality_requirements, machinery_requirements)
+            issue.refresh_from_db(fields=['state'])
+            outcomes[{Issue.State.ASSIGNED: 'assigned', Issue.State.ACCEPTED: 'queued'}.get(issue.state, 'failed')] += 1
+            if mission is not None:
+                active_missions.append(mission)
+            if active_missions and generator.random() < options['finish_rate']:
+                mission = active_missions.pop(generator.randrange(len(active_missions)))
+                self.measure('finish', latencies, query_counts, mission.finish, 'Done')
+        return {
+            'operations': {name: self.summarize(latencies[name], query_counts[name]) for name in latencies},
+            'outcomes': dict(outcomes),
+        }
+
+    @staticmethod
+    def measure(name, latencies, query_counts, function, *args):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            result = function(*args)
+            latencies[name].append(time.perf_counter() - start)
+        query_counts[name].append(len(queries))
+        return result
+
+    def summarize(self, latencies, query_counts=None):
+        summary = {'count': len(latencies)}
+        if not latencies:
+            return summary
+        for percentile, value in zip(self.PERCENTILES, np.percentile(latencies, self.PERCENTILES)):
+            summary['p%d_ms' % percentile] = round(1000 * value, 3)
+        summary['max_ms'] = round(1000 * max(latencies), 3)
+        if query_counts is not None:
+            summary['queries_mean'] = round(float(np.mean(query_counts)), 2)
+            summary['queries_max'] = max(query_counts)
+        return summary
+
+    def random_requirements(self, generator):
+        speciality_requirements = [(speciality, generator.randint(1, 2))
+                                   for speciality in generator.sample(self.specialities, 1)]
+        machinery_requirements = [(machinery_type, generator.randint(1, 3))
+                                  for machinery_type in generator.sample(self.machinery_types, 1)]
+        return speciality_requirements, machinery_requirements
+
+    def scatter(self, generator, center):
+        return (round(center[0] + generator.gauss(0, self.COUNTY_SPREAD), 6),
+                round(center[1] + generator.gauss(0, self.COUNTY_SPREAD), 6))
+
+    @staticmethod
+    def create_users(prefix, count):
+        first_pk = (User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1
+        User.objects.bulk_create([User(username='%s%d-%d' % (prefix, first_pk, index),
+                                       phone_number='b%d-%d' % (first_pk, index)) for index in range(count)])
+        return list(User.objects.filter(username__startswith='%s%d-' % (prefix, first_pk)).order_by('pk'))
+
+    @staticmethod
+    def create_roles(users, role_type):
+        Role.objects.bulk_create([Role(user=user, type=role_type) for user in users])
+        return list(Role.objects.filter(user__in=users).order_by('user_id'))
+
+    @staticmethod
+    def insert_children(model, rows):
+        """Inserts the rows of the child table of a multi-table inherited model, which bulk_create does not support.
+        The parent rows must already exist."""
+        if not rows:
+            return
+        fields = [model._meta.get_field(name) for name in rows[0]]
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+        )
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [[field.get_db_prep_save(row[field.name], connection) for field in fields]
+                                     for row in rows])
+
+
+class StressRun:
+    """Accepts issues and finishes missions from several threads at once.
+
+    Operations failing with lock errors (SQLite busy errors, PostgreSQL deadlocks or serialization failures) are
+    retried with a randomized exponential backoff. The time spent in the statements that take locks, the writes and
+    the SELECT ... FOR UPDATE queries, is reported as the locking statement time: it includes the wait for the locks
+    as well as the execution of those statements. The invariants are checked while the workers run and once more
+    after they finish.
+    """
+
+    def __init__(self, command, generator, counties, experts, options):
+        self.command = command
+        self.generator = generator
+        self.counties = counties
+        self.experts = experts
+        self.options = options
+        self.lock = threading.Lock()
+        self.issues = [(issue.county_id, issue.pk) for issue in Issue.objects.filter(county__in=counties)]
+        generator.shuffle(self.issues)
+        self.issues = self.issues[:options['cycles']]
+        self.active_mission_ids = []
+        self.latencies = defaultdict(list)
+        self.locking_statement_times = []
+        self.retries = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.outcomes = defaultdict(int)
+        self.violations = defaultdict(int)
+        self.done = threading.Event()
+
+    def run(self):
+        start = time.perf_counter()
+        workers = self.options['workers']
+        if workers == 1:
+            self.work(close_connection=False)
+        else:
+            monitor = threading.Thread(target=self.monitor)
+            monitor.start()
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for future in [executor.submit(self.work) for _ in range(workers)]:
+                        future.result()
+            finally:
+                self.done.set()
+                monitor.join()
+        elapsed = time.perf_counter() - start
+        self.check_invariants(final=True)
+        return {
+            'mode': 'stress',
+            'operations': {name: self.command.summarize(latencies) for name, latencies in self.latencies.items()},
+            'throughput_per_second': round(sum(len(latencies) for latencies in self.latencies.values()) / elapsed, 2),
+            'locking_statement_time': dict(self.command.summarize(self.locking_statement_times),
+                                           total_ms=round(1000 * sum(self.locking_statement_times), 3)),
+            'retries': dict(self.retries),
+            'errors': dict(self.errors),
+            'outcomes': dict(self.outcomes),
+            'violations': dict(self.violations),
+        }
+
+    def work(self, close_connection=True):
+        generator = random.Random(self.generator.random())
+        try:
+            with connection.execute_wrapper(self.time_locking_statement):
+                while True:
+                    with self.lock:
+                        if not self.issues:
+                            break
+                        county_id, issue_id = self.issues.pop()
+                    speciality_requirements, machinery_requirements = self.command.random_requirements(generator)
+                    mission = self.attempt('accept', self.accept, county_id, issue_id, speciality_requirements,
+                                           machinery_requirements)
+                    if mission is not None:
+                        with self.lock:
+                            self.active_mission_ids.append(mission.pk)
+                    mission_id = None
+                    with self.lock:
+                        if self.active_mission_ids and generator.random() < self.options['finish_rate']:
+                            mission_id = self.active_mission_ids.pop(generator.randrange(len(self.active_mission_ids)))
+                    if mission_id is not None:
+                        self.attempt('finish', self.finish, mission_id)
+        finally:
+            if close_connection:
+                connection.close()
+
+    def accept(self, county_id, issue_id, speciality_requirements, machinery_requirements):
+        # The state is read in the same transaction, so that the accept is undone and retried if that read fails
+        with transaction.atomic():
+            issue = Issue.objects.get(pk=issue_id)
+            mission = self.experts[county_id].accept_issue(issue, self.command.mission_type, speciality_requirements,
+                                                           machinery_requirements)
+            state = Issue.objects.filter(pk=issue_id).values_list('state', flat=True).get()
+        with self.lock:
+            self.outcomes[{Issue.State.ASSIGNED: 'assigned', Issue.State.ACCEPTED: 'queued'}.get(state, 'failed')] += 1
+        return mission
+
+    @staticmethod
+    def finish(mission_id):
+        Mission.objects.select_related('issue').get(pk=mission_id).finish('Done')
+
+    def attempt(self, name, function, *args):
+        start = time.perf_counter()
+        for attempt in range(self.command.MAX_ATTEMPTS):
+            try:
+                result = function(*args)
+                break
+            except OperationalError:
+                if attempt == self.command.MAX_ATTEMPTS - 1:
+                    with self.lock:
+                        self.errors[name] += 1
+                    return None
+                with self.lock:
+                    self.retries[name] += 1
+                time.sleep(self.command.RETRY_BACKOFF * 2 ** attempt * random.random())
+            except IntegrityError:
+                # The database rejected a write, e.g. a negative machinery count
+                with self.lock:
+                    self.violations['rejected_writes'] += 1
+                return None
+        with self.lock:
+            self.latencies[name].append(time.perf_counter() - start)
+        return result
+
+    def time_locking_statement(self, execute, sql, params, many, context):
+        if not sql.lstrip().upper().startswith(('UPDATE', 'INSERT', 'DELETE')) and 'FOR UPDATE' not in sql:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.locking_statement_times.append(duration)
+
+    def monitor(self):
+        try:
+            while not self.done.wait(self.command.CHECK_INTERVAL):
+                try:
+                    self.check_invariants()
+                except OperationalError:
+                    pass  # the database is busy, check again later
+        finally:
+            connection.close()
+
+    def check_invariants(self, final=False):
+        """Counts the teams in more than one assigned mission and the negative machinery counts, and after the run
+        the teams, machinery and team availabilities whose state disagrees with the assigned missions"""
+        assigned = Q(mission__issue__state=Issue.State.ASSIGNED)
+        double_booked_count = ServiceTeam.objects.filter(county__in=self.counties).annotate(
+            assigned_missions=Count('mission', filter=assigned)).filter(assigned_missions__gt=1).count()
+        negative_count = MachinerySlot.objects.filter(machinery__county__in=self.counties,
+                                                      available_count__lt=0).count()
+        with self.lock:
+            self.violations['double_booked_teams'] = max(self.violations['double_booked_teams'], double_booked_count)
+            self.violations['negative_machinery'] = max(self.violations['negative_machinery'], negative_count)
+        if not final:
+            return
+        self.violations['team_mismatches'] = ServiceTeam.objects.filter(county__in=self.counties).annotate(
+            assigned_missions=Count('mission', filter=assigned)
+        ).filter(
+            Q(active_mission__isnull=False, assigned_missions=0) |
+            Q(active_mission__isnull=True, assigned_missions__gt=0)
+        ).count()
+        counted = set(TeamAvailability.objects.filter(county__in=self.counties).exclude(
+            team_count=0, idle_count=0).values_list('county_id', 'speciality_id', 'team_count', 'idle_count'))
+        self.violations['availability_mismatches'] = len(counted.symmetric_difference(
+            (counts['county_id'], counts['speciality_id'], counts['team_count'], counts['idle_count'])
+            for counts in TeamAvailability.count_teams(self.counties)))
+        self.violations['machinery_mismatches'] = Machinery.annotate_reserved_count(Machinery.annotate_available_count(
+            Machinery.objects.filter(county__in=self.counties)
+        )).exclude(available_count=F('total_count') - F('reserved_count')).count()
@@ -0,0 +1,90 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.distance import DISTANCE_BACKENDS, get_distance_backend, haversine_distances
+
+
+class Command(BaseCommand):
+    help = 'Measures the speed of the distance backends and how well they agree with the geodesic ranking of teams'
+
+    # The area the synthetic points are drawn from, roughly the bounding box of Iran
+    LAT_RANGE = (25, 40)
+    LONG_RANGE = (44, 63)
+    # The spread of the candidates around a target in degrees, about the size of a county
+    CANDIDATE_SPREAD = 0.3
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=20000, help='distance calls timed per backend')
+        parser.add_argument('--rankings', type=int, default=200, help='targets whose candidate rankings are compared')
+        parser.add_argument('--candidates', type=int, default=30, help='candidates ranked per target')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        generator = random.Random(options['seed'])
+        pairs = [self.random_pair(generator) for _ in range(options['calls'])]
+        rankings = [self.random_ranking(generator, options['candidates']) for _ in range(options['rankings'])]
+        geodesic = get_distance_backend('geodesic')
+        reference_orders = [self.rank(geodesic, target, candidates) for target, candidates in rankings]
+        reference_distances = [geodesic.distance(*pair) for pair in pairs]
+
+        self.stdout.write('%-16s %12s %10s %10s %12s %10s' % (
+            'backend', 'calls/s', 'top-1', 'top-5', 'kendall tau', 'max error'))
+        for name in DISTANCE_BACKENDS:
+            backend = get_distance_backend(name)
+            start = time.perf_counter()
+            distances = [backend.distance(*pair) for pair in pairs]
+            calls_per_second = len(pairs) / (time.perf_counter() - start)
+            orders = [self.rank(backend, target, candidates) for target, candidates in rankings]
+            max_error = max(abs(distance - reference) / reference
+                            for distance, reference in zip(distances, reference_distances) if reference > 0)
+            self.stdout.write('%-16s %12.0f %9.1f%% %9.1f%% %12.4f %9.3f%%' % (
+                name, calls_per_second,
+                100 * self.mean(order[:1] == reference[:1] for order, reference in zip(orders, reference_orders)),
+                100 * self.mean(order[:5] == reference[:5] for order, reference in zip(orders, reference_orders)),
+                self.mean(self.kendall_tau(order, reference) for order, reference in zip(orders, reference_orders)),
+                100 * max_error))
+
+        # The vectorized kernel measuring the distances of all the points from a single target, as in team ranking
+        lats, longs, target_lats, target_longs = zip(*pairs)
+        start = time.perf_counter()
+        haversine_distances(lats, longs, target_lats[:1], target_longs[:1])
+        vectorized_time = max(time.perf_counter() - start, 1e-9)
+        self.stdout.write('%-16s %12.0f' % ('haversine batch', len(pairs) / vectorized_time))
+
+    def random_pair(self, generator):
+        lat, long = generator.uniform(*self.LAT_RANGE), generator.uniform(*self.LONG_RANGE)
+        return (lat, long, lat + generator.gauss(0, self.CANDIDATE_SPREAD),
+                long + generator.gauss(0, self.CANDIDATE_SPREAD))
+
+    def random_ranking(self, generator, candidate_count):
+        target = (generator.uniform(*self.LAT_RANGE), generator.uniform(*self.LONG_RANGE))
+        candidates = [(target[0] + generator.gauss(0, self.CANDIDATE_SPREAD),
+                       target[1] + generator.gauss(0, self.CANDIDATE_SPREAD)) for _ in range(candidate_count)]
+        return target, candidates
+
+    @staticmethod
+    def rank(backend, target, candidates):
+        distances = [backend.distance(lat, long, target[0], target[1]) for lat, long in candidates]
+        return sorted(range(len(candidates)), key=distances.__getitem__)
+
+    @staticmethod
+    def kendall_tau(order, reference):
+        """returns the Kendall rank correlation of two orders of the same items"""
+        positions = {item: position for position, item in enumerate(order)}
+        ranks = [positions[item] for item in reference]
+        concordant = discordant = 0
+        for i in range(len(ranks)):
+            for j in range(i + 1, len(ranks)):
+                if ranks[i] < ranks[j]:
+                    concordant += 1
+                else:
+                    discordant += 1
+        pair_count = concordant + discordant
+        return (concordant - discordant) / pair_count if pair_count else 1
+
+    @staticmethod
+    def mean(values):
+        values = list(values)
+        return sum(values) / len(values) if values else 0
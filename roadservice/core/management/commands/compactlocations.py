@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import LocationFix
+
+
+class Command(BaseCommand):
+    help = 'Downsamples the location history older than LOCATION_HISTORY_FULL_HOURS and drops the history older ' \
+           'than LOCATION_HISTORY_RETENTION_DAYS, meant to be run daily'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=2,
+                            help='days of history before the full resolution window to downsample')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        retention_start = (now - timedelta(days=settings.LOCATION_HISTORY_RETENTION_DAYS)).astimezone(timezone.utc)
+        pruned_count = LocationFix.prune(retention_start.date())
+        full_start = now - timedelta(hours=settings.LOCATION_HISTORY_FULL_HOURS)
+        downsampled_count = LocationFix.downsample(max(full_start - timedelta(days=options['days']), retention_start),
+                                                   full_start, settings.LOCATION_HISTORY_INTERVAL)
+        self.stdout.write('%d fixes dropped, %d fixes downsampled' % (pruned_count, downsampled_count))
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.3 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+def fill_region_paths(apps, schema_editor):
+    Region = apps.get_model('core', 'Region')
+    regions = {region.pk: region for region in Region.objects.all()}
+
+    def build_path(region):
+        if not region.path:
+            prefix = build_path(regions[region.super_region_id]) if region.super_region_id is not None else ''
+            region.path = '%s%d/' % (prefix, region.pk)
+        return region.path
+
+    for region in regions.values():
+        build_path(region)
+    Region.objects.bulk_update(regions.values(), ['path'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_issue_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='region',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(fill_region_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.3 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_region_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegionVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
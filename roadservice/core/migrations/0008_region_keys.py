@@ -0,0 +1,102 @@
+# Generated by Django 3.2.3 on 2026-10-18 08:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_region_keys(apps, schema_editor):
+    Region = apps.get_model('core', 'Region')
+    super_region_ids = dict(Region.objects.values_list('id', 'super_region_id'))
+    for model_name in ['Issue', 'ServiceTeam', 'Machinery']:
+        model = apps.get_model('core', model_name)
+        for county_id in model.objects.values_list('county_id', flat=True).distinct():
+            province_id = super_region_ids[county_id]
+            model.objects.filter(county_id=county_id).update(province_id=province_id,
+                                                             country_id=super_region_ids[province_id])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_regionversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issue',
+            name='country',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.country'),
+        ),
+        migrations.AddField(
+            model_name='issue',
+            name='province',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.province'),
+        ),
+        migrations.AddField(
+            model_name='machinery',
+            name='country',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.country'),
+        ),
+        migrations.AddField(
+            model_name='machinery',
+            name='province',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.province'),
+        ),
+        migrations.AddField(
+            model_name='serviceteam',
+            name='country',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.country'),
+        ),
+        migrations.AddField(
+            model_name='serviceteam',
+            name='province',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.province'),
+        ),
+        migrations.RunPython(fill_region_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='issue',
+            name='country',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.country'),
+        ),
+        migrations.AlterField(
+            model_name='issue',
+            name='province',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.province'),
+        ),
+        migrations.AlterField(
+            model_name='machinery',
+            name='country',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.country'),
+        ),
+        migrations.AlterField(
+            model_name='machinery',
+            name='province',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.province'),
+        ),
+        migrations.AlterField(
+            model_name='serviceteam',
+            name='country',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.country'),
+        ),
+        migrations.AlterField(
+            model_name='serviceteam',
+            name='province',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.province'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['province', 'state', 'created_at'], name='core_issue_provinc_80d12e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['country', 'state', 'created_at'], name='core_issue_country_df4072_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='serviceteam',
+            index=models.Index(fields=['province', 'deleted_at', 'created_at'], name='core_servic_provinc_fd32fc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='serviceteam',
+            index=models.Index(fields=['country', 'deleted_at', 'created_at'], name='core_servic_country_da47d2_idx'),
+        ),
+    ]
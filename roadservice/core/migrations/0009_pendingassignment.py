@@ -0,0 +1,24 @@
+# Generated by Django 3.2.3 on 2026-10-18 09:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_region_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingAssignment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('county', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.county')),
+                ('issue', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='pending_assignment', to='core.issue')),
+                ('mission_type', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='core.missiontype')),
+            ],
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.3 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_team_availabilities(apps, schema_editor):
+    ServiceTeam = apps.get_model('core', 'ServiceTeam')
+    TeamAvailability = apps.get_model('core', 'TeamAvailability')
+    TeamAvailability.objects.bulk_create([TeamAvailability(**counts) for counts in ServiceTeam.objects.filter(
+        deleted_at__isnull=True,
+        members__isnull=False
+    ).values('county_id', 'speciality_id').annotate(
+        team_count=models.Count('id', distinct=True),
+        idle_count=models.Count('id', distinct=True, filter=models.Q(active_mission__isnull=True))
+    ).order_by()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_pendingassignment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeamAvailability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('team_count', models.PositiveIntegerField(default=0)),
+                ('idle_count', models.PositiveIntegerField(default=0)),
+                ('county', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='team_availabilities', to='core.county')),
+                ('speciality', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.speciality')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='teamavailability',
+            constraint=models.UniqueConstraint(fields=('county', 'speciality'), name='unique_team_availability'),
+        ),
+        migrations.RunPython(count_team_availabilities, migrations.RunPython.noop),
+    ]
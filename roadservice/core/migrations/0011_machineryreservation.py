@@ -0,0 +1,45 @@
+# Generated by Django 3.2.3 on 2026-10-18 09:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def reserve_assigned_machineries(apps, schema_editor):
+    Machinery = apps.get_model('core', 'Machinery')
+    MachineryRequirement = apps.get_model('core', 'MachineryRequirement')
+    MachineryReservation = apps.get_model('core', 'MachineryReservation')
+    machinery_ids = {(county_id, type_id): machinery_id
+                     for machinery_id, county_id, type_id in Machinery.objects.values_list('id', 'county_id', 'type_id')}
+    MachineryReservation.objects.bulk_create([
+        MachineryReservation(machinery_id=machinery_ids[county_id, type_id], mission_id=mission_id, amount=amount)
+        for county_id, type_id, mission_id, amount in MachineryRequirement.objects.filter(
+            issue__state='AS', issue__mission__isnull=False
+        ).values_list('issue__county_id', 'machinery_type_id', 'issue__mission__id', 'amount')
+        if (county_id, type_id) in machinery_ids
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_teamavailability'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MachineryReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('released_at', models.DateTimeField(blank=True, null=True)),
+                ('machinery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='core.machinery')),
+                ('mission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='machinery_reservations', to='core.mission')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='machineryreservation',
+            index=models.Index(fields=['machinery', 'released_at'], name='core_machin_machine_a36def_idx'),
+        ),
+        migrations.RunPython(reserve_assigned_machineries, migrations.RunPython.noop),
+    ]
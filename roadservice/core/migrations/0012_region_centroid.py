@@ -0,0 +1,34 @@
+# Generated by Django 3.2.3 on 2026-10-18 09:19
+
+from django.db import migrations, models
+from django.db.models import Avg
+
+
+def locate_counties(apps, schema_editor):
+    # The centroid of the issues reported in a county is the best estimate of its location at hand
+    Issue = apps.get_model('core', 'Issue')
+    Region = apps.get_model('core', 'Region')
+    for county_id, lat, long in Issue.objects.filter(lat__isnull=False, long__isnull=False).values_list(
+            'county_id').annotate(lat=Avg('lat'), long=Avg('long')).values_list('county_id', 'lat', 'long'):
+        Region.objects.filter(pk=county_id).update(lat=round(lat, 6), long=round(long, 6))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_machineryreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='region',
+            name='lat',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True),
+        ),
+        migrations.AddField(
+            model_name='region',
+            name='long',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True),
+        ),
+        migrations.RunPython(locate_counties, migrations.RunPython.noop),
+    ]
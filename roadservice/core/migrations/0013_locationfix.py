@@ -0,0 +1,43 @@
+# Generated by Django 3.2.3 on 2026-10-18 09:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_region_centroid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mission',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mission',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='LocationFix',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('recorded_at', models.DateTimeField()),
+                ('lat', models.IntegerField()),
+                ('long', models.IntegerField()),
+                ('serviceman', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='location_fixes', to='core.serviceman')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='locationfix',
+            index=models.Index(fields=['serviceman', 'recorded_at'], name='core_locati_service_21acb2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='locationfix',
+            index=models.Index(fields=['day'], name='core_locati_day_3a7c36_idx'),
+        ),
+    ]
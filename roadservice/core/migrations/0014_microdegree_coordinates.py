@@ -0,0 +1,63 @@
+# Generated by Django 3.2.3 on 2026-10-18 13:05
+
+import core.models
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F
+from django.db.models.functions import Round
+
+GEO_MODELS = ['issue', 'region', 'serviceman']
+
+
+def to_microdegrees(apps, schema_editor):
+    for model_name in GEO_MODELS:
+        apps.get_model('core', model_name).objects.update(lat_e6=Round(F('lat') * 1000000),
+                                                          long_e6=Round(F('long') * 1000000))
+
+
+def to_degrees(apps, schema_editor):
+    degrees = models.DecimalField(max_digits=9, decimal_places=6)
+    for model_name in GEO_MODELS:
+        apps.get_model('core', model_name).objects.update(
+            lat=ExpressionWrapper(F('lat_e6') / 1000000.0, output_field=degrees),
+            long=ExpressionWrapper(F('long_e6') / 1000000.0, output_field=degrees))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_locationfix'),
+    ]
+
+    # The decimal columns are replaced by integer ones since converting them in place would truncate them
+    operations = [
+        *[migrations.AddField(
+            model_name=model_name,
+            name=name + '_e6',
+            field=models.IntegerField(null=True),
+        ) for model_name in GEO_MODELS for name in ['lat', 'long']],
+        migrations.RunPython(to_microdegrees, to_degrees),
+        *[migrations.RemoveField(
+            model_name=model_name,
+            name=name,
+        ) for model_name in GEO_MODELS for name in ['lat', 'long']],
+        *[migrations.RenameField(
+            model_name=model_name,
+            old_name=name + '_e6',
+            new_name=name,
+        ) for model_name in GEO_MODELS for name in ['lat', 'long']],
+        *[migrations.AlterField(
+            model_name=model_name,
+            name=name,
+            field=core.models.MicrodegreeField(blank=True, decimal_places=6, max_digits=9, null=True),
+        ) for model_name in GEO_MODELS for name in ['lat', 'long']],
+        migrations.AlterField(
+            model_name='locationfix',
+            name='lat',
+            field=core.models.MicrodegreeField(decimal_places=6, max_digits=9),
+        ),
+        migrations.AlterField(
+            model_name='locationfix',
+            name='long',
+            field=core.models.MicrodegreeField(decimal_places=6, max_digits=9),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.3 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_microdegree_coordinates'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['county', 'state', 'created_at', 'id'], name='core_issue_county__f5e465_idx'),
+        ),
+    ]
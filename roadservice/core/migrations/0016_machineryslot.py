@@ -0,0 +1,70 @@
+# Generated by Django 3.2.3 on 2026-10-18 14:40
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+# The default of MACHINERY_SLOTS when this migration was written, as a migration must not depend on the settings
+SLOT_COUNT = 4
+
+
+def split_available_counts(apps, schema_editor):
+    Machinery = apps.get_model('core', 'Machinery')
+    MachinerySlot = apps.get_model('core', 'MachinerySlot')
+    slot_count = SLOT_COUNT
+    MachinerySlot.objects.bulk_create([
+        MachinerySlot(machinery_id=machinery_id, index=index,
+                      available_count=available_count // slot_count + (index < available_count % slot_count))
+        for machinery_id, available_count in Machinery.objects.values_list('id', 'available_count')
+        for index in range(slot_count)
+    ])
+
+
+def sum_available_counts(apps, schema_editor):
+    Machinery = apps.get_model('core', 'Machinery')
+    MachinerySlot = apps.get_model('core', 'MachinerySlot')
+    Machinery.objects.update(available_count=Coalesce(Subquery(
+        MachinerySlot.objects.filter(machinery=OuterRef('pk')).values('machinery').annotate(
+            total=Sum('available_count')).values('total')
+    ), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_issue_county_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MachinerySlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('available_count', models.PositiveIntegerField(default=0)),
+                ('machinery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='core.machinery')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='machineryslot',
+            constraint=models.UniqueConstraint(fields=('machinery', 'index'), name='unique_machinery_slot'),
+        ),
+        # The default lets the column be added back when the migration is reversed
+        migrations.AlterField(
+            model_name='machinery',
+            name='available_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(split_available_counts, sum_available_counts),
+        migrations.RemoveField(
+            model_name='machinery',
+            name='available_count',
+        ),
+        migrations.AlterField(
+            model_name='machineryreservation',
+            name='machinery',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='reservations', to='core.machinery'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.3 on 2026-10-18 15:05
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def set_teams(apps, schema_editor):
+    # The teams the fixes were received in were not recorded, and the current teams of the servicemen are the best
+    # estimate of them at hand
+    LocationFix = apps.get_model('core', 'LocationFix')
+    Serviceman = apps.get_model('core', 'Serviceman')
+    LocationFix.objects.update(team=Subquery(Serviceman.objects.filter(pk=OuterRef('serviceman')).values('team')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_machineryslot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='locationfix',
+            name='team',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='location_fixes', to='core.serviceteam'),
+        ),
+        migrations.AddIndex(
+            model_name='locationfix',
+            index=models.Index(fields=['team', 'recorded_at'], name='core_locati_team_id_c483bb_idx'),
+        ),
+        migrations.RunPython(set_teams, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.3 on 2026-10-18 15:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_locationfix_team'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='serviceman',
+            index=models.Index(fields=['lat', 'long'], name='core_servic_lat_c5a20d_idx'),
+        ),
+    ]
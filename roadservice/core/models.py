@@ -1,4 +1,13 @@
+import atexit
 import base64
+import logging
+import math
+import random
+import threading
+import time
+from collections import Counter, defaultdict, namedtuple
+from datetime import timedelta
+from decimal import Decimal
 from uuid import uuid4
 
 from django.conf import settings
@@ -7,25 +16,34 @@ from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
 from django.core.files.images import get_image_dimensions
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models, IntegrityError
-from django.db.models import ProtectedError
+from django.db import models, close_old_connections, DatabaseError, IntegrityError, transaction
+from django.db.models import ProtectedError, Value, Count, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, Concat, Substr
 from django.utils import timezone
-from geopy.distance import geodesic
+import numpy as np
 
 from accounts.exceptions import WeakPasswordError
 from accounts.models import User, Role
+from core import push
+from core.dispatch import min_cost_assignment, greedy_assignment
+from core.distance import bounding_box, farthest_distances, nearest_neighbours, select_nearest, \
+    get_distance_backend, UNKNOWN_DISTANCE
 from core.exceptions import AccessDeniedError, OccupiedUserError, DuplicatedInfoError, BusyResourceError, \
-    ResourceNotFoundError, IllegalOperationInStateError, InvalidArgumentError
+    ResourceNotFoundError, IllegalOperationInStateError, InvalidArgumentError, TimeBudgetExceededError
 from sms.models import SmsSender
 
+logger = logging.getLogger(__name__)
+
 
 class Location:
+    __slots__ = ('lat', 'long')
+
     def __init__(self, lat, long):
         self.lat = lat
         self.long = long
 
     def distance_from(self, location):
-        return geodesic(self.to_tuple(), location.to_tuple()).miles
+        return get_distance_backend().distance(self.lat, self.long, location.lat, location.long)
 
     def to_tuple(self):
         return self.lat, self.long
@@ -40,9 +58,68 @@ class Location:
         return False
 
 
+class LocationArray:
+    """Many locations as two arrays of float degrees, for the vectorized distance computations"""
+    __slots__ = ('lats', 'longs')
+
+    def __init__(self, lats, longs):
+        self.lats = np.asarray(lats, dtype=float)
+        self.longs = np.asarray(longs, dtype=float)
+
+    @classmethod
+    def from_microdegrees(cls, lats, longs):
+        """returns the array of the coordinates given in microdegrees, the missing ones becoming NaN"""
+        return cls(np.array(lats, dtype=float) / 1e6, np.array(longs, dtype=float) / 1e6)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LocationArray(self.lats[index], self.longs[index])
+        return Location(float(self.lats[index]), float(self.longs[index]))
+
+
+def to_microdegrees(degrees):
+    return int(Decimal(degrees).scaleb(6).to_integral_value())
+
+
+class MicrodegreeField(models.DecimalField):
+    """A coordinate in degrees stored as an integer number of microdegrees.
+
+    In Python it is the DecimalField(max_digits=9, decimal_places=6) it replaces, so the forms, the serializers and
+    the location property are unchanged, while the database holds a plain integer that the dispatch reads as is with
+    microdegrees(name).
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_digits', 9)
+        kwargs.setdefault('decimal_places', 6)
+        super().__init__(*args, **kwargs)
+
+    def get_internal_type(self):
+        return 'IntegerField'
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else Decimal(value).scaleb(-6)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        return None if value is None else to_microdegrees(value)
+
+    def get_db_prep_save(self, value, connection):
+        return self.get_db_prep_value(value, connection)
+
+
+def microdegrees(name):
+    """returns an expression reading the MicrodegreeField name as the integer it is stored as"""
+    return ExpressionWrapper(F(name), output_field=models.IntegerField())
+
+
 class GeoModel(models.Model):
-    lat = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
-    long = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    lat = MicrodegreeField(null=True, blank=True)
+    long = MicrodegreeField(null=True, blank=True)
 
     class Meta:
         abstract = True
@@ -57,7 +134,8 @@ class GeoModel(models.Model):
         self.long = val.long
 
 
-class Region(models.Model):
+class Region(GeoModel):
+    # The location of a region is its centroid, which is what the dispatch measures the distances between counties by
     class Type(models.TextChoices):
         COUNTRY = 'CR'
         PROVINCE = 'PR'
@@ -67,18 +145,63 @@ class Region(models.Model):
     name = models.CharField(max_length=20)
     super_region = models.ForeignKey('self', related_name='sub_regions', null=True, blank=True,
                                      on_delete=models.PROTECT)
+    # Materialized path of the primary keys from the root down to this region, e.g. '1/4/17/'
+    path = models.CharField(max_length=255, db_index=True, editable=False, default='')
 
     def __str__(self):
         return self.full_name
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        moved = self.update_path()
+        RegionVersion.bump()
+        if moved:
+            self.update_region_keys()
+
+    def delete(self, *args, **kwargs):
+        res = super().delete(*args, **kwargs)
+        RegionVersion.bump()
+        return res
+
+    def build_path(self):
+        prefix = self.super_region.path if self.super_region_id is not None else ''
+        return '%s%d/' % (prefix, self.pk)
+
+    def update_path(self):
+        """Store the materialized path of this region and rewrite the paths of the regions below it if it moved.
+
+        Returns whether the region has moved.
+        """
+        old_path, new_path = self.path, self.build_path()
+        if old_path == new_path:
+            return False
+        if old_path:
+            Region.objects.filter(path__startswith=old_path).update(
+                path=Concat(Value(new_path), Substr('path', len(old_path) + 1), output_field=models.CharField())
+            )
+        else:
+            Region.objects.filter(pk=self.pk).update(path=new_path)
+        self.path = new_path
+        return bool(old_path)
+
+    def update_region_keys(self):
+        """Rewrite the province and country keys of the resources below this region"""
+        keys = RegionalModel.get_region_keys(RegionTree.get_instance(), self.pk)
+        for model in [Issue, ServiceTeam, Machinery]:
+            model.objects.filter(county_id__in=self.get_county_ids()).update(**keys)
+
     @property
     def full_name(self):
-        if self.type == Region.Type.COUNTRY:
-            return 'کشور ' + self.name
-        if self.type == Region.Type.PROVINCE:
-            return 'استان ' + self.name
-        if self.type == Region.Type.COUNTY:
-            return 'شهرستان ' + self.name
+        return Region.get_full_name(self.type, self.name)
+
+    @staticmethod
+    def get_full_name(type, name):
+        if type == Region.Type.COUNTRY:
+            return 'کشور ' + name
+        if type == Region.Type.PROVINCE:
+            return 'استان ' + name
+        if type == Region.Type.COUNTY:
+            return 'شهرستان ' + name
 
     def has_moderator(self):
         return hasattr(self, 'moderator')
@@ -87,58 +210,62 @@ class Region(models.Model):
         return self.__class__ != Region
 
     def get_concrete(self):
+        # The concrete region tables have no columns of their own, so the concrete instance is built from the fields
+        # of this region rather than fetched
         if self.type == Region.Type.COUNTRY:
-            return self.country
+            model = Country
         elif self.type == Region.Type.PROVINCE:
-            return self.province
+            model = Province
         elif self.type == Region.Type.COUNTY:
-            return self.county
+            model = County
+        values = {field.attname: getattr(self, field.attname) for field in Region._meta.concrete_fields}
+        values['region_ptr_id'] = self.pk
+        field_names = [field.attname for field in model._meta.concrete_fields]
+        return model.from_db(self._state.db, field_names, [values[name] for name in field_names])
+
+    def get_ancestor_ids(self):
+        """returns the ids of the regions that include this region, from the root down to this region"""
+        return [int(pk) for pk in self.path.split('/') if pk]
 
     def get_including_regions(self):
         """returns a queryset consisting of regions that include this region"""
-        res = Region.objects.filter(pk=self.pk)
-        if self.super_region is not None:
-            res |= self.super_region.get_including_regions()
-        return res
+        return Region.objects.filter(pk__in=self.get_ancestor_ids()).order_by('path')
 
     def get_included_regions(self):
         """returns a queryset consisting of regions below this region"""
-        res = Region.objects.filter(pk=self.pk)
-        for sub_region in self.sub_regions.all():
-            res |= sub_region.get_included_regions()
-        return res
+        return Region.objects.filter(path__startswith=self.path).order_by('path')
+
+    def get_county_ids(self):
+        return RegionTree.get_instance().get_county_ids(self.pk)
 
     def get_counties(self):
-        if not self.is_concrete():
-            return self.get_concrete().get_counties()
-        res = County.objects.none()
-        for region in self.sub_regions.all():
-            res |= region.get_concrete().get_counties()
-        return res
+        return County.objects.filter(pk__in=self.get_county_ids())
+
+    @staticmethod
+    def get_region_field(type):
+        """returns the field of the county-bound resources that refers to their region of the given type"""
+        if type == Region.Type.COUNTRY:
+            return 'country_id'
+        elif type == Region.Type.PROVINCE:
+            return 'province_id'
+        elif type == Region.Type.COUNTY:
+            return 'county_id'
+
+    def get_region_filter(self, prefix=''):
+        """returns the lookup that restricts the county-bound resources to this region"""
+        return {prefix + Region.get_region_field(self.type): self.pk}
 
     def get_teams(self):
-        res = ServiceTeam.objects.none()
-        for county in self.get_counties():
-            res |= county.get_teams()
-        return res
+        return ServiceTeam.objects.filter(deleted_at__isnull=True, **self.get_region_filter())
 
     def get_machineries(self):
-        res = Machinery.objects.none()
-        for county in self.get_counties():
-            res |= county.get_machineries()
-        return res
+        return Machinery.objects.filter(**self.get_region_filter())
 
     def get_issues(self):
-        res = Issue.objects.none()
-        for county in self.get_counties():
-            res |= county.get_issues()
-        return res
+        return Issue.objects.filter(**self.get_region_filter())
 
     def get_missions(self):
-        res = Mission.objects.none()
-        for county in self.get_counties():
-            res |= county.get_missions()
-        return res
+        return Mission.objects.filter(**self.get_region_filter('issue__'))
 
 
 class Country(Region):
@@ -182,26 +309,206 @@ class County(Region):
     def get_missions(self):
         return Mission.objects.filter(issue__county=self)
 
-    def get_required_teams(self, speciality, amount, location):
-        special_teams = list(
-            self.serviceteam_set.filter(
-                speciality=speciality,
-                active_mission__isnull=True,
-                deleted_at__isnull=True,
-                members__isnull=False
-            ).distinct()
+    def get_dispatch_county_ids(self):
+        """returns the ids of the counties the issues of this county may take resources from, this county first and
+        then at most DISPATCH_FALLBACK_COUNTIES of its nearest counties, nearest first"""
+        if settings.DISPATCH_FALLBACK_COUNTIES <= 0:
+            return [self.pk]
+        return [self.pk] + CountyNeighbourIndex.get_instance().get_neighbour_ids(self.pk)
+
+    def get_borrower_county_ids(self):
+        """returns the ids of the other counties whose issues may take the resources of this county"""
+        if settings.DISPATCH_FALLBACK_COUNTIES <= 0:
+            return []
+        return CountyNeighbourIndex.get_instance().get_borrower_ids(self.pk)
+
+    def get_required_teams(self, speciality, amount, location, excluded_team_ids=()):
+        """returns the amount idle teams of the speciality nearest to location, leaving out the excluded ones.
+
+        Only the teams with a member in a box around location, or with a buffered member location, are loaded. The
+        box starts TEAM_SEARCH_RADIUS miles wide and is widened until the nearest teams in it are closer than any team
+        outside it can be. The teams are read without locks, so they may be taken by another assignment before they
+        are claimed.
+        """
+        servicemen = Serviceman.objects.filter(
+            team__county=self,
+            team__speciality=speciality,
+            team__active_mission__isnull=True,
+            team__deleted_at__isnull=True
         )
-        special_teams.sort(key=lambda t: t.farthest_member_distance(location))
-        return special_teams[:amount]
+        if excluded_team_ids:
+            servicemen = servicemen.exclude(team__in=excluded_team_ids)
+        radius = settings.TEAM_SEARCH_RADIUS
+        while True:
+            box = bounding_box(location.lat, location.long, radius)
+            candidates = servicemen
+            if box is not None:
+                min_lat, max_lat, min_long, max_long = box
+                # The box is rounded outwards to the microdegrees the coordinates are stored in
+                nearby = Q(lat__gte=Decimal(math.floor(min_lat * 10 ** 6)).scaleb(-6),
+                           lat__lte=Decimal(math.ceil(max_lat * 10 ** 6)).scaleb(-6))
+                if min_long is not None:
+                    nearby &= Q(long__gte=Decimal(math.floor(min_long * 10 ** 6)).scaleb(-6),
+                                long__lte=Decimal(math.ceil(max_long * 10 ** 6)).scaleb(-6))
+                # The members whose newer locations are buffered may have moved into the box
+                nearby |= Q(pk__in=LocationBuffer.get_serviceman_ids())
+                candidates = servicemen.filter(team__in=servicemen.filter(nearby).values('team_id'))
+            member_locations = [(team_id,) + LocationBuffer.get_member_location(serviceman_id, lat, long)
+                                for team_id, serviceman_id, lat, long in candidates.order_by('team_id').values_list(
+                                    'team_id', 'pk', microdegrees('lat'), microdegrees('long'))]
+            if box is None:
+                return ServiceTeam.get_nearest_teams(member_locations, amount, location)
+            # The teams outside the box have all their members farther than radius
+            teams = ServiceTeam.get_nearest_teams(member_locations, amount, location,
+                                                  get_distance_backend().haversine_lower_bound_factor * radius)
+            if teams is not None:
+                return teams
+            radius *= 8
 
     def get_required_machinery(self, machinery_type, amount):
-        machinery_qs = self.machinery_set.filter(
-            type=machinery_type,
-            available_count__gte=amount
-        )
-        if not machinery_qs:
-            return None
-        return machinery_qs.get()
+        """returns the machinery of the type if amount of it is available, read without a lock"""
+        return Machinery.annotate_available_count(self.machinery_set.filter(type=machinery_type)).filter(
+            available_count__gte=amount).first()
+
+    def has_idle_resources(self, specialities=(), machinery_types=()):
+        """returns whether any idle team of the specialities or available machinery of the types is left in the
+        counties the issues of this county may take resources from"""
+        county_ids = self.get_dispatch_county_ids()
+        return TeamAvailability.objects.filter(county__in=county_ids, speciality__in=specialities,
+                                               idle_count__gt=0).exists() or \
+            MachinerySlot.objects.filter(machinery__county__in=county_ids, machinery__type__in=machinery_types,
+                                         available_count__gt=0).exists()
+
+    @staticmethod
+    def drain_released_resources(county_ids, specialities=(), machinery_types=()):
+        """Drains the queues that may take the resources released in the counties, those of the counties themselves
+        in the given order and then those of the other counties that fall back to them"""
+        borrower_ids = set()
+        for county in County.objects.in_bulk(county_ids).values():
+            borrower_ids.update(county.get_borrower_county_ids())
+        borrower_ids.difference_update(county_ids)
+        counties = County.objects.in_bulk(list(county_ids) + list(borrower_ids))
+        for pk in list(county_ids) + sorted(borrower_ids):
+            if pk in counties:
+                counties[pk].drain_pending_assignments(specialities, machinery_types)
+
+    def drain_pending_assignments(self, specialities=(), machinery_types=()):
+        """Retries the queued assignments that require any of the given specialities or machinery types, oldest issue
+        first, until those resources run out, and returns the missions made.
+
+        In the batch dispatch mode the whole queue is dispatched at once instead.
+        """
+        if settings.DISPATCH_MODE == 'batch':
+            return self.dispatch_pending_assignments()
+        pending_assignments = self.pendingassignment_set.filter(
+            Q(issue__specialityrequirement__speciality__in=specialities) |
+            Q(issue__machineryrequirement__machinery_type__in=machinery_types)
+        ).distinct().select_related('issue', 'mission_type').order_by('issue__created_at', 'issue_id')
+        missions = []
+        for pending_assignment in pending_assignments:
+            if not self.has_idle_resources(specialities, machinery_types):
+                break
+            issue = pending_assignment.issue
+            issue.county = self
+            mission = issue.assign_resources(pending_assignment.mission_type)
+            if mission is not None:
+                missions.append(mission)
+        return missions
+
+    @transaction.atomic
+    def dispatch_pending_assignments(self):
+        """Assigns the queued issues in one batch and returns the missions made.
+
+        Issues are admitted oldest first as long as the idle resources can meet all of their requirements. Then for
+        each speciality the idle teams are matched to the admitted issues minimizing the total farthest member
+        distance, or greedily in the order of the issues if that does not finish within its share of
+        DISPATCH_TIME_BUDGET. Only the queued issues are locked. The resources are read without locks and claimed
+        with guarded updates, and the issues whose resources are taken in the meantime stay queued.
+        """
+        budget_end = time.monotonic() + settings.DISPATCH_TIME_BUDGET
+        pending_assignments = list(self.pendingassignment_set.filter(
+            issue__state=Issue.State.ACCEPTED
+        ).select_for_update(skip_locked=True, of=('self', 'issue')).select_related(
+            'issue', 'mission_type'
+        ).order_by('issue__created_at', 'issue_id'))
+        if not pending_assignments:
+            return []
+        issue_ids = [pending_assignment.issue_id for pending_assignment in pending_assignments]
+        speciality_requirements = defaultdict(list)
+        for issue_id, speciality_id, amount in SpecialityRequirement.objects.filter(
+                issue__in=issue_ids).values_list('issue_id', 'speciality_id', 'amount'):
+            speciality_requirements[issue_id].append((speciality_id, amount))
+        machinery_requirements = defaultdict(list)
+        for issue_id, machinery_type_id, amount in MachineryRequirement.objects.filter(
+                issue__in=issue_ids).values_list('issue_id', 'machinery_type_id', 'amount'):
+            machinery_requirements[issue_id].append((machinery_type_id, amount))
+
+        member_locations = defaultdict(list)
+        for team_id, speciality_id, serviceman_id, lat, long in Serviceman.objects.filter(
+            team__county=self,
+            team__active_mission__isnull=True,
+            team__deleted_at__isnull=True
+        ).order_by('team_id').values_list(
+                'team_id', 'team__speciality_id', 'pk', microdegrees('lat'), microdegrees('long')):
+            member_location = LocationBuffer.get_member_location(serviceman_id, lat, long)
+            member_locations[speciality_id].append((team_id,) + member_location)
+        idle_team_counts = {speciality_id: len(set(team_id for team_id, _, _ in locations))
+                            for speciality_id, locations in member_locations.items()}
+        machineries = {machinery.type_id: machinery for machinery in Machinery.annotate_available_count(
+            self.machinery_set.all()).filter(available_count__gt=0)}
+        available_counts = {type_id: machinery.available_count for type_id, machinery in machineries.items()}
+
+        admitted = []
+        for pending_assignment in pending_assignments:
+            issue_id = pending_assignment.issue_id
+            if all(idle_team_counts.get(speciality_id, 0) >= amount
+                   for speciality_id, amount in speciality_requirements[issue_id]) and \
+                    all(available_counts.get(type_id, 0) >= amount for type_id, amount in machinery_requirements[issue_id]):
+                for speciality_id, amount in speciality_requirements[issue_id]:
+                    idle_team_counts[speciality_id] -= amount
+                for type_id, amount in machinery_requirements[issue_id]:
+                    available_counts[type_id] -= amount
+                admitted.append(pending_assignment)
+
+        matchings = []
+        for speciality_id, locations in member_locations.items():
+            slots = [pending_assignment for pending_assignment in admitted
+                     for required_speciality_id, amount in speciality_requirements[pending_assignment.issue_id]
+                     if required_speciality_id == speciality_id for _ in range(amount)]
+            if slots:
+                matchings.append((locations, slots))
+        assigned_team_ids = defaultdict(list)
+        for index, (locations, slots) in enumerate(matchings):
+            # Every speciality gets an equal share of the budget that is left, so the time one does not use goes to
+            # the ones after it
+            now = time.monotonic()
+            deadline = now + max(budget_end - now, 0) / (len(matchings) - index)
+            team_ids, team_member_locations, group_starts = ServiceTeam.group_member_locations(locations)
+            costs = farthest_distances(team_member_locations.lats, team_member_locations.longs, group_starts,
+                                       [slot.issue.lat for slot in slots], [slot.issue.long for slot in slots])
+            try:
+                assignment = min_cost_assignment(costs, deadline)
+            except TimeBudgetExceededError:
+                assignment = greedy_assignment(costs)
+            for slot, team_index in zip(slots, assignment):
+                assigned_team_ids[slot.issue_id].append(team_ids[team_index])
+
+        teams = ServiceTeam.objects.in_bulk([team_id for team_ids in assigned_team_ids.values() for team_id in team_ids])
+        missions = []
+        for pending_assignment in admitted:
+            issue = pending_assignment.issue
+            issue.county = self
+            try:
+                mission = issue.claim_resources(
+                    pending_assignment.mission_type,
+                    [teams[team_id] for team_id in assigned_team_ids[issue.pk]],
+                    [(machineries[type_id], amount) for type_id, amount in machinery_requirements[issue.pk]]
+                )
+            except BusyResourceError:
+                continue
+            issue.state = Issue.State.ASSIGNED
+            missions.append(mission)
+        return missions
 
     def has_expert(self):
         return hasattr(self, 'expert')
@@ -210,6 +517,314 @@ class County(Region):
         self.expert.notify()
 
 
+class RegionVersion(models.Model):
+    """A single-row counter that is bumped whenever the region data changes"""
+    value = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def get_current(cls):
+        version = cls.objects.filter(pk=1).values_list('value', flat=True).first()
+        return version or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(pk=1).update(value=F('value') + 1):
+            cls.objects.create(pk=1, value=1)
+        RegionTree.changed()
+
+
+class RegionNode(namedtuple('RegionNode', ['id', 'type', 'name', 'super_region_id', 'path', 'lat', 'long'])):
+    @property
+    def full_name(self):
+        return Region.get_full_name(self.type, self.name)
+
+
+class RegionTree:
+    """An immutable in-memory snapshot of the region hierarchy, loaded once per worker.
+
+    The snapshot is reloaded only when the RegionVersion it was built from is outdated. Other workers are checked
+    for changes at most once every REGION_TREE_CHECK_INTERVAL seconds, changes made by this worker are seen at once.
+    A snapshot loaded by a transaction that changed the regions is provisional: it is dropped once that transaction
+    commits or rolls back, and by the other threads, which must not see its uncommitted changes.
+    """
+    __instance = None
+    __checked_at = None
+    __uncommitted = threading.local()
+
+    @classmethod
+    def get_instance(cls, check=False):
+        """returns the snapshot of this worker, reloading it if outdated
+
+        Keyword arguments:
+        check -- whether to check the version now regardless of the time of the last check
+        """
+        now = time.monotonic()
+        provisional = cls.__has_uncommitted_changes()
+        instance = cls.__instance
+        if instance is not None and instance.provisional and not provisional:
+            instance = None
+        if instance is None or check or now - cls.__checked_at >= settings.REGION_TREE_CHECK_INTERVAL:
+            version = RegionVersion.get_current()
+            if instance is None or instance.version != version:
+                instance = cls(version)
+                instance.provisional = provisional
+            cls.__instance = instance
+            cls.__checked_at = now
+        return instance
+
+    @classmethod
+    def invalidate(cls):
+        cls.__instance = None
+
+    @classmethod
+    def changed(cls):
+        """Drops the snapshot after the regions are changed, and once more when the transaction that changed them
+        commits"""
+        cls.invalidate()
+        if transaction.get_connection().in_atomic_block:
+            cls.__uncommitted.changed = True
+            transaction.on_commit(cls.__committed)
+
+    @classmethod
+    def __committed(cls):
+        cls.__uncommitted.changed = False
+        cls.invalidate()
+
+    @classmethod
+    def __has_uncommitted_changes(cls):
+        """returns whether the regions are changed by the open transaction of this thread"""
+        if not getattr(cls.__uncommitted, 'changed', False):
+            return False
+        if not transaction.get_connection().in_atomic_block:
+            # The transaction rolled back, which drops the callback that clears the flag
+            cls.__uncommitted.changed = False
+            return False
+        return True
+
+    def __init__(self, version):
+        self.version = version
+        self.provisional = False
+        # The nodes in path order, so that every subtree is a contiguous slice of it. The sorting is done here since
+        # the database collation may not compare the paths byte by byte.
+        regions = Region.objects.values_list('id', 'type', 'name', 'super_region_id', 'path', 'lat', 'long')
+        self.nodes = sorted((RegionNode(*values) for values in regions), key=lambda node: node.path)
+        self.__nodes_by_id = {node.id: node for node in self.nodes}
+        self.__spans = {}
+        self.__ancestor_ids = {}
+        children = defaultdict(list)
+        county_ids = defaultdict(list)
+        open_nodes = []
+        for index, node in enumerate(self.nodes):
+            while open_nodes and not node.path.startswith(self.nodes[open_nodes[-1]].path):
+                start = open_nodes.pop()
+                self.__spans[self.nodes[start].id] = (start, index)
+            open_nodes.append(index)
+            children[node.super_region_id].append(node)
+            self.__ancestor_ids[node.id] = tuple(int(pk) for pk in node.path.split('/') if pk)
+            if node.type == Region.Type.COUNTY:
+                for ancestor_id in self.__ancestor_ids[node.id]:
+                    county_ids[ancestor_id].append(node.id)
+        for start in open_nodes:
+            self.__spans[self.nodes[start].id] = (start, len(self.nodes))
+        self.__children = {pk: tuple(sorted(nodes, key=lambda node: node.id)) for pk, nodes in children.items()}
+        self.__county_ids = {pk: tuple(ids) for pk, ids in county_ids.items()}
+        self.__derived = {}
+        self.__derived_lock = threading.Lock()
+
+    def __get_newer(self, region_id):
+        """returns the snapshot of the current version if it has the region this one misses, since the region may
+        have been created by another worker since this one was checked"""
+        tree = RegionTree.get_instance(check=True)
+        if tree is self or not tree.contains(region_id):
+            raise KeyError(region_id)
+        return tree
+
+    def __find_newer(self, region_id):
+        """returns the snapshot of the current version if it has the region this one misses, or None"""
+        try:
+            return self.__get_newer(region_id)
+        except KeyError:
+            return None
+
+    def get_node(self, region_id):
+        if region_id not in self.__nodes_by_id:
+            return self.__get_newer(region_id).get_node(region_id)
+        return self.__nodes_by_id[region_id]
+
+    def get_parent(self, region_id):
+        super_region_id = self.get_node(region_id).super_region_id
+        return self.get_node(super_region_id) if super_region_id is not None else None
+
+    def get_children(self, region_id):
+        if region_id is not None and region_id not in self.__nodes_by_id:
+            tree = self.__find_newer(region_id)
+            return tree.get_children(region_id) if tree is not None else ()
+        return self.__children.get(region_id, ())
+
+    def get_ancestors(self, region_id):
+        """returns the nodes including the region, from the root down to the region itself"""
+        if region_id not in self.__ancestor_ids:
+            return self.__get_newer(region_id).get_ancestors(region_id)
+        return [self.get_node(pk) for pk in self.__ancestor_ids[region_id]]
+
+    def get_descendants(self, region_id):
+        """returns the nodes below the region in path order, starting with the region itself"""
+        if region_id not in self.__spans:
+            return self.__get_newer(region_id).get_descendants(region_id)
+        start, end = self.__spans[region_id]
+        return self.nodes[start:end]
+
+    def get_county_ids(self, region_id):
+        if region_id not in self.__nodes_by_id:
+            tree = self.__find_newer(region_id)
+            return tree.get_county_ids(region_id) if tree is not None else ()
+        return self.__county_ids.get(region_id, ())
+
+    def includes(self, region_id, sub_region_id):
+        if sub_region_id not in self.__ancestor_ids:
+            tree = self.__find_newer(sub_region_id)
+            return tree is not None and tree.includes(region_id, sub_region_id)
+        return region_id in self.__ancestor_ids[sub_region_id]
+
+    def contains(self, region_id):
+        return region_id in self.__nodes_by_id
+
+    def get_roots(self):
+        return self.get_children(None)
+
+    def get_derived(self, name, build):
+        """returns the data derived from this snapshot under name, computing it with build(tree) on first use"""
+        with self.__derived_lock:
+            if name not in self.__derived:
+                self.__derived[name] = build(self)
+            return self.__derived[name]
+
+
+class CountyNeighbourIndex:
+    """The nearest counties of every county by the distances between their centroids, derived once per RegionTree
+    snapshot so that it follows the changes of the regions.
+
+    A county without a centroid is placed at the location of its nearest region that has one, and counties with
+    neither have no neighbours and are no one's neighbour.
+    """
+
+    def __init__(self, tree, size):
+        locations = []
+        for node in tree.nodes:
+            if node.type != Region.Type.COUNTY:
+                continue
+            located = [ancestor for ancestor in tree.get_ancestors(node.id)
+                       if ancestor.lat is not None and ancestor.long is not None]
+            if located:
+                locations.append((node.id, located[-1].lat, located[-1].long))
+        self.county_ids = np.array([county_id for county_id, _, _ in locations], dtype=np.int64)
+        self.neighbours = nearest_neighbours(np.array([lat for _, lat, _ in locations], dtype=float),
+                                             np.array([long for _, _, long in locations], dtype=float), size)
+        self.__indices = {county_id: index for index, county_id in enumerate(self.county_ids.tolist())}
+        self.__borrower_ids = defaultdict(list)
+        for county_id, neighbours in zip(self.county_ids.tolist(), self.neighbours):
+            for neighbour_id in self.county_ids[neighbours].tolist():
+                self.__borrower_ids[neighbour_id].append(county_id)
+
+    @staticmethod
+    def get_instance():
+        size = settings.DISPATCH_FALLBACK_COUNTIES
+        return RegionTree.get_instance().get_derived('county_neighbours_%d' % size,
+                                                     lambda tree: CountyNeighbourIndex(tree, size))
+
+    def get_neighbour_ids(self, county_id):
+        """returns the ids of the nearest counties to the county, nearest first"""
+        index = self.__indices.get(county_id)
+        if index is None:
+            return []
+        return self.county_ids[self.neighbours[index]].tolist()
+
+    def get_borrower_ids(self, county_id):
+        """returns the ids of the counties that have the county among their nearest counties"""
+        return list(self.__borrower_ids.get(county_id, ()))
+
+
+class RegionSet:
+    """A selection of regions compiled into the minimal set of non-overlapping subtrees that cover it"""
+
+    def __init__(self, region_ids, within=None):
+        """
+        Keyword arguments:
+        region_ids -- the ids of the selected regions
+        within -- the id of the region out of which the selected regions are dropped, if any
+        """
+        tree = RegionTree.get_instance()
+        selected = set(int(pk) for pk in region_ids if tree.contains(int(pk)))
+        if within is not None:
+            selected = set(pk for pk in selected if tree.includes(within, pk))
+        self.region_ids = sorted(pk for pk in selected
+                                 if not any(node.id in selected for node in tree.get_ancestors(pk)[:-1]))
+        self.__ids_by_field = defaultdict(list)
+        for pk in self.region_ids:
+            self.__ids_by_field[Region.get_region_field(tree.get_node(pk).type)].append(pk)
+
+    def __bool__(self):
+        return bool(self.region_ids)
+
+    def to_q(self, prefix=''):
+        """returns the condition that restricts the county-bound resources to the regions, or None if there are none"""
+        q = None
+        for field, ids in self.__ids_by_field.items():
+            condition = Q(**{prefix + field + '__in': ids})
+            q = condition if q is None else q | condition
+        return q
+
+    def filter(self, queryset, prefix=''):
+        if not self:
+            return queryset.none()
+        return queryset.filter(self.to_q(prefix))
+
+
+class RegionalModel(models.Model):
+    """A model bound to a county that also stores the province and the country of the county, so that province and
+    country level listings filter on a single indexed column
+    """
+    province = models.ForeignKey('Province', on_delete=models.PROTECT, related_name='+', editable=False)
+    country = models.ForeignKey('Country', on_delete=models.PROTECT, related_name='+', editable=False)
+
+    class Meta:
+        abstract = True
+
+    @staticmethod
+    def get_region_keys(tree, region_id):
+        keys = {}
+        for node in tree.get_ancestors(region_id):
+            if node.type == Region.Type.COUNTRY:
+                keys['country_id'] = node.id
+            elif node.type == Region.Type.PROVINCE:
+                keys['province_id'] = node.id
+        return keys
+
+    # The county the row was loaded or last saved with
+    _saved_county_id = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_county_id = instance.__dict__.get('county_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # The keys only change with the county, and the moves of the regions rewrite them in bulk
+        if self._state.adding or self.__dict__.get('county_id') != self._saved_county_id:
+            self.set_region_keys()
+        super().save(*args, **kwargs)
+        self._saved_county_id = self.__dict__.get('county_id')
+
+    def set_region_keys(self):
+        """Read the keys from the database rather than the RegionTree, which may not know yet that the county moved,
+        since they are stored with the row. A missing county is left to fail the insert as any invalid key does."""
+        keys = County.objects.filter(pk=self.county_id).values_list(
+            'super_region', 'super_region__super_region').first()
+        if keys is not None:
+            self.province_id, self.country_id = keys
+
+
 class Moderator(Role):
     region = models.OneToOneField(Region, on_delete=models.PROTECT)
 
@@ -241,32 +856,25 @@ class Moderator(Role):
             return self.countymoderator
 
     def can_moderate(self, region):
-        return self.region in region.get_including_regions()
+        return RegionTree.get_instance().includes(self.region_id, region.pk)
 
     def can_view_issue(self, issue):
-        return self.can_moderate(issue.county.region_ptr)
+        return RegionTree.get_instance().includes(self.region_id, issue.county_id)
+
+    def get_region_set(self, regions):
+        """returns the RegionSet of the regions, given as a list or as a RegionSet, that this moderator may moderate"""
+        region_ids = regions.region_ids if isinstance(regions, RegionSet) else [region.pk for region in regions]
+        return RegionSet(region_ids, within=self.region_id)
 
     def get_issues(self, regions):
         """return a queryset containing issues of the regions list"""
-        res = Issue.objects.none()
-        for region in regions:
-            if self.can_moderate(region):
-                res |= region.get_issues()
-        return res
+        return self.get_region_set(regions).filter(Issue.objects.all())
 
     def get_teams(self, regions):
-        res = ServiceTeam.objects.none()
-        for region in regions:
-            if self.can_moderate(region):
-                res |= region.get_teams()
-        return res
+        return self.get_region_set(regions).filter(ServiceTeam.objects.filter(deleted_at__isnull=True))
 
     def get_machineries(self, regions):
-        res = Machinery.objects.none()
-        for region in regions:
-            if self.can_moderate(region):
-                res |= region.get_machineries()
-        return res
+        return self.get_region_set(regions).filter(Machinery.objects.all())
 
     def create_new_user(self, username, password, phone_number, first_name, last_name):
         try:
@@ -348,6 +956,7 @@ class CountyModerator(Moderator):
         for user in members_users:
             Serviceman.objects.create(team=team, user=user)
             user.refresh_from_db()
+        County.drain_released_resources([self.county.pk], specialities=[speciality])
         return team
 
     def edit_service_team(self, team, speciality, members_users):
@@ -365,6 +974,7 @@ class CountyModerator(Moderator):
                 serviceman.user.refresh_from_db()
         team.speciality = speciality
         team.save()
+        County.drain_released_resources([self.county.pk], specialities=[speciality])
 
     def delete_service_team(self, team):
         if team.active_mission is not None:
@@ -409,13 +1019,17 @@ class CountyModerator(Moderator):
 
     def increase_machinery(self, machinery_type):
         if not Machinery.objects.filter(type=machinery_type, county=self.county).exists():
-            return Machinery.objects.create(type=machinery_type, total_count=1, available_count=1, county=self.county)
+            machinery = Machinery.objects.create(type=machinery_type, total_count=1, county=self.county)
+            County.drain_released_resources([self.county.pk], machinery_types=[machinery_type])
+            return machinery
         machinery = Machinery.objects.get(type=machinery_type, county=self.county)
         machinery.increase()
+        County.drain_released_resources([self.county.pk], machinery_types=[machinery_type])
         return machinery
 
     def decrease_machinery(self, machinery_type):
-        if not Machinery.objects.filter(type=machinery_type, county=self.county).exists():
+        # A machinery without units is only kept for the history of its reservations
+        if not Machinery.objects.filter(type=machinery_type, county=self.county, total_count__gt=0).exists():
             raise ResourceNotFoundError()
         machinery = Machinery.objects.get(type=machinery_type, county=self.county)
         machinery.decrease()
@@ -428,20 +1042,180 @@ class Speciality(models.Model):
         return self.name
 
 
-class ServiceTeam(models.Model):
+class ServiceTeam(RegionalModel):
     county = models.ForeignKey(County, on_delete=models.PROTECT)
     created_at = models.DateTimeField(auto_now=False, auto_now_add=True)
     deleted_at = models.DateTimeField(auto_now=False, auto_now_add=False, null=True, blank=True)
     active_mission = models.ForeignKey('Mission', on_delete=models.SET_NULL, null=True, blank=True)
     speciality = models.ForeignKey(Speciality, on_delete=models.PROTECT)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['province', 'deleted_at', 'created_at']),
+            models.Index(fields=['country', 'deleted_at', 'created_at']),
+        ]
+
     def __str__(self):
         return '%s - %s (%d members)' % (self.speciality, self.county, len(self.members.all()))
 
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        # The team is locked before it is read, so that concurrent saves of it apply their deltas one after another
+        previous = ServiceTeam.objects.select_for_update().filter(pk=self.pk).first() if self.pk is not None else None
+        super().save(*args, **kwargs)
+        if previous is None:
+            return
+        has_members = self.members.exists()
+        previous_counts = previous.get_availability_counts(has_members)
+        counts = self.get_availability_counts(has_members)
+        if previous.county_id != self.county_id:
+            transaction.on_commit(lambda: push.TeamCounties.forget(self.pk))
+        if (previous.county_id, previous.speciality_id, previous_counts) != (self.county_id, self.speciality_id, counts):
+            TeamAvailability.add(previous.county_id, previous.speciality_id, *[-count for count in previous_counts])
+            TeamAvailability.add(self.county_id, self.speciality_id, *counts)
+
+    def get_availability_counts(self, has_members):
+        """returns how much this team adds to the team_count and idle_count of its TeamAvailability"""
+        counted = self.deleted_at is None and has_members
+        return int(counted), int(counted and self.active_mission_id is None)
+
+    @staticmethod
+    def update_availability(team_id, member_delta):
+        """Updates the TeamAvailability of the team after member_delta members were added to or removed from it, in
+        the transaction that changed the members.
+
+        The team is locked before its members are counted, so that of the concurrent first members added to a team
+        only the first to commit counts it.
+        """
+        team = ServiceTeam.objects.select_for_update().get(pk=team_id)
+        member_count = team.members.count()
+        if member_delta > 0 and member_count == member_delta:
+            TeamAvailability.add(team.county_id, team.speciality_id, *team.get_availability_counts(True))
+        elif member_delta < 0 and member_count == 0:
+            TeamAvailability.add(team.county_id, team.speciality_id,
+                                 *[-count for count in team.get_availability_counts(True)])
+
+    @staticmethod
+    def claim(teams, mission):
+        """Assigns the mission to the teams that are still idle with one update guarded against the other
+        assignments, and returns them"""
+        team_ids = [team.pk for team in teams]
+        claimed_count = ServiceTeam.objects.filter(pk__in=team_ids, active_mission__isnull=True).update(
+            active_mission=mission)
+        if claimed_count < len(teams):
+            claimed_ids = set(ServiceTeam.objects.filter(pk__in=team_ids, active_mission=mission).values_list(
+                'pk', flat=True))
+            teams = [team for team in teams if team.pk in claimed_ids]
+        for team in teams:
+            team.active_mission = mission
+        return teams
+
     def farthest_member_distance(self, location):
         distances = [member.location.distance_from(location) for member in self.members.all()]
         return max(distances)
 
+    @staticmethod
+    def group_member_locations(member_locations):
+        """returns the team ids, the LocationArray of the members and the group starts of the (team_id, lat, long)
+        rows of the members of some teams in microdegrees, ordered by team_id"""
+        team_ids, lats, longs = [], [], []
+        group_starts = []
+        for team_id, lat, long in member_locations:
+            if not team_ids or team_ids[-1] != team_id:
+                team_ids.append(team_id)
+                group_starts.append(len(lats))
+            lats.append(lat)
+            longs.append(long)
+        return team_ids, LocationArray.from_microdegrees(lats, longs), group_starts
+
+    @staticmethod
+    def get_nearest_teams(member_locations, amount, location, max_distance=None):
+        """returns the amount teams with the smallest farthest_member_distance from location, nearest first.
+
+        member_locations are the (team_id, lat, long) rows of the members of the candidate teams in microdegrees,
+        ordered by team_id.
+        The farthest member distances of all the teams are estimated in one vectorized pass, the exact distance is
+        only computed for the teams that can still be among the nearest ones, and only the chosen teams are loaded.
+        With max_distance, None is returned unless there are amount teams and the farthest of them is within
+        max_distance, as the candidates are then known to be nearer than the teams left out of them.
+        """
+        team_ids, member_locations, group_starts = ServiceTeam.group_member_locations(member_locations)
+        if not team_ids:
+            return None if max_distance is not None and amount > 0 else []
+        group_ends = group_starts[1:] + [len(member_locations)]
+        backend = get_distance_backend()
+
+        def get_distance(index):
+            members = member_locations[group_starts[index]:group_ends[index]]
+            if np.isnan(members.lats).any() or np.isnan(members.longs).any():
+                return UNKNOWN_DISTANCE
+            return max(backend.distance(lat, long, location.lat, location.long)
+                       for lat, long in zip(members.lats.tolist(), members.longs.tolist()))
+
+        lower_bounds = backend.haversine_lower_bound_factor * farthest_distances(
+            member_locations.lats, member_locations.longs, group_starts, location.lat, location.long)[0]
+        nearest = select_nearest(lower_bounds.tolist(), get_distance, amount)
+        if max_distance is not None and (len(nearest) < amount or nearest and get_distance(nearest[-1]) > max_distance):
+            return None
+        nearest_ids = [team_ids[index] for index in nearest]
+        teams = ServiceTeam.objects.in_bulk(nearest_ids)
+        return [teams[team_id] for team_id in nearest_ids]
+
+
+class TeamAvailability(models.Model):
+    """The number of teams with members and of the idle ones among them per county and speciality.
+
+    The counts are updated in the same transactions that create, edit, delete, assign and release the teams, so
+    staffing decisions and dashboards can read them instead of scanning the teams.
+    """
+    county = models.ForeignKey(County, on_delete=models.CASCADE, related_name='team_availabilities')
+    speciality = models.ForeignKey(Speciality, on_delete=models.CASCADE)
+    team_count = models.PositiveIntegerField(default=0)
+    idle_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['county', 'speciality'], name='unique_team_availability'),
+        ]
+
+    def __str__(self):
+        return '%s - %s: %d/%d' % (self.speciality, self.county, self.idle_count, self.team_count)
+
+    @classmethod
+    def add(cls, county_id, speciality_id, team_count=0, idle_count=0):
+        if not team_count and not idle_count:
+            return
+        if cls.objects.filter(county_id=county_id, speciality_id=speciality_id).update(
+                team_count=F('team_count') + team_count, idle_count=F('idle_count') + idle_count):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(county_id=county_id, speciality_id=speciality_id, team_count=team_count,
+                                   idle_count=idle_count)
+        except IntegrityError:
+            # Created by a concurrent transaction in the meantime
+            cls.objects.filter(county_id=county_id, speciality_id=speciality_id).update(
+                team_count=F('team_count') + team_count, idle_count=F('idle_count') + idle_count)
+
+    @staticmethod
+    def count_teams(counties):
+        """returns the counts of the counties computed from their teams, as dicts of the fields"""
+        return ServiceTeam.objects.filter(
+            county__in=counties,
+            deleted_at__isnull=True,
+            members__isnull=False
+        ).values('county_id', 'speciality_id').annotate(
+            team_count=Count('id', distinct=True),
+            idle_count=Count('id', distinct=True, filter=Q(active_mission__isnull=True))
+        ).order_by()
+
+    @classmethod
+    @transaction.atomic
+    def recount(cls, counties):
+        """Rebuilds the counts of the counties from their teams, e.g. after the teams were bulk created"""
+        cls.objects.filter(county__in=counties).delete()
+        cls.objects.bulk_create([cls(**counts) for counts in cls.count_teams(counties)])
+
 
 class Serviceman(Role, GeoModel):
     team = models.ForeignKey(ServiceTeam, on_delete=models.PROTECT, null=True, related_name='members')
@@ -449,13 +1223,56 @@ class Serviceman(Role, GeoModel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.type = Role.Type.SERVICEMAN
+        self.saved_team_id = None  # the team in the database, to update the TeamAvailability when it changes
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        serviceman = super().from_db(db, field_names, values)
+        serviceman.saved_team_id = serviceman.__dict__.get('team_id')
+        location = LocationBuffer.get(serviceman.pk)
+        if location is not None:
+            serviceman.location = location
+        return serviceman
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        team_id = self.__dict__.get('team_id', self.saved_team_id)
+        if team_id != self.saved_team_id:
+            if self.saved_team_id is not None:
+                ServiceTeam.update_availability(self.saved_team_id, -1)
+            if team_id is not None:
+                ServiceTeam.update_availability(team_id, 1)
+            self.saved_team_id = team_id
+
+    class Meta:
+        indexes = [
+            # The idle teams near an issue are first searched in a box of latitudes and longitudes
+            models.Index(fields=['lat', 'long']),
+        ]
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        res = super().delete(*args, **kwargs)
+        if self.saved_team_id is not None:
+            ServiceTeam.update_availability(self.saved_team_id, -1)
+        return res
 
     def get_concrete(self):
         return self
 
     def update_location(self, location):
         self.location = location
-        self.save()
+        Serviceman.set_location(self.pk, location)
+
+    @staticmethod
+    def set_location(serviceman_id, location):
+        """writes only the location columns of the serviceman, without loading it, through the LocationBuffer when
+        it is enabled"""
+        if settings.LOCATION_FLUSH_INTERVAL > 0:
+            LocationBuffer.put(serviceman_id, location)
+        else:
+            Serviceman.objects.filter(pk=serviceman_id).update(lat=location.lat, long=location.long)
 
     def end_mission(self, report):
         if self.team.active_mission is None:
@@ -463,6 +1280,203 @@ class Serviceman(Role, GeoModel):
         self.team.active_mission.finish(report)
 
 
+class LocationBuffer:
+    """The latest locations of the servicemen that are not written to the database yet, the last one put winning.
+
+    Each worker buffers the locations it receives and writes them all with one bulk update once
+    LOCATION_FLUSH_INTERVAL seconds have passed since its last flush. Only a background thread writes them, woken as
+    locations are put, so the requests never wait for a flush. What is left is written when the worker exits. The
+    locations stay readable
+    here until they are written, and the servicemen loaded or dispatched by this worker have their buffered
+    locations, so the dispatch sees them at once. The other workers see them after the flush.
+    """
+    __locations = {}
+    __fixes = []
+    __lock = threading.Lock()
+    __flush_lock = threading.Lock()
+    __flushed_at = time.monotonic()
+    __flusher = None
+    __wakeup = threading.Event()
+    __exit_registered = False
+
+    @classmethod
+    def put(cls, serviceman_id, location):
+        with cls.__lock:
+            cls.__locations[serviceman_id] = location
+        cls.__request_flush()
+
+    @classmethod
+    def put_fixes(cls, fixes):
+        """buffers the unsaved LocationFix instances to be inserted with the next flush"""
+        with cls.__lock:
+            cls.__fixes.extend(fixes)
+        cls.__request_flush()
+
+    @classmethod
+    def __request_flush(cls):
+        with cls.__lock:
+            idle = cls.__flusher is None
+        if idle:
+            cls.start_flusher()
+        cls.__wakeup.set()
+
+    @classmethod
+    def start_flusher(cls):
+        """starts the thread that flushes the locations LOCATION_FLUSH_INTERVAL seconds after the last flush once
+        some are put, and has them flushed at exit, unless it is running"""
+        with cls.__lock:
+            if cls.__flusher is not None:
+                return
+            cls.__flusher = threading.Thread(target=cls.__flush_periodically, name='location-flusher', daemon=True)
+            register = not cls.__exit_registered
+            cls.__exit_registered = True
+        if register:
+            atexit.register(cls.flush)
+        cls.__flusher.start()
+
+    @classmethod
+    def __flush_periodically(cls):
+        while settings.LOCATION_FLUSH_INTERVAL > 0:
+            # The wait is bounded so that the thread notices when the buffering is turned off
+            if not cls.__wakeup.wait(settings.LOCATION_FLUSH_INTERVAL):
+                continue
+            cls.__wakeup.clear()
+            wait = cls.__flushed_at + settings.LOCATION_FLUSH_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                cls.flush()
+            except DatabaseError:
+                # The locations stay buffered and are retried with the next flush
+                logger.exception('Could not flush the buffered locations')
+                with cls.__lock:
+                    cls.__flushed_at = time.monotonic()
+                cls.__wakeup.set()
+            finally:
+                # The thread has a connection of its own, which no request closes
+                close_old_connections()
+        with cls.__lock:
+            cls.__flusher = None
+
+    @classmethod
+    def get(cls, serviceman_id, default=None):
+        return cls.__locations.get(serviceman_id, default)
+
+    @classmethod
+    def get_serviceman_ids(cls):
+        with cls.__lock:
+            return list(cls.__locations)
+
+    @classmethod
+    def flush(cls):
+        """writes the buffered locations and location fixes and returns how many locations were written"""
+        with cls.__flush_lock:
+            with cls.__lock:
+                locations = dict(cls.__locations)
+                fixes, cls.__fixes = cls.__fixes, []
+                cls.__flushed_at = time.monotonic()
+            try:
+                with transaction.atomic():
+                    LocationFix.objects.bulk_create(fixes, batch_size=500)
+            except DatabaseError:
+                with cls.__lock:
+                    cls.__fixes[:0] = fixes
+                raise
+            if not locations:
+                return 0
+            Serviceman.objects.bulk_update([
+                Serviceman(pk=serviceman_id, lat=location.lat, long=location.long)
+                for serviceman_id, location in locations.items()
+            ], ['lat', 'long'], batch_size=500)
+            with cls.__lock:
+                # The locations put during the write are newer and are left for the next flush
+                for serviceman_id, location in locations.items():
+                    if cls.__locations.get(serviceman_id) is location:
+                        del cls.__locations[serviceman_id]
+            return len(locations)
+
+    @classmethod
+    def get_member_location(cls, serviceman_id, lat, long):
+        """returns the buffered (lat, long) of the serviceman in microdegrees, or the given one read from the
+        database"""
+        location = cls.__locations.get(serviceman_id)
+        return (lat, long) if location is None else (to_microdegrees(location.lat), to_microdegrees(location.long))
+
+
+class LocationFix(models.Model):
+    """A location a serviceman reported, kept as the history of the servicemen locations.
+
+    The history is only appended to, and is laid out for its size: the coordinates are stored as integers and the
+    UTC day of every fix is kept apart so that a day can be scanned, downsampled or dropped as a whole, as a day
+    partition of the table would be.
+    """
+    serviceman = models.ForeignKey(Serviceman, on_delete=models.CASCADE, related_name='location_fixes')
+    # The team of the serviceman when the fix was received, which the track of a mission is selected by
+    team = models.ForeignKey('ServiceTeam', null=True, blank=True, on_delete=models.SET_NULL, db_index=False,
+                             related_name='location_fixes')
+    day = models.DateField()
+    recorded_at = models.DateTimeField()
+    lat = MicrodegreeField()
+    long = MicrodegreeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['serviceman', 'recorded_at']),
+            models.Index(fields=['team', 'recorded_at']),
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return '%s at %s: %s' % (self.serviceman_id, self.recorded_at, self.location)
+
+    @property
+    def location(self):
+        return Location(self.lat, self.long)
+
+    @staticmethod
+    def record(serviceman_id, team_id, fixes):
+        """appends the (recorded_at, Location) fixes of the serviceman in the team to the history in one insert,
+        through the LocationBuffer when it is enabled"""
+        fixes = [LocationFix(serviceman_id=serviceman_id, team_id=team_id,
+                             day=recorded_at.astimezone(timezone.utc).date(), recorded_at=recorded_at,
+                             lat=location.lat, long=location.long)
+                 for recorded_at, location in fixes]
+        if settings.LOCATION_FLUSH_INTERVAL > 0:
+            LocationBuffer.put_fixes(fixes)
+        else:
+            LocationFix.objects.bulk_create(fixes)
+
+    @staticmethod
+    def downsample(start, end, interval):
+        """Keeps only the first fix of every serviceman in every interval seconds, counted from the epoch, of the
+        fixes recorded from start up to end, and returns how many fixes were deleted.
+
+        The fixes are scanned a day at a time.
+        """
+        deleted_count = 0
+        day, last_day = start.astimezone(timezone.utc).date(), end.astimezone(timezone.utc).date()
+        while day <= last_day:
+            redundant_ids = []
+            previous = None
+            fixes = LocationFix.objects.filter(day=day, recorded_at__gte=start, recorded_at__lt=end).order_by(
+                'serviceman_id', 'recorded_at', 'id').values_list('id', 'serviceman_id', 'recorded_at')
+            for pk, serviceman_id, recorded_at in fixes.iterator():
+                current = (serviceman_id, int(recorded_at.timestamp()) // interval)
+                if current == previous:
+                    redundant_ids.append(pk)
+                previous = current
+            for index in range(0, len(redundant_ids), 500):
+                LocationFix.objects.filter(pk__in=redundant_ids[index:index + 500]).delete()
+            deleted_count += len(redundant_ids)
+            day += timedelta(days=1)
+        return deleted_count
+
+    @staticmethod
+    def prune(day):
+        """deletes the fixes of the days before day and returns how many were deleted"""
+        return LocationFix.objects.filter(day__lt=day).delete()[0]
+
+
 class Citizen(Role):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -513,32 +1527,179 @@ class MachineryType(models.Model):
         return self.name
 
 
-class Machinery(models.Model):
+class Machinery(RegionalModel):
+    """The machinery of a type in a county, whose available units are kept in its MachinerySlot rows"""
     type = models.ForeignKey(MachineryType, on_delete=models.PROTECT)
     county = models.ForeignKey(County, on_delete=models.CASCADE)
     total_count = models.PositiveIntegerField()
-    available_count = models.PositiveIntegerField()
 
     def __str__(self):
-        return '%s - %s: %d/%d' % (self.type, self.county, self.available_count, self.total_count)
-
+        available_count = getattr(self, 'available_count', None)
+        if available_count is None:
+            available_count = self.get_available_count()
+        return '%s - %s: %d/%d' % (self.type, self.county, available_count, self.total_count)
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            MachinerySlot.create_slots([(self.pk, self.total_count)])
+
+    def get_available_count(self):
+        return MachinerySlot.objects.filter(machinery=self).aggregate(
+            available_count=Coalesce(Sum('available_count'), 0))['available_count']
+
+    def take(self, amount):
+        """takes amount of this machinery with decrements guarded against the other assignments and returns whether
+        it was available"""
+        return MachinerySlot.take(self.pk, amount)
+
+    @transaction.atomic
     def increase(self):
-        self.total_count += 1
-        self.available_count += 1
-        self.save()
+        Machinery.objects.filter(pk=self.pk).update(total_count=F('total_count') + 1)
+        MachinerySlot.give(self.pk, 1)
+        self.refresh_from_db(fields=['total_count'])
 
+    @transaction.atomic
     def decrease(self):
-        if self.available_count == 0:
+        """Removes an available unit of this machinery, and the machinery itself with its last unit unless it has
+        reservations, which are kept as the history of its use"""
+        if not MachinerySlot.take(self.pk, 1):
             raise BusyResourceError()
-        self.total_count -= 1
-        self.available_count -= 1
-        if self.total_count == 0:
+        Machinery.objects.filter(pk=self.pk).update(total_count=F('total_count') - 1)
+        self.refresh_from_db(fields=['total_count'])
+        if self.total_count == 0 and not self.reservations.exists():
             self.delete()
-        else:
-            self.save()
 
+    @staticmethod
+    def annotate_available_count(queryset):
+        """annotates the machineries with available_count, the total of their slots"""
+        return queryset.annotate(available_count=Coalesce(Subquery(
+            MachinerySlot.objects.filter(machinery=OuterRef('pk')).values('machinery').annotate(
+                total=Sum('available_count')).values('total')
+        ), 0))
 
-class Issue(GeoModel):
+    @staticmethod
+    def annotate_reserved_count(queryset):
+        """annotates the machineries with reserved_count, the total amount of their active reservations"""
+        return queryset.annotate(reserved_count=Coalesce(
+            Sum('reservations__amount', filter=Q(reservations__released_at__isnull=True)), 0))
+
+    @transaction.atomic
+    def refresh_available_count(self):
+        """Resets the slots to the total_count minus the active reservations"""
+        # The slots are locked before the reservations are counted, so that the assignments that took from them
+        # have committed their reservations by then
+        list(MachinerySlot.objects.select_for_update().filter(machinery=self))
+        machinery = Machinery.annotate_reserved_count(Machinery.objects.filter(pk=self.pk)).get()
+        MachinerySlot.objects.filter(machinery=self).delete()
+        MachinerySlot.create_slots([(self.pk, max(machinery.total_count - machinery.reserved_count, 0))])
+        self.refresh_from_db(fields=['total_count'])
+
+
+class MachinerySlot(models.Model):
+    """A share of the available units of a machinery.
+
+    The units are split across MACHINERY_SLOTS rows per machinery, so that concurrent assignments take them with
+    guarded decrements of different rows instead of all waiting on a single one. The available count of a machinery
+    is the sum of its slots.
+    """
+    machinery = models.ForeignKey(Machinery, on_delete=models.CASCADE, related_name='slots')
+    index = models.PositiveSmallIntegerField()
+    available_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['machinery', 'index'], name='unique_machinery_slot'),
+        ]
+
+    def __str__(self):
+        return '%s #%d: %d' % (self.machinery, self.index, self.available_count)
+
+    @staticmethod
+    def create_slots(available_counts):
+        """creates the slots of the machineries given as (machinery_id, available_count) pairs, splitting each count
+        evenly"""
+        slot_count = settings.MACHINERY_SLOTS
+        MachinerySlot.objects.bulk_create([
+            MachinerySlot(machinery_id=machinery_id, index=index,
+                          available_count=available_count // slot_count + (index < available_count % slot_count))
+            for machinery_id, available_count in available_counts for index in range(slot_count)
+        ])
+
+    @staticmethod
+    def take(machinery_id, amount):
+        """Takes amount units of the machinery, from one slot if any has enough and gathered from several otherwise,
+        and returns whether they were available.
+
+        The slots are read without locks and decremented with updates guarded against the other assignments,
+        starting at a random slot so that concurrent assignments spread over them.
+        """
+        slots = list(MachinerySlot.objects.filter(machinery_id=machinery_id, available_count__gt=0).values_list(
+            'pk', 'available_count'))
+        if sum(available_count for _, available_count in slots) < amount:
+            return False
+        start = random.randrange(len(slots)) if slots else 0
+        slots = slots[start:] + slots[:start]
+        for pk, available_count in slots:
+            if available_count >= amount and MachinerySlot.objects.filter(pk=pk, available_count__gte=amount).update(
+                    available_count=F('available_count') - amount):
+                return True
+        try:
+            with transaction.atomic():
+                remaining = amount
+                for pk, available_count in slots:
+                    taken = min(available_count, remaining)
+                    if MachinerySlot.objects.filter(pk=pk, available_count__gte=taken).update(
+                            available_count=F('available_count') - taken):
+                        remaining -= taken
+                    if remaining == 0:
+                        return True
+                # Undoes the units taken from the other slots
+                raise BusyResourceError()
+        except BusyResourceError:
+            return False
+
+    @staticmethod
+    def give(machinery_id, amount):
+        """adds amount units to a random slot of the machinery"""
+        index = random.randrange(settings.MACHINERY_SLOTS)
+        if MachinerySlot.objects.filter(machinery_id=machinery_id, index=index).update(
+                available_count=F('available_count') + amount):
+            return
+        try:
+            with transaction.atomic():
+                MachinerySlot.objects.create(machinery_id=machinery_id, index=index, available_count=amount)
+        except IntegrityError:
+            # Created by a concurrent transaction in the meantime
+            MachinerySlot.objects.filter(machinery_id=machinery_id, index=index).update(
+                available_count=F('available_count') + amount)
+
+
+class MachineryReservation(models.Model):
+    """The machinery taken by a mission, released when the mission finishes.
+
+    The active reservations are the record of the machinery in use, and the slots of the machinery hold its
+    total_count minus their amounts. Assignments take the machinery from the slots, so the reservations themselves
+    are only inserted and never contended. A machinery with reservations is never deleted, to keep its history.
+    """
+    machinery = models.ForeignKey(Machinery, on_delete=models.PROTECT, related_name='reservations')
+    mission = models.ForeignKey('Mission', on_delete=models.CASCADE, related_name='machinery_reservations')
+    amount = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now=False, auto_now_add=True)
+    released_at = models.DateTimeField(auto_now=False, auto_now_add=False, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['machinery', 'released_at']),
+        ]
+
+    def __str__(self):
+        return '%d x %s: %s' % (self.amount, self.machinery, self.mission)
+
+
+class Issue(GeoModel, RegionalModel):
     class State(models.TextChoices):
         REPORTED = 'RP'
         REJECTED = 'RJ'
@@ -565,6 +1726,13 @@ class Issue(GeoModel):
     state = models.CharField(max_length=2, choices=State.choices, default=State.REPORTED)
     image = models.ImageField(upload_to='issue-images/', validators=[validate_image.__func__], null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['province', 'state', 'created_at']),
+            models.Index(fields=['country', 'state', 'created_at']),
+            models.Index(fields=['county', 'state', 'created_at', 'id']),
+        ]
+
     def __str__(self):
         return '%s: %s (%s)' % (self.county, self.title, self.State(self.state).label)
 
@@ -576,53 +1744,143 @@ class Issue(GeoModel):
         file_name = '%s.%s' % (uuid4().hex, ext)
         return file_name, image_file
 
+    @transaction.atomic
     def assign_resources(self, mission_type):
-        # TODO: lock is required when manipulating resources (in this & other methods)
-        if self.state != Issue.State.ACCEPTED:
+        if self.state != Issue.State.ACCEPTED or \
+                not Issue.objects.select_for_update().filter(pk=self.pk, state=Issue.State.ACCEPTED).exists():
             raise IllegalOperationInStateError()
 
-        required_teams = []
-        for speciality_requirement in self.specialityrequirement_set.all():
-            special_teams = self.county.get_required_teams(
-                speciality_requirement.speciality,
-                speciality_requirement.amount,
-                self.location
-            )
-            if len(special_teams) < speciality_requirement.amount:
-                self.postpone_assignment(mission_type)
-                return None
-            required_teams += special_teams
+        counties = self.get_dispatch_counties()
+        speciality_requirements = list(self.specialityrequirement_set.all())
+        idle_counts = defaultdict(dict)
+        for county_id, speciality_id, idle_count in TeamAvailability.objects.filter(
+            county__in=counties,
+            speciality__in=[requirement.speciality_id for requirement in speciality_requirements],
+            idle_count__gt=0
+        ).values_list('county_id', 'speciality_id', 'idle_count'):
+            idle_counts[speciality_id][county_id] = idle_count
+        if any(sum(idle_counts[requirement.speciality_id].values()) < requirement.amount
+               for requirement in speciality_requirements):
+            self.postpone_assignment(mission_type)
+            return None
 
-        required_machineries = []
-        for machinery_requirement in self.machineryrequirement_set.all():
-            machinery = self.county.get_required_machinery(
-                machinery_requirement.machinery_type,
-                machinery_requirement.amount
-            )
-            if machinery is None:
-                self.postpone_assignment(mission_type)
-                return None
-            required_machineries.append((machinery, machinery_requirement.amount))
+        try:
+            with transaction.atomic():
+                mission = Mission.objects.create(issue=self, type=mission_type)
+                teams = []
+                for speciality_requirement in speciality_requirements:
+                    # The own county is probed first and the others in distance order, skipping the ones with no
+                    # idle team
+                    teams += self.claim_teams(mission, speciality_requirement.speciality, speciality_requirement.amount,
+                                              [county for county in counties
+                                               if county.pk in idle_counts[speciality_requirement.speciality_id]])
+                machineries = [(self.claim_machinery(counties, requirement.machinery_type, requirement.amount),
+                                requirement.amount) for requirement in self.machineryrequirement_set.all()]
+                self.start_mission(mission, teams, machineries)
+        except BusyResourceError:
+            self.postpone_assignment(mission_type)
+            return None
+        self.state = Issue.State.ASSIGNED
+        return mission
 
-        mission = Mission.objects.create(issue=self, type=mission_type)
-        for team in required_teams:
-            mission.service_teams.add(team)
-            team.active_mission = mission
-            team.save()
+    def claim_teams(self, mission, speciality, amount, counties):
+        """Assigns the mission to the amount idle teams of the speciality nearest to the issue, taking them from the
+        counties in order, and returns them, raising BusyResourceError if there are not enough.
 
-        for machinery, amount in required_machineries:
-            machinery.available_count -= amount
-            machinery.save()
-        self.state = Issue.State.ASSIGNED
-        self.save()
+        The candidates are ranked without locks and claimed with a guarded update, so the ones taken by another
+        assignment in the meantime are passed over for the next nearest ones.
+        """
+        teams = []
+        tried_team_ids = set()
+        for county in counties:
+            while len(teams) < amount:
+                candidates = county.get_required_teams(speciality, amount - len(teams), self.location, tried_team_ids)
+                if not candidates:
+                    break
+                tried_team_ids.update(team.pk for team in candidates)
+                teams += ServiceTeam.claim(candidates, mission)
+            if len(teams) >= amount:
+                return teams
+        raise BusyResourceError()
+
+    @staticmethod
+    def claim_machinery(counties, machinery_type, amount):
+        """takes amount of the machinery of the type from the first of the counties that has it available and
+        returns the machinery, raising BusyResourceError if none has"""
+        for county in counties:
+            machinery = county.get_required_machinery(machinery_type, amount)
+            if machinery is not None and machinery.take(amount):
+                return machinery
+        raise BusyResourceError()
+
+    def get_dispatch_counties(self):
+        """returns the county of the issue followed by the nearest counties it may take resources from"""
+        county_ids = self.county.get_dispatch_county_ids()
+        if len(county_ids) == 1:
+            return [self.county]
+        neighbours = County.objects.in_bulk(county_ids[1:])
+        return [self.county] + [neighbours[pk] for pk in county_ids[1:] if pk in neighbours]
+
+    @transaction.atomic
+    def claim_resources(self, mission_type, teams, machineries):
+        """Creates the mission and takes the resources with updates that are guarded against the other assignments,
+        raising BusyResourceError and undoing everything if any of them is taken in the meantime"""
+        mission = Mission.objects.create(issue=self, type=mission_type)
+        if len(ServiceTeam.claim(teams, mission)) != len(teams):
+            raise BusyResourceError()
+        for machinery, amount in machineries:
+            if not machinery.take(amount):
+                raise BusyResourceError()
+        self.start_mission(mission, teams, machineries)
         return mission
 
+    def start_mission(self, mission, teams, machineries):
+        """Records the resources claimed for the mission and moves the issue on to ASSIGNED"""
+        mission.service_teams.add(*teams)
+        MachineryReservation.objects.bulk_create([
+            MachineryReservation(machinery=machinery, mission=mission, amount=amount)
+            for machinery, amount in machineries
+        ])
+        if not Issue.objects.filter(pk=self.pk, state=Issue.State.ACCEPTED).update(state=Issue.State.ASSIGNED):
+            raise IllegalOperationInStateError()
+        PendingAssignment.objects.filter(issue=self).delete()
+        # The shared counters are updated last so that their rows are locked for the rest of the transaction only
+        claimed_counts = Counter((team.county_id, team.speciality_id) for team in teams)
+        for (county_id, speciality_id), count in claimed_counts.items():
+            TeamAvailability.add(county_id, speciality_id, idle_count=-count)
+        transaction.on_commit(lambda: push.publish_mission(mission.pk))
+
+    def is_assignable(self):
+        """returns whether the counties the issue may take resources from have enough of them, busy or not, to ever
+        meet the requirements"""
+        county_ids = self.county.get_dispatch_county_ids()
+        speciality_requirements = list(self.specialityrequirement_set.all())
+        team_counts = dict(TeamAvailability.objects.filter(
+            county__in=county_ids,
+            speciality__in=[requirement.speciality_id for requirement in speciality_requirements]
+        ).values_list('speciality_id').annotate(count=Sum('team_count')).values_list('speciality_id', 'count'))
+        if any(team_counts.get(requirement.speciality_id, 0) < requirement.amount
+               for requirement in speciality_requirements):
+            return False
+        for machinery_requirement in self.machineryrequirement_set.all():
+            if not Machinery.objects.filter(county__in=county_ids, type=machinery_requirement.machinery_type,
+                                            total_count__gte=machinery_requirement.amount).exists():
+                return False
+        return True
+
     def postpone_assignment(self, mission_type):
-        # Right now we won't implement the queue, so the mission will just fail
+        """Queues the issue until the county frees the resources it requires, or fails it if they will never be
+        enough"""
         if self.state != Issue.State.ACCEPTED:
             raise IllegalOperationInStateError()
+        if self.is_assignable():
+            PendingAssignment.objects.get_or_create(issue=self, defaults={'county_id': self.county_id,
+                                                                          'mission_type': mission_type})
+            return
+        if not Issue.objects.filter(pk=self.pk, state=Issue.State.ACCEPTED).update(state=Issue.State.FAILED):
+            raise IllegalOperationInStateError()
+        PendingAssignment.objects.filter(issue=self).delete()
         self.state = Issue.State.FAILED
-        self.save()
 
     def rate(self, rating):
         if self.state != Issue.State.DONE:
@@ -635,10 +1893,10 @@ class Issue(GeoModel):
     def return_machineries(self):
         if self.state != Issue.State.DONE:
             raise IllegalOperationInStateError()
-        for machinery_requirement in self.machineryrequirement_set.all():
-            machinery = self.county.machinery_set.get(type=machinery_requirement.machinery_type)
-            machinery.available_count += machinery_requirement.amount
-            machinery.save()
+        for reservation in MachineryReservation.objects.filter(mission__issue=self, released_at__isnull=True):
+            if MachineryReservation.objects.filter(pk=reservation.pk, released_at__isnull=True).update(
+                    released_at=timezone.now()):
+                MachinerySlot.give(reservation.machinery_id, reservation.amount)
 
 
 class SpecialityRequirement(models.Model):
@@ -659,6 +1917,17 @@ class MachineryRequirement(models.Model):
         return '%d x %s - %s: %s' % (self.amount, self.machinery_type, self.issue.county, self.issue.title)
 
 
+class PendingAssignment(models.Model):
+    """An accepted issue waiting for its county to free the resources it requires"""
+    issue = models.OneToOneField(Issue, on_delete=models.CASCADE, related_name='pending_assignment')
+    county = models.ForeignKey(County, on_delete=models.CASCADE)
+    mission_type = models.ForeignKey('MissionType', on_delete=models.PROTECT)
+    created_at = models.DateTimeField(auto_now=False, auto_now_add=True)
+
+    def __str__(self):
+        return str(self.issue)
+
+
 class MissionType(models.Model):
     name = models.CharField(max_length=20)
 
@@ -672,10 +1941,27 @@ class Mission(models.Model):
     type = models.ForeignKey(MissionType, on_delete=models.PROTECT)
     score = models.PositiveIntegerField(validators=[MinValueValidator(1), MaxValueValidator(5)], null=True, blank=True)
     report = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now=False, auto_now_add=True, null=True)
+    finished_at = models.DateTimeField(auto_now=False, auto_now_add=False, null=True, blank=True)
 
     def __str__(self):
         return str(self.issue)
 
+    def get_track(self):
+        """returns the location fixes the members of the teams of the mission recorded during it while in those teams,
+        ordered by serviceman and time"""
+        if self.created_at is None:
+            return LocationFix.objects.none()
+        fixes = LocationFix.objects.filter(
+            team__in=self.service_teams.all(),
+            day__gte=self.created_at.astimezone(timezone.utc).date(),
+            recorded_at__gte=self.created_at
+        )
+        if self.finished_at is not None:
+            fixes = fixes.filter(day__lte=self.finished_at.astimezone(timezone.utc).date(),
+                                 recorded_at__lte=self.finished_at)
+        return fixes.order_by('serviceman_id', 'recorded_at')
+
     @property
     def state(self):
         return self.issue.state
@@ -691,17 +1977,37 @@ class Mission(models.Model):
     def return_machineries(self):
         self.issue.return_machineries()
 
+    @transaction.atomic
     def finish(self, report):
-        if self.issue.state != Issue.State.ASSIGNED:
+        if self.issue.state != Issue.State.ASSIGNED or \
+                not Issue.objects.filter(pk=self.issue_id, state=Issue.State.ASSIGNED).update(state=Issue.State.DONE):
             raise IllegalOperationInStateError()
+        self.issue.state = Issue.State.DONE
         self.report = report
+        self.finished_at = timezone.now()
         self.save()
-        self.issue.state = Issue.State.DONE
-        self.issue.save()
-        for team in self.service_teams.all():
-            team.active_mission = None
-            team.save()
+        released_counts = list(ServiceTeam.objects.filter(
+            active_mission=self,
+            deleted_at__isnull=True,
+            members__isnull=False
+        ).values_list('county_id', 'speciality_id').annotate(
+            count=Count('id', distinct=True)
+        ).values_list('county_id', 'speciality_id', 'count'))
+        ServiceTeam.objects.filter(active_mission=self).update(active_mission=None)
+        for county_id, speciality_id, count in released_counts:
+            TeamAvailability.add(county_id, speciality_id, idle_count=count)
+        specialities = list(self.service_teams.values_list('speciality_id', flat=True).distinct())
+        # The resources taken from the nearby counties may be awaited by the queues of those counties too
+        lender_ids = set(self.service_teams.values_list('county_id', flat=True)) | \
+            set(self.machinery_reservations.values_list('machinery__county_id', flat=True))
+        lender_ids.discard(self.issue.county_id)
         self.return_machineries()
+        County.drain_released_resources(
+            [self.issue.county_id] + sorted(lender_ids),
+            specialities=specialities,
+            machinery_types=[requirement.machinery_type_id
+                             for requirement in self.issue.machineryrequirement_set.all()]
+        )
 
 
 class CountyExpert(Role):
@@ -717,6 +2023,7 @@ class CountyExpert(Role):
     def get_concrete(self):
         return self
 
+    @transaction.atomic
     def accept_issue(self, issue, mission_type, speciality_requirements, machinery_requirements):
         """
             speciality_requirements is a list of tuples in the form of (Speciality, Amount) in which the
@@ -743,6 +2050,10 @@ class CountyExpert(Role):
 
         issue.state = Issue.State.ACCEPTED
         issue.save()
+        if settings.DISPATCH_MODE == 'batch':
+            issue.postpone_assignment(mission_type)
+            self.county.dispatch_pending_assignments()
+            return Mission.objects.filter(issue=issue).first()
         return issue.assign_resources(mission_type)
 
     def reject_issue(self, issue):
@@ -0,0 +1,247 @@
+"""Pushes the missions of the servicemen and the locations of the teams of a county over websockets.
+
+Every worker has one Broker, an in-process publish/subscribe of messages by topic, which stands in for a shared
+broker: a websocket only receives the messages published by the worker it is connected to. The models of core
+import this module, so it imports them in its functions.
+"""
+import asyncio
+import json
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from http.cookies import SimpleCookie
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpRequest
+from django.http.request import split_domain_port, validate_host
+from rest_framework.authtoken.models import Token
+
+from accounts.models import Role
+
+COUNTY_PATH = re.compile(r'/ws/county/(\d+)/')
+SERVICEMAN_PATH = '/ws/serviceman/'
+# Browsers, which cannot set the headers of a websocket, offer this subprotocol followed by the token
+TOKEN_SUBPROTOCOL = 'token'
+
+
+class Broker:
+    """Delivers the messages published by any thread to the subscribers of their topic, each of which is an
+    asyncio.Queue read in the event loop it subscribed from.
+
+    A topic is a (kind, id) tuple. The messages for a subscriber whose queue is full are dropped.
+    """
+
+    def __init__(self):
+        self.__subscribers = defaultdict(set)
+        self.__kind_counts = Counter()
+        self.__lock = threading.Lock()
+
+    def subscribe(self, topic):
+        """returns the queue of a new subscriber of topic, to be called in the event loop that reads it"""
+        queue = asyncio.Queue(maxsize=settings.PUSH_QUEUE_SIZE)
+        with self.__lock:
+            self.__subscribers[topic].add((asyncio.get_running_loop(), queue))
+            self.__kind_counts[topic[0]] += 1
+        return queue
+
+    def unsubscribe(self, topic, queue):
+        with self.__lock:
+            subscribers = self.__subscribers[topic]
+            subscribers.difference_update([subscriber for subscriber in subscribers if subscriber[1] is queue])
+            if not subscribers:
+                del self.__subscribers[topic]
+            self.__kind_counts[topic[0]] -= 1
+
+    def has_subscribers(self, kind):
+        """returns whether any topic of the kind has a subscriber, so that publishers can skip building messages"""
+        return self.__kind_counts[kind] > 0
+
+    def publish(self, topic, message):
+        with self.__lock:
+            subscribers = list(self.__subscribers.get(topic, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self.deliver, queue, message)
+            except RuntimeError:
+                # The loop of the subscriber is closed, it is unsubscribed as its connection ends
+                pass
+
+    @staticmethod
+    def deliver(queue, message):
+        if not queue.full():
+            queue.put_nowait(message)
+
+
+broker = Broker()
+
+
+def publish_mission(mission_id):
+    """Pushes the mission, as the mission endpoint of the servicemen serves it, to the members of its teams"""
+    if not broker.has_subscribers('serviceman'):
+        return
+    from core.models import Mission, Serviceman
+    from core.serializers import MissionSerializer
+    mission = MissionSerializer.optimize(Mission.objects.filter(pk=mission_id)).first()
+    if mission is None:
+        return
+    message = {'type': 'mission', 'mission': MissionSerializer(mission).data}
+    for serviceman_id in Serviceman.objects.filter(team__in=mission.service_teams.all()).values_list('pk', flat=True):
+        broker.publish(('serviceman', serviceman_id), message)
+
+
+class TeamCounties:
+    """The counties of the teams, cached by every worker so that the locations are routed without a query each.
+
+    The teams rarely change their county: the entries of the teams saved by this worker are dropped, and the others
+    expire after PUSH_TEAM_COUNTY_TTL seconds.
+    """
+    __counties = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    def get(cls, team_id):
+        now = time.monotonic()
+        with cls.__lock:
+            county_id, loaded_at = cls.__counties.get(team_id, (None, None))
+        if loaded_at is None or now - loaded_at >= settings.PUSH_TEAM_COUNTY_TTL:
+            from core.models import ServiceTeam
+            county_id = ServiceTeam.objects.filter(pk=team_id).values_list('county_id', flat=True).first()
+            with cls.__lock:
+                cls.__counties[team_id] = (county_id, now)
+        return county_id
+
+    @classmethod
+    def forget(cls, team_id):
+        with cls.__lock:
+            cls.__counties.pop(team_id, None)
+
+
+def publish_location(serviceman_id, team_id, location):
+    """Pushes the location of the serviceman to the dashboards of the county of their team"""
+    if team_id is None or not broker.has_subscribers('county'):
+        return
+    county_id = TeamCounties.get(team_id)
+    if county_id is None:
+        return
+    broker.publish(('county', county_id), {
+        'type': 'location',
+        'serviceman': serviceman_id,
+        'team': team_id,
+        'lat': str(location.lat),
+        'long': str(location.long),
+    })
+
+
+def get_header(scope, name):
+    for header, value in scope.get('headers', []):
+        if header == name:
+            return value.decode('latin-1')
+    return None
+
+
+def is_allowed_origin(origin):
+    """returns whether the origin is of a host of ALLOWED_HOSTS, checked as Django checks the Host header"""
+    allowed_hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed_hosts:
+        allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+    domain, port = split_domain_port(urlsplit(origin).netloc)
+    return bool(domain) and validate_host(domain, allowed_hosts)
+
+
+def get_token_key(scope):
+    """returns the token in the Authorization header of the connection or offered after the token subprotocol"""
+    authorization = get_header(scope, b'authorization')
+    if authorization is not None:
+        keyword, _, key = authorization.partition(' ')
+        return key.strip() if keyword == 'Token' and key.strip() else None
+    subprotocols = list(scope.get('subprotocols', []))
+    if TOKEN_SUBPROTOCOL in subprotocols[:-1]:
+        return subprotocols[subprotocols.index(TOKEN_SUBPROTOCOL) + 1]
+    return None
+
+
+def authenticate(scope):
+    """Returns the user of the token or of the session cookie of the connection.
+
+    Connections from the pages of other sites, by their Origin header, are refused. Since a browser sends the
+    session cookie on the connections any page opens, the cookie is only taken from the pages of ALLOWED_HOSTS. The
+    token is not taken from the query string, which is written to the access logs.
+    """
+    origin = get_header(scope, b'origin')
+    if origin is not None and not is_allowed_origin(origin):
+        return None
+    key = get_token_key(scope)
+    if key is not None:
+        token = Token.objects.filter(key=key).select_related('user').first()
+        return token.user if token is not None and token.user.is_active else None
+    if origin is None:
+        return None
+    cookies = SimpleCookie()
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            cookies.load(value.decode('latin-1'))
+    if settings.SESSION_COOKIE_NAME not in cookies:
+        return None
+    request = HttpRequest()
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(cookies[settings.SESSION_COOKIE_NAME].value)
+    user = auth.get_user(request)
+    return user if user.is_authenticated else None
+
+
+def get_topic(scope):
+    """returns the topic the connection subscribes to by its path, or None if its user may not subscribe to it"""
+    from core.models import RegionTree
+    user = authenticate(scope)
+    if user is None or not user.has_role():
+        return None
+    role = user.role
+    if scope['path'] == SERVICEMAN_PATH:
+        return ('serviceman', role.pk) if role.type == Role.Type.SERVICEMAN else None
+    match = COUNTY_PATH.fullmatch(scope['path'])
+    if match is None:
+        return None
+    county_id = int(match.group(1))
+    if role.type == Role.Type.COUNTY_EXPERT:
+        allowed = role.countyexpert.county_id == county_id
+    elif role.type in [Role.Type.COUNTRY_MODERATOR, Role.Type.PROVINCE_MODERATOR, Role.Type.COUNTY_MODERATOR]:
+        allowed = RegionTree.get_instance().includes(role.moderator.region_id, county_id)
+    else:
+        allowed = False
+    return ('county', county_id) if allowed else None
+
+
+async def websocket_application(scope, receive, send):
+    """Streams the messages of the topic of the connection as JSON text frames, ignoring what the client sends"""
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    topic = await sync_to_async(get_topic)(scope)
+    if topic is None:
+        await send({'type': 'websocket.close', 'code': 4403})
+        return
+    if TOKEN_SUBPROTOCOL in scope.get('subprotocols', []):
+        await send({'type': 'websocket.accept', 'subprotocol': TOKEN_SUBPROTOCOL})
+    else:
+        await send({'type': 'websocket.accept'})
+    queue = broker.subscribe(topic)
+    receiving = asyncio.ensure_future(receive())
+    getting = asyncio.ensure_future(queue.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait([receiving, getting], return_when=asyncio.FIRST_COMPLETED)
+            if getting in done:
+                await send({'type': 'websocket.send', 'text': json.dumps(getting.result(), cls=DjangoJSONEncoder)})
+                getting = asyncio.ensure_future(queue.get())
+            if receiving in done:
+                if receiving.result()['type'] == 'websocket.disconnect':
+                    break
+                receiving = asyncio.ensure_future(receive())
+    finally:
+        receiving.cancel()
+        getting.cancel()
+        broker.unsubscribe(topic, queue)
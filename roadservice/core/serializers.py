@@ -1,9 +1,19 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import serializers
 
 from accounts.models import User
 from accounts.serializers import UserSerializer
 from core.models import Speciality, SpecialityRequirement, Issue, MachineryRequirement, MachineryType, MissionType, \
-    Serviceman, Mission, County, Province, Country, ServiceTeam
+    Serviceman, Mission, County, Province, Country, ServiceTeam, Location
 
 
 class SpecialitySerializer(serializers.ModelSerializer):
@@ -47,6 +57,63 @@ class IssueRejectionSerializer(serializers.Serializer):
     issue = serializers.PrimaryKeyRelatedField(queryset=Issue.objects.all())
 
 
+class IssueFilterSerializer(serializers.Serializer):
+    """Reads the filters and the page of an issue listing from the query string.
+
+    The issues are listed newest first, and a page starts after the (created_at, id) of the last issue of the page
+    before it, which the cursor encodes. The bounding box is 'min_lat,min_long,max_lat,max_long'.
+    """
+    state = serializers.ChoiceField(choices=Issue.State.choices, default=Issue.State.REPORTED)
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+    bbox = serializers.CharField(required=False)
+    page_size = serializers.IntegerField(min_value=1, max_value=settings.ISSUE_PAGE_SIZE_LIMIT,
+                                         default=settings.ISSUE_PAGE_SIZE)
+    cursor = serializers.CharField(required=False)
+
+    def validate_bbox(self, bbox):
+        try:
+            min_lat, min_long, max_lat, max_long = [Decimal(value) for value in bbox.split(',')]
+        except (ValueError, ArithmeticError):
+            raise serializers.ValidationError('The bounding box must be 4 comma separated coordinates.')
+        if not all(value.is_finite() for value in (min_lat, min_long, max_lat, max_long)) or \
+                not (-90 <= min_lat <= 90 and -90 <= max_lat <= 90 and -180 <= min_long <= 180 and
+                     -180 <= max_long <= 180):
+            raise serializers.ValidationError('The bounding box must be of valid coordinates.')
+        return min_lat, min_long, max_lat, max_long
+
+    def validate_cursor(self, cursor):
+        try:
+            created_at, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            created_at = parse_datetime(created_at)
+        except (ValueError, TypeError, binascii.Error):
+            raise serializers.ValidationError('Invalid cursor.')
+        if created_at is None or not isinstance(pk, int):
+            raise serializers.ValidationError('Invalid cursor.')
+        return created_at, pk
+
+    @staticmethod
+    def encode_cursor(issue):
+        return base64.urlsafe_b64encode(json.dumps([issue.created_at.isoformat(), issue.pk]).encode()).decode()
+
+    def get_page(self, issues):
+        """returns the queryset of the page of the filtered issues, with one more issue that tells whether there is a
+        next page"""
+        data = self.validated_data
+        issues = issues.filter(state=data['state'])
+        if 'created_after' in data:
+            issues = issues.filter(created_at__gte=data['created_after'])
+        if 'created_before' in data:
+            issues = issues.filter(created_at__lt=data['created_before'])
+        if 'bbox' in data:
+            min_lat, min_long, max_lat, max_long = data['bbox']
+            issues = issues.filter(lat__gte=min_lat, lat__lte=max_lat, long__gte=min_long, long__lte=max_long)
+        if 'cursor' in data:
+            created_at, pk = data['cursor']
+            issues = issues.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+        return issues.order_by('-created_at', '-id')[:data['page_size'] + 1]
+
+
 class LocationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Serviceman
@@ -57,6 +124,34 @@ class LocationSerializer(serializers.ModelSerializer):
         }
 
 
+class LocationBatchSerializer(serializers.Serializer):
+    """Decodes a batch of timestamped location fixes into (datetime, Location) pairs.
+
+    Every fix is [unix seconds, latitude, longitude] with the coordinates in integer microdegrees. The first fix is
+    absolute and every other fix is its difference from the one before it, e.g.
+    {"fixes": [[1700000000, 35689200, 51389000], [5, 120, -40], [5, 95, -31]]}
+    """
+    fixes = serializers.ListField(
+        child=serializers.ListField(child=serializers.IntegerField(), min_length=3, max_length=3),
+        min_length=1,
+        max_length=settings.LOCATION_BATCH_LIMIT
+    )
+
+    def validate_fixes(self, fixes):
+        decoded_fixes = []
+        timestamp = lat = long = 0
+        for timestamp_delta, lat_delta, long_delta in fixes:
+            timestamp, lat, long = timestamp + timestamp_delta, lat + lat_delta, long + long_delta
+            if not (-90000000 <= lat <= 90000000 and -180000000 <= long <= 180000000):
+                raise serializers.ValidationError('The fixes must decode to valid coordinates.')
+            try:
+                recorded_at = datetime.fromtimestamp(timestamp, timezone.utc)
+            except (OverflowError, OSError, ValueError):
+                raise serializers.ValidationError('The fixes must decode to valid times.')
+            decoded_fixes.append((recorded_at, Location(Decimal(lat).scaleb(-6), Decimal(long).scaleb(-6))))
+        return decoded_fixes
+
+
 class CountrySerializer(serializers.ModelSerializer):
     class Meta:
         model = Country
@@ -95,6 +190,11 @@ class IssueSerializer(serializers.ModelSerializer):
         fields = ['id', 'lat', 'long', 'state', 'title', 'description', 'reporter', 'county',
                   'created_at', 'mission', 'image_url']
 
+    @staticmethod
+    def optimize(queryset):
+        """returns the queryset loading along the related rows the serializer reads"""
+        return queryset.select_related('mission', 'reporter__user__role')
+
     def get_reporter(self, obj):
         return UserSerializer(obj.reporter.user).data
 
@@ -104,35 +204,32 @@ class IssueSerializer(serializers.ModelSerializer):
         return None
 
 
-class NestedCountySerializer(serializers.ModelSerializer):
-    province = serializers.PrimaryKeyRelatedField(queryset=Province.objects.all(), source='super_region.province')
-
-    class Meta:
-        model = County
-        fields = ['id', 'name', 'province']
+class NestedCountySerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    province = serializers.IntegerField(source='super_region_id')
 
 
-class NestedProvinceSerializer(serializers.ModelSerializer):
-    country = serializers.PrimaryKeyRelatedField(queryset=Country.objects.all(), source='super_region.country')
+class NestedProvinceSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    country = serializers.IntegerField(source='super_region_id')
     sub_regions = serializers.SerializerMethodField()
 
-    class Meta:
-        model = Country
-        fields = ['id', 'name', 'country', 'sub_regions']
-
     def get_sub_regions(self, obj):
-        return [NestedCountySerializer(region.county).data for region in obj.sub_regions.all()]
+        counties = self.context['tree'].get_children(obj.id)
+        return NestedCountySerializer(counties, many=True).data
 
 
-class NestedCountrySerializer(serializers.ModelSerializer):
+class NestedCountrySerializer(serializers.Serializer):
+    """Serializes a country node of a RegionTree, given as the tree in the context, with all the regions below it"""
+    id = serializers.IntegerField()
+    name = serializers.CharField()
     sub_regions = serializers.SerializerMethodField()
 
-    class Meta:
-        model = Country
-        fields = ['id', 'name', 'sub_regions']
-
     def get_sub_regions(self, obj):
-        return [NestedProvinceSerializer(region.province).data for region in obj.sub_regions.all().order_by('name')]
+        provinces = sorted(self.context['tree'].get_children(obj.id), key=lambda node: node.name)
+        return NestedProvinceSerializer(provinces, many=True, context=self.context).data
 
 
 class IssueReportingSerializer(serializers.ModelSerializer):
@@ -159,6 +256,11 @@ class ServicemanSerializer(serializers.ModelSerializer):
         model = Serviceman
         fields = ['lat', 'long', 'user', 'team']
 
+    @staticmethod
+    def optimize(queryset):
+        """returns the queryset loading along the related rows the serializer reads"""
+        return queryset.select_related('user__role')
+
     def get_user(self, obj):
         return UserSerializer(obj.user).data
 
@@ -170,6 +272,12 @@ class ServiceTeamSerializer(serializers.ModelSerializer):
         model = ServiceTeam
         fields = ['county', 'active_mission', 'speciality', 'members']
 
+    @staticmethod
+    def optimize(queryset):
+        """returns the queryset loading along the related rows the serializer reads"""
+        return queryset.prefetch_related(
+            Prefetch('members', queryset=ServicemanSerializer.optimize(Serviceman.objects.order_by('pk'))))
+
     def get_members(self, obj):
         return ServicemanSerializer(obj.members.all(), many=True).data
 
@@ -183,6 +291,14 @@ class MissionSerializer(serializers.ModelSerializer):
         model = Mission
         fields = ['issue', 'service_teams', 'type', 'score', 'report', 'machinery_requirements']
 
+    @staticmethod
+    def optimize(queryset):
+        """returns the queryset loading along the related rows the serializer reads"""
+        return queryset.select_related('issue__reporter__user__role').prefetch_related(
+            Prefetch('service_teams', queryset=ServiceTeamSerializer.optimize(ServiceTeam.objects.order_by('pk'))),
+            'issue__machineryrequirement_set'
+        )
+
     def get_issue(self, obj):
         return IssueSerializer(obj.issue).data
 
@@ -1,10 +1,43 @@
-from django.test import TestCase
+import gzip
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+import numpy as np
+
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.checks import run_checks, Tags
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
 
 from accounts.models import User
+from core import push
+from core.api_views import RegionsListView
+from core.dispatch import min_cost_assignment, greedy_assignment
+from core.distance import bounding_box, haversine, haversine_distances, farthest_distances, nearest_neighbours, \
+    select_nearest, get_distance_backend, DISTANCE_BACKENDS, HAVERSINE_LOWER_BOUND_FACTOR, \
+    HAVERSINE_UPPER_BOUND_FACTOR, UNKNOWN_DISTANCE
 from core.models import Country, Province, County, CountryModerator, Citizen, Serviceman, \
-    ServiceTeam, CountyExpert, Issue, MachineryType, Machinery, MissionType, Speciality, Location
+    ServiceTeam, CountyExpert, Issue, MachineryType, Machinery, MissionType, Speciality, Location, RegionTree, \
+    RegionVersion, Mission, PendingAssignment, SpecialityRequirement, TeamAvailability, CountyNeighbourIndex, \
+    LocationBuffer, LocationFix, LocationArray, microdegrees, Region, MachinerySlot
+from core.push import websocket_application
+from core.serializers import LocationSerializer
 from core.exceptions import AccessDeniedError, OccupiedUserError, DuplicatedInfoError, BusyResourceError, \
-    ResourceNotFoundError, IllegalOperationInStateError, InvalidArgumentError
+    ResourceNotFoundError, IllegalOperationInStateError, InvalidArgumentError, TimeBudgetExceededError
 
 
 class BaseTestCase(TestCase):
@@ -139,29 +172,29 @@ class BaseTestCase(TestCase):
         self.water_type = MissionType.objects.create(name='Water')
 
     def setUpMachineries(self):
-        self.tehran_crane = Machinery.objects.create(type=self.crane_type, county=self.tehran, total_count=100, available_count=100)
-        Machinery.objects.create(type=self.loader_type, county=self.tehran, total_count=50, available_count=50)
-        self.tehran_truck = Machinery.objects.create(type=self.truck_type, county=self.tehran, total_count=30, available_count=30)
-        Machinery.objects.create(type=self.ambulance_type, county=self.tehran, total_count=40, available_count=40)
-        Machinery.objects.create(type=self.firetruck_type, county=self.tehran, total_count=30, available_count=30)
-
-        Machinery.objects.create(type=self.crane_type, county=self.shiraz, total_count=80, available_count=80)
-        Machinery.objects.create(type=self.loader_type, county=self.shiraz, total_count=30, available_count=30)
-        Machinery.objects.create(type=self.truck_type, county=self.shiraz, total_count=15, available_count=15)
-        Machinery.objects.create(type=self.ambulance_type, county=self.shiraz, total_count=20, available_count=20)
-        Machinery.objects.create(type=self.firetruck_type, county=self.shiraz, total_count=15, available_count=15)
-
-        Machinery.objects.create(type=self.crane_type, county=self.mashhad, total_count=90, available_count=70)
-        Machinery.objects.create(type=self.loader_type, county=self.mashhad, total_count=40, available_count=30)
-        Machinery.objects.create(type=self.truck_type, county=self.mashhad, total_count=25, available_count=25)
-        Machinery.objects.create(type=self.ambulance_type, county=self.mashhad, total_count=30, available_count=30)
-        Machinery.objects.create(type=self.firetruck_type, county=self.mashhad, total_count=20, available_count=20)
-
-        Machinery.objects.create(type=self.crane_type, county=self.isfahan, total_count=80, available_count=50)
-        Machinery.objects.create(type=self.loader_type, county=self.isfahan, total_count=50, available_count=40)
-        Machinery.objects.create(type=self.truck_type, county=self.isfahan, total_count=25, available_count=25)
-        Machinery.objects.create(type=self.ambulance_type, county=self.isfahan, total_count=35, available_count=30)
-        Machinery.objects.create(type=self.firetruck_type, county=self.isfahan, total_count=25, available_count=20)
+        self.tehran_crane = Machinery.objects.create(type=self.crane_type, county=self.tehran, total_count=100)
+        Machinery.objects.create(type=self.loader_type, county=self.tehran, total_count=50)
+        self.tehran_truck = Machinery.objects.create(type=self.truck_type, county=self.tehran, total_count=30)
+        Machinery.objects.create(type=self.ambulance_type, county=self.tehran, total_count=40)
+        Machinery.objects.create(type=self.firetruck_type, county=self.tehran, total_count=30)
+
+        Machinery.objects.create(type=self.crane_type, county=self.shiraz, total_count=80)
+        Machinery.objects.create(type=self.loader_type, county=self.shiraz, total_count=30)
+        Machinery.objects.create(type=self.truck_type, county=self.shiraz, total_count=15)
+        Machinery.objects.create(type=self.ambulance_type, county=self.shiraz, total_count=20)
+        Machinery.objects.create(type=self.firetruck_type, county=self.shiraz, total_count=15)
+
+        Machinery.objects.create(type=self.crane_type, county=self.mashhad, total_count=90)
+        Machinery.objects.create(type=self.loader_type, county=self.mashhad, total_count=40)
+        Machinery.objects.create(type=self.truck_type, county=self.mashhad, total_count=25)
+        Machinery.objects.create(type=self.ambulance_type, county=self.mashhad, total_count=30)
+        Machinery.objects.create(type=self.firetruck_type, county=self.mashhad, total_count=20)
+
+        Machinery.objects.create(type=self.crane_type, county=self.isfahan, total_count=80)
+        Machinery.objects.create(type=self.loader_type, county=self.isfahan, total_count=50)
+        Machinery.objects.create(type=self.truck_type, county=self.isfahan, total_count=25)
+        Machinery.objects.create(type=self.ambulance_type, county=self.isfahan, total_count=35)
+        Machinery.objects.create(type=self.firetruck_type, county=self.isfahan, total_count=25)
 
     def setUpTeams(self):
         self.u0 = User.objects.create(username='u0', phone_number='30')
@@ -274,6 +307,120 @@ class ServicemanTestCase(BaseTestCase):
         serviceman.update_location(new_location)
         self.assertEqual(serviceman.location, new_location)
 
+    def test_microdegree_storage(self):
+        serviceman = self.tehran_water_team0_servicemen[0]
+        serviceman.update_location(Location(Decimal('35.6892'), Decimal('-51.3890005')))
+        self.assertEqual(Serviceman.objects.filter(pk=serviceman.pk).values_list(
+            microdegrees('lat'), microdegrees('long')).get(), (35689200, -51389000))
+        serviceman.refresh_from_db()
+        self.assertEqual(serviceman.location, Location(Decimal('35.689200'), Decimal('-51.389000')))
+        self.assertEqual(LocationSerializer(serviceman).data, {'lat': '35.689200', 'long': '-51.389000'})
+        self.assertTrue(Serviceman.objects.filter(pk=serviceman.pk, lat__gt=35.6891, long=Decimal('-51.389')).exists())
+
+        locations = LocationArray.from_microdegrees([35689200, None], [51389000, 0])
+        self.assertEqual((len(locations), locations[0].to_tuple()), (2, (35.6892, 51.389)))
+        self.assertEqual(len(locations[1:]), 1)
+        self.assertTrue(np.isnan(locations.lats[1]))
+
+    def test_location_buffer(self):
+        self.addCleanup(LocationBuffer.flush)
+        serviceman0, serviceman1 = self.tehran_water_team1_servicemen
+        with override_settings(LOCATION_FLUSH_INTERVAL=60), \
+                mock.patch.object(LocationBuffer, 'start_flusher') as start_flusher:
+            with self.assertNumQueries(0):
+                serviceman0.update_location(Location(1.8, 2.5))
+                Serviceman.set_location(serviceman0.pk, Location(1.9, 2.4))
+                Serviceman.set_location(serviceman1.pk, Location(1.8, 2.3))
+            start_flusher.assert_called()
+            with self.assertNumQueries(0):
+                LocationFix.record(serviceman0.pk, serviceman0.team_id, [(timezone.now(), Location(1.9, 2.4))])
+            self.assertFalse(serviceman0.location_fixes.exists())
+            self.assertEqual(Serviceman.objects.filter(pk=serviceman0.pk).values_list('lat', 'long').get(),
+                             (Decimal(1), Decimal(1)))
+            self.assertEqual(Serviceman.objects.get(pk=serviceman0.pk).location, Location(1.9, 2.4))
+            with transaction.atomic():
+                self.assertEqual(self.tehran.get_required_teams(self.water_speciality, 1, Location(1.9, 2.4)),
+                                 [self.tehran_water_team1])
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                Serviceman.set_location(serviceman1.pk, Location(1.6, 2))
+            self.assertEqual(len(callbacks), 0)
+
+            # A due flush is left to the flusher thread
+            with override_settings(LOCATION_FLUSH_INTERVAL=0.001), self.assertNumQueries(0), \
+                    self.captureOnCommitCallbacks(execute=True) as callbacks:
+                time.sleep(0.002)
+                Serviceman.set_location(serviceman1.pk, Location(1.7, 2))
+            self.assertEqual(len(callbacks), 0)
+
+        self.assertEqual(LocationBuffer.flush(), 2)
+        self.assertIsNone(LocationBuffer.get(serviceman0.pk))
+        self.assertEqual(dict(Serviceman.objects.filter(pk__in=[serviceman0.pk, serviceman1.pk]).values_list(
+            'pk', 'lat')), {serviceman0.pk: Decimal('1.9'), serviceman1.pk: Decimal('1.7')})
+        self.assertEqual(serviceman0.location_fixes.get().location, Location(Decimal('1.9'), Decimal('2.4')))
+
+    def test_location_flusher(self):
+        flushed = threading.Event()
+        with mock.patch('core.models.atexit.register') as register, mock.patch('core.models.close_old_connections'), \
+                mock.patch.object(LocationBuffer, '_LocationBuffer__exit_registered', False), \
+                mock.patch.object(LocationBuffer, '_LocationBuffer__wakeup', threading.Event()), \
+                mock.patch.object(LocationBuffer, 'flush', side_effect=flushed.set) as flush:
+            for _ in range(2):
+                flushed.clear()
+                with override_settings(LOCATION_FLUSH_INTERVAL=0.01):
+                    LocationBuffer.start_flusher()
+                    # The idle thread only flushes once woken by a location
+                    self.assertFalse(flushed.wait(0.05))
+                    LocationBuffer.put_fixes([])
+                    self.assertTrue(flushed.wait(5))
+                # The thread stops once the buffering is turned off
+                for thread in threading.enumerate():
+                    if thread.name == 'location-flusher':
+                        thread.join(5)
+                        self.assertFalse(thread.is_alive())
+            register.assert_called_once_with(flush)
+
+    def test_location_history(self):
+        serviceman = self.tehran_wind_team_servicemen[0]
+        start = datetime(2026, 1, 1, 23, 58, 10, tzinfo=timezone.utc)
+        LocationFix.record(serviceman.pk, serviceman.team_id, [
+            (start + timedelta(seconds=15 * index), Location(Decimal('1.1') + index, 1)) for index in range(16)])
+        fixes = list(serviceman.location_fixes.order_by('recorded_at'))
+        self.assertEqual((fixes[0].location, fixes[0].day), (Location(Decimal('1.1'), 1), date(2026, 1, 1)))
+        self.assertEqual(fixes[-1].day, date(2026, 1, 2))
+
+        self.assertEqual(LocationFix.downsample(start + timedelta(seconds=15), start + timedelta(minutes=3), 60), 8)
+        self.assertEqual([fix.recorded_at.strftime('%H:%M:%S') for fix in serviceman.location_fixes.order_by(
+            'recorded_at')], ['23:58:10', '23:58:25', '23:59:10', '00:00:10', '00:01:10', '00:01:25', '00:01:40',
+                              '00:01:55'])
+        self.assertEqual(LocationFix.downsample(start + timedelta(seconds=15), start + timedelta(minutes=3), 60), 0)
+        self.assertEqual(LocationFix.prune(date(2026, 1, 2)), 3)
+        self.assertEqual(serviceman.location_fixes.count(), 5)
+
+    def test_mission_track(self):
+        serviceman = self.tehran_wind_team_servicemen[0]
+        LocationFix.record(serviceman.pk, serviceman.team_id, [(timezone.now() - timedelta(hours=1), Location(1, 1))])
+        mission = self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.wind_speciality, 1)], [])
+        Mission.objects.filter(pk=mission.pk).update(created_at=F('created_at') - timedelta(minutes=10))
+        mission.refresh_from_db()
+        self.client.force_login(serviceman.user)
+        self.client.post('/api/serviceman/update-locations/', {'fixes': [
+            [int(timezone.now().timestamp()) - 60, 1200000, 1300000], [1, 100000, 100000]]},
+            content_type='application/json')
+        self.client.post('/api/serviceman/update-location/', {'lat': '1.4', 'long': '1.4'})
+        # A serviceman who joins the team later does not bring in the fixes of the team they were in
+        newcomer = self.tehran_water_team0_servicemen[0]
+        LocationFix.record(newcomer.pk, newcomer.team_id, [(timezone.now(), Location(3, 3))])
+        Serviceman.objects.filter(pk=newcomer.pk).update(team=self.tehran_wind_team)
+        mission.finish('Done')
+        LocationFix.record(serviceman.pk, serviceman.team_id, [(timezone.now() + timedelta(hours=1), Location(2, 2))])
+        self.assertEqual([fix.location for fix in mission.get_track()],
+                         [Location(Decimal('1.2'), Decimal('1.3')), Location(Decimal('1.3'), Decimal('1.4')),
+                          Location(Decimal('1.4'), Decimal('1.4'))])
+        self.assertIsNotNone(mission.finished_at)
+
+        call_command('compactlocations', stdout=StringIO())
+        self.assertEqual(serviceman.location_fixes.count(), 5)
+
     def test_end_mission(self):
         self.mission = self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.wind_speciality, 1)],
                                                        [(self.crane_type, 10), (self.truck_type, 30)])
@@ -289,6 +436,259 @@ class ServiceTeamTestCase(BaseTestCase):
     def test_farthest_member_distance(self):
         pass
 
+    def test_get_nearest_teams(self):
+        generator = random.Random(7)
+        for index in range(30):
+            team = ServiceTeam.objects.create(county=self.mashhad, speciality=self.water_speciality)
+            for member_index in range(generator.randint(1, 4)):
+                user = User.objects.create(username='m%d-%d' % (index, member_index),
+                                           phone_number='9%d-%d' % (index, member_index))
+                Serviceman.objects.create(user=user, team=team, lat=round(generator.uniform(35, 37), 6),
+                                          long=round(generator.uniform(58, 60), 6))
+        location = Location(36, 59)
+        teams = list(self.mashhad.serviceteam_set.filter(speciality=self.water_speciality))
+        expected_teams = sorted(teams, key=lambda team: team.farthest_member_distance(location))
+        for amount in [0, 1, 5, 30, 40]:
+            self.assertEqual(self.mashhad.get_required_teams(self.water_speciality, amount, location),
+                             expected_teams[:amount])
+
+    def test_get_required_teams_queries(self):
+        location = Location(36, 59)
+        for team_count in [1, 20]:
+            for index in range(team_count):
+                team = ServiceTeam.objects.create(county=self.mashhad, speciality=self.water_speciality)
+                for member_index in range(3):
+                    user = User.objects.create(username='q%d-%d-%d' % (team_count, index, member_index),
+                                               phone_number='8%d-%d-%d' % (team_count, index, member_index))
+                    Serviceman.objects.create(user=user, team=team, lat=36 + index / 100, long=59 + member_index / 100)
+            with self.assertNumQueries(2):
+                self.assertEqual(len(self.mashhad.get_required_teams(self.water_speciality, min(team_count, 10),
+                                                                     location)),
+                                 min(team_count, 10))
+
+    def test_get_required_teams_widening(self):
+        near_team = ServiceTeam.objects.create(county=self.mashhad, speciality=self.water_speciality)
+        far_team = ServiceTeam.objects.create(county=self.mashhad, speciality=self.water_speciality)
+        for index, (team, lat, long) in enumerate([(near_team, 36, 59), (near_team, 36.05, 59), (far_team, 37, 60)]):
+            user = User.objects.create(username='w%d' % index, phone_number='7%d' % index)
+            Serviceman.objects.create(user=user, team=team, lat=lat, long=long)
+        location = Location(36, 59.01)
+        get_nearest_teams = ServiceTeam.get_nearest_teams
+        with mock.patch.object(ServiceTeam, 'get_nearest_teams', side_effect=get_nearest_teams) as nearest_teams:
+            self.assertEqual(self.mashhad.get_required_teams(self.water_speciality, 1, location), [near_team])
+            self.assertEqual([row[0] for row in nearest_teams.call_args[0][0]], [near_team.pk, near_team.pk])
+            nearest_teams.reset_mock()
+            self.assertEqual(self.mashhad.get_required_teams(self.water_speciality, 2, location),
+                             [near_team, far_team])
+            # The far team is about 90 miles away, out of the boxes of 10 and 80 miles
+            self.assertEqual(nearest_teams.call_count, 3)
+            self.assertEqual(self.mashhad.get_required_teams(self.water_speciality, 3, location),
+                             [near_team, far_team])
+
+
+class DistanceTestCase(TestCase):
+    def test_bounding_box(self):
+        generator = random.Random(5)
+        for lat, long, radius in [(36, 59, 10), (-60, 170, 300), (75, -120, 500)]:
+            min_lat, max_lat, min_long, max_long = bounding_box(lat, long, radius)
+            for _ in range(2000):
+                point_lat = generator.uniform(max(lat - 10, -90), min(lat + 10, 90))
+                point_long = generator.uniform(long - 30, long + 30)
+                if haversine(lat, long, point_lat, point_long) <= radius:
+                    self.assertTrue(min_lat <= point_lat <= max_lat and min_long <= point_long <= max_long)
+            self.assertGreater(haversine(lat, long, max_lat + 0.01, long), radius)
+        self.assertEqual(bounding_box(89.9, 0, 20)[2:], (None, None))
+        self.assertEqual(bounding_box(-60, 179.9, 50)[2:], (None, None))
+        self.assertIsNone(bounding_box(0, 0, 13000))
+
+    def test_haversine_distances(self):
+        generator = random.Random(3)
+        points = [(generator.uniform(25, 40), generator.uniform(44, 63)) for _ in range(50)]
+        targets = [(generator.uniform(25, 40), generator.uniform(44, 63)) for _ in range(3)]
+        distances = haversine_distances([lat for lat, _ in points], [long for _, long in points],
+                                        [lat for lat, _ in targets], [long for _, long in targets])
+        self.assertEqual(distances.shape, (3, 50))
+        for i, (target_lat, target_long) in enumerate(targets):
+            for j, (lat, long) in enumerate(points):
+                self.assertAlmostEqual(distances[i, j], haversine(lat, long, target_lat, target_long), places=6)
+                geodesic_distance = Location(lat, long).distance_from(Location(target_lat, target_long))
+                self.assertLessEqual(HAVERSINE_LOWER_BOUND_FACTOR * distances[i, j], geodesic_distance)
+                self.assertGreaterEqual(HAVERSINE_UPPER_BOUND_FACTOR * distances[i, j], geodesic_distance)
+
+    def test_nearest_neighbours(self):
+        generator = random.Random(5)
+        lats = np.array([generator.uniform(25, 40) for _ in range(30)])
+        longs = np.array([generator.uniform(44, 63) for _ in range(30)])
+        distances = haversine_distances(lats, longs, lats, longs)
+        neighbours = nearest_neighbours(lats, longs, 4, chunk_size=7)
+        self.assertEqual(neighbours.shape, (30, 4))
+        for index in range(30):
+            expected = [other for other in np.argsort(distances[index], kind='stable') if other != index][:4]
+            self.assertEqual(list(neighbours[index]), expected)
+        self.assertEqual(nearest_neighbours(lats[:3], longs[:3], 4).shape, (3, 2))
+        self.assertEqual(nearest_neighbours(lats[:1], longs[:1], 4).shape, (1, 0))
+
+    def test_farthest_distances(self):
+        lats, longs = [1, 1.1, 1, 1, 1.5], [1, 1, 1.1, 1, 1]
+        distances = farthest_distances(lats, longs, [0, 3, 4], 1, 1)
+        self.assertEqual(distances.shape, (1, 3))
+        self.assertAlmostEqual(distances[0, 0], haversine(1.1, 1, 1, 1))
+        self.assertEqual(distances[0, 1], 0)
+        self.assertAlmostEqual(distances[0, 2], haversine(1.5, 1, 1, 1))
+        self.assertEqual(farthest_distances([1, np.nan, 1], [1, 1, 1], [0, 1], 1, 1).tolist(), [[0, UNKNOWN_DISTANCE]])
+
+    def test_select_nearest(self):
+        distances = [5, 3, 3, 9, 1, 3]
+        self.assertEqual(select_nearest(distances, distances.__getitem__, 4), [4, 1, 2, 5])
+        self.assertEqual(select_nearest([0] * 6, distances.__getitem__, 2), [4, 1])
+        visited = []
+        select_nearest(distances, lambda index: visited.append(index) or distances[index], 1)
+        self.assertEqual(visited, [4])
+
+    def test_distance_backends(self):
+        generator = random.Random(5)
+        geodesic = get_distance_backend('geodesic')
+        for name in DISTANCE_BACKENDS:
+            backend = get_distance_backend(name)
+            for _ in range(100):
+                lat, long = generator.uniform(25, 40), generator.uniform(44, 63)
+                spread = generator.choice([0.01, 0.3, 3])
+                point = (lat, long, lat + generator.gauss(0, spread), long + generator.gauss(0, spread))
+                lower_bound = backend.haversine_lower_bound_factor * haversine(*point)
+                self.assertLessEqual(lower_bound, backend.distance(*point) + 1e-9)
+                self.assertAlmostEqual(backend.distance(*point), geodesic.distance(*point),
+                                       delta=0.0071 * geodesic.distance(*point) + 1e-9)
+
+    def test_distance_setting(self):
+        origin, destination = Location(35.7, 51.4), Location(35.8, 51.6)
+        with override_settings(DISTANCE_BACKEND='haversine'):
+            self.assertEqual(origin.distance_from(destination), haversine(35.7, 51.4, 35.8, 51.6))
+        with override_settings(DISTANCE_BACKEND='core.distance.EquirectangularBackend'):
+            self.assertAlmostEqual(origin.distance_from(destination), haversine(35.7, 51.4, 35.8, 51.6), places=3)
+
+    def test_benchmark_distance(self):
+        out = StringIO()
+        call_command('benchmarkdistance', calls=200, rankings=5, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines[1:4]], list(DISTANCE_BACKENDS))
+        self.assertIn('100.0%', lines[1])
+
+
+class BenchmarkDispatchTestCase(TestCase):
+    def test_benchmark_dispatch(self):
+        out = StringIO()
+        call_command('benchmarkdispatch', provinces=2, counties=2, teams=3, issues=3, cycles=10, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['operations']['accept']['count'], 10)
+        self.assertEqual(sum(report['outcomes'].values()), 10)
+        self.assertFalse(Country.objects.filter(name='Bench').exists())
+
+    def test_benchmark_dispatch_stress(self):
+        out = StringIO()
+        call_command('benchmarkdispatch', provinces=2, counties=2, teams=3, issues=3, cycles=10, workers=1, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(sum(report['outcomes'].values()), 10)
+        self.assertEqual(report['violations'], {'double_booked_teams': 0, 'negative_machinery': 0,
+                                                'team_mismatches': 0, 'availability_mismatches': 0,
+                                                'machinery_mismatches': 0})
+        self.assertGreater(report['locking_statement_time']['count'], 0)
+        self.assertFalse(Country.objects.filter(name='Bench').exists())
+        self.assertFalse(User.objects.filter(username__startswith='bench-').exists())
+
+
+class BenchmarkDispatchStressTestCase(TransactionTestCase):
+    def test_concurrent_workers(self):
+        # The workers run in threads with connections of their own, which only see the committed data
+        out = StringIO()
+        call_command('benchmarkdispatch', provinces=2, counties=2, teams=3, issues=5, cycles=20, workers=3,
+                     stdout=out)
+        report = json.loads(out.getvalue())
+        # Every issue is accepted once, while the failed finishes are counted with the errors too
+        self.assertEqual(sum(report['outcomes'].values()) + report['errors'].get('accept', 0), 20)
+        self.assertEqual(report['violations'], {'double_booked_teams': 0, 'negative_machinery': 0,
+                                                'team_mismatches': 0, 'availability_mismatches': 0,
+                                                'machinery_mismatches': 0})
+        self.assertFalse(Country.objects.filter(name='Bench').exists())
+
+
+class DispatchTestCase(BaseTestCase):
+    def test_min_cost_assignment(self):
+        generator = random.Random(11)
+        for _ in range(100):
+            row_count = generator.randint(1, 5)
+            column_count = generator.randint(row_count, 6)
+            costs = [[generator.randint(0, 20) for _ in range(column_count)] for _ in range(row_count)]
+            assignment = min_cost_assignment(costs)
+            self.assertEqual(len(set(assignment)), row_count)
+            self.assertEqual(sum(costs[row][column] for row, column in enumerate(assignment)),
+                             min(sum(costs[row][column] for row, column in enumerate(columns))
+                                 for columns in itertools.permutations(range(column_count), row_count)))
+        with self.assertRaises(TimeBudgetExceededError):
+            min_cost_assignment([[1, 2], [3, 4]], deadline=0)
+
+    def test_greedy_assignment(self):
+        self.assertEqual(greedy_assignment([[1, 2, 5], [1, 3, 0.5]]), [0, 2])
+        self.assertEqual(greedy_assignment([[1, 2], [1, 3]]), [0, 1])
+
+    def test_dispatch_pending_assignments(self):
+        speciality = Speciality.objects.create(name='dispatch')
+        teams = []
+        for index, long in enumerate([59.6, 58]):
+            team = ServiceTeam.objects.create(county=self.mashhad, speciality=speciality)
+            user = User.objects.create(username='d%d' % index, phone_number='7%d' % index)
+            Serviceman.objects.create(user=user, team=team, lat=36, long=long)
+            teams.append(team)
+        issues = [self.citizen0.submit_issue(title='Issue %d' % index, description='To dispatch', county=self.mashhad,
+                                             location=Location(36, long), base64_image=None)
+                  for index, long in enumerate([59, 60, 61])]
+        for issue in issues:
+            issue.state = Issue.State.ACCEPTED
+            issue.save()
+            SpecialityRequirement.objects.create(issue=issue, speciality=speciality, amount=1)
+            PendingAssignment.objects.create(issue=issue, county=self.mashhad, mission_type=self.water_type)
+
+        # The greedy dispatch would give the team at 59.6 to the older issue at 59, leaving the one at 58 for 60
+        missions = self.mashhad.dispatch_pending_assignments()
+        self.assertEqual([mission.issue for mission in missions], issues[:2])
+        self.assertEqual([list(mission.service_teams.all()) for mission in missions], [[teams[1]], [teams[0]]])
+        self.assertEqual(list(PendingAssignment.objects.values_list('issue', flat=True)), [issues[2].pk])
+
+        with override_settings(DISPATCH_MODE='batch'):
+            missions[1].finish('Fixed')
+        self.assertEqual(Issue.objects.get(pk=issues[2].pk).mission.service_teams.get(), teams[0])
+        self.assertFalse(PendingAssignment.objects.exists())
+
+        issue = self.citizen0.submit_issue(title='Issue 3', description='To dispatch', county=self.mashhad,
+                                           location=Location(36, 58), base64_image=None)
+        with override_settings(DISPATCH_MODE='batch'):
+            self.assertIsNone(self.mashhad_expert.accept_issue(issue, self.water_type, [(speciality, 1)], []))
+            missions[0].finish('Fixed')
+        self.assertEqual(Issue.objects.get(pk=issue.pk).mission.service_teams.get(), teams[1])
+
+
+    def test_batch_dispatch_budget(self):
+        deadlines = []
+
+        def record_deadline(costs, deadline):
+            deadlines.append(deadline - time.monotonic())
+            return min_cost_assignment(costs, deadline)
+
+        self.issue0.state = Issue.State.ACCEPTED
+        self.issue0.save()
+        SpecialityRequirement.objects.create(issue=self.issue0, speciality=self.water_speciality, amount=1)
+        SpecialityRequirement.objects.create(issue=self.issue0, speciality=self.wind_speciality, amount=1)
+        PendingAssignment.objects.create(issue=self.issue0, county=self.tehran, mission_type=self.animal_type)
+        with override_settings(DISPATCH_TIME_BUDGET=10), \
+                mock.patch('core.models.min_cost_assignment', side_effect=record_deadline):
+            missions = self.tehran.dispatch_pending_assignments()
+        self.assertEqual(len(missions), 1)
+        self.assertEqual(set(team.speciality for team in missions[0].service_teams.all()),
+                         set([self.water_speciality, self.wind_speciality]))
+        # The first speciality gets half of the budget, and the second what the first left
+        self.assertEqual(len(deadlines), 2)
+        self.assertTrue(4 < deadlines[0] <= 5)
+        self.assertTrue(9 < deadlines[1] <= 10)
+
 
 class CountyExpertTestCase(BaseTestCase):
     def test_get_reported_issues(self):
@@ -314,8 +714,8 @@ class CountyExpertTestCase(BaseTestCase):
         self.assertEqual(self.issue0.state, Issue.State.ASSIGNED)
         self.assertEqual(self.tehran_water_team0.active_mission, self.issue0.mission)
         self.assertEqual(self.tehran_water_team1.active_mission, self.issue0.mission)
-        self.assertEqual(self.tehran_crane.available_count, 90)
-        self.assertEqual(self.tehran_truck.available_count, 25)
+        self.assertEqual(self.tehran_crane.get_available_count(), 90)
+        self.assertEqual(self.tehran_truck.get_available_count(), 25)
 
         self.tehran_expert.accept_issue(self.issue2, self.fire_type, [(self.wind_speciality, 2)], [(self.crane_type, 5)])
         self.issue1.refresh_from_db()
@@ -353,20 +753,259 @@ class IssueTestCase(BaseTestCase):
     def test_assign_resources(self):
         pass
 
+    def test_assign_resources_state_guard(self):
+        self.issue0.state = Issue.State.ACCEPTED
+        self.issue0.save()
+        stale_issue = Issue.objects.get(pk=self.issue0.pk)
+        self.issue0.state = Issue.State.REJECTED
+        self.issue0.save()
+        with self.assertRaises(IllegalOperationInStateError):
+            stale_issue.assign_resources(self.animal_type)
+        self.assertFalse(Mission.objects.filter(issue=self.issue0).exists())
+
+    def test_claim_resources_guards(self):
+        self.issue0.state = Issue.State.ACCEPTED
+        self.issue0.save()
+        other_mission = Mission.objects.create(issue=self.issue1, type=self.animal_type)
+        stale_team = ServiceTeam.objects.get(pk=self.tehran_water_team0.pk)
+        ServiceTeam.objects.filter(pk=stale_team.pk).update(active_mission=other_mission)
+        with self.assertRaises(BusyResourceError):
+            self.issue0.claim_resources(self.animal_type, [self.tehran_wind_team, stale_team], [])
+        self.tehran_wind_team.refresh_from_db()
+        self.assertIsNone(self.tehran_wind_team.active_mission)
+        self.assertFalse(Mission.objects.filter(issue=self.issue0).exists())
+
+        stale_crane = Machinery.objects.get(pk=self.tehran_crane.pk)
+        MachinerySlot.objects.filter(machinery=stale_crane).delete()
+        MachinerySlot.create_slots([(stale_crane.pk, 3)])
+        with self.assertRaises(BusyResourceError):
+            self.issue0.claim_resources(self.animal_type, [self.tehran_wind_team], [(stale_crane, 5)])
+        self.tehran_wind_team.refresh_from_db()
+        self.tehran_crane.refresh_from_db()
+        self.assertIsNone(self.tehran_wind_team.active_mission)
+        self.assertEqual(self.tehran_crane.get_available_count(), 3)
+
+        mission = self.issue0.claim_resources(self.animal_type, [self.tehran_wind_team], [(stale_crane, 3)])
+        self.issue0.refresh_from_db()
+        self.tehran_wind_team.refresh_from_db()
+        self.tehran_crane.refresh_from_db()
+        self.assertEqual(self.issue0.state, Issue.State.ASSIGNED)
+        self.assertEqual(self.tehran_wind_team.active_mission, mission)
+        self.assertEqual(self.tehran_crane.get_available_count(), 0)
+
+    def test_claim_teams_passes_over_taken_teams(self):
+        other_mission = Mission.objects.create(issue=self.issue1, type=self.animal_type)
+        get_required_teams = County.get_required_teams
+        taken_team_ids = []
+
+        def take_first_candidate(county, *args):
+            # Another assignment takes the nearest team between the ranking and the claim
+            candidates = get_required_teams(county, *args)
+            if not taken_team_ids:
+                taken_team_ids.append(candidates[0].pk)
+                ServiceTeam.objects.filter(pk=candidates[0].pk).update(active_mission=other_mission)
+            return candidates
+
+        with mock.patch.object(County, 'get_required_teams', take_first_candidate):
+            mission = self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.water_speciality, 1)], [])
+        self.assertIsNotNone(mission)
+        water_team_ids = set([self.tehran_water_team0.pk, self.tehran_water_team1.pk])
+        self.assertEqual(set(mission.service_teams.values_list('pk', flat=True)), water_team_ids - set(taken_team_ids))
+        self.assertEqual(ServiceTeam.objects.get(pk=taken_team_ids[0]).active_mission, other_mission)
+
+    def test_pending_assignment(self):
+        mission = self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.water_speciality, 2)],
+                                                  [(self.crane_type, 100)])
+        self.assertIsNotNone(mission)
+        self.assertIsNone(self.tehran_expert.accept_issue(self.issue2, self.fire_type, [(self.water_speciality, 1)],
+                                                          []))
+        issue4 = self.citizen0.submit_issue(title='Broken light', description='The traffic light is broken',
+                                            county=self.tehran, location=Location(1, 2), base64_image=None)
+        self.assertIsNone(self.tehran_expert.accept_issue(issue4, self.fire_type, [(self.wind_speciality, 1)],
+                                                          [(self.crane_type, 1)]))
+        self.issue2.refresh_from_db()
+        self.assertEqual(self.issue2.state, Issue.State.ACCEPTED)
+        self.assertEqual(set(PendingAssignment.objects.values_list('issue', flat=True)), set([issue4.pk, self.issue2.pk]))
+
+        self.tehran_moderator.increase_machinery(self.crane_type)
+        issue4.refresh_from_db()
+        self.assertEqual(issue4.state, Issue.State.ASSIGNED)
+        self.assertFalse(PendingAssignment.objects.filter(issue=issue4).exists())
+        self.issue2.refresh_from_db()
+        self.assertEqual(self.issue2.state, Issue.State.ACCEPTED)
+
+        mission.finish('The cow is caught alive')
+        self.issue2.refresh_from_db()
+        self.assertEqual(self.issue2.state, Issue.State.ASSIGNED)
+        self.assertEqual(self.issue2.mission.service_teams.get().speciality, self.water_speciality)
+        self.assertFalse(PendingAssignment.objects.exists())
+
+    def assertTeamAvailabilityCounted(self):
+        counted = set(TeamAvailability.objects.exclude(team_count=0, idle_count=0).values_list(
+            'county_id', 'speciality_id', 'team_count', 'idle_count'))
+        TeamAvailability.recount(County.objects.all())
+        self.assertEqual(counted, set(TeamAvailability.objects.values_list(
+            'county_id', 'speciality_id', 'team_count', 'idle_count')))
+
+    def test_team_availability(self):
+        self.assertTeamAvailabilityCounted()
+        users = [User.objects.create(username='a%d' % index, phone_number='6%d' % index) for index in range(3)]
+        speciality = self.tehran_moderator.add_speciality('snow plow')
+        team = self.tehran_moderator.add_service_team(speciality, users[:2])
+        self.assertEqual(TeamAvailability.objects.get(county=self.tehran, speciality=speciality).idle_count, 1)
+        self.assertTeamAvailabilityCounted()
+        self.tehran_moderator.edit_service_team(team, self.water_speciality, users[2:])
+        self.assertTeamAvailabilityCounted()
+
+        mission = self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.water_speciality, 3)], [])
+        self.assertTeamAvailabilityCounted()
+        self.tehran_expert.accept_issue(self.issue2, self.animal_type, [(self.water_speciality, 1)], [])
+        self.assertTeamAvailabilityCounted()
+        mission.finish('Done')
+        self.assertTeamAvailabilityCounted()
+        self.assertEqual(TeamAvailability.objects.get(county=self.tehran, speciality=self.water_speciality).idle_count,
+                         2)
+
+        self.tehran_moderator.delete_service_team(self.tehran.serviceteam_set.filter(
+            speciality=self.water_speciality, active_mission__isnull=True).first())
+        self.assertTeamAvailabilityCounted()
+
+    def test_machinery_reservations(self):
+        mission = self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.wind_speciality, 1)],
+                                                  [(self.crane_type, 10), (self.truck_type, 5)])
+        reservation = mission.machinery_reservations.get(machinery=self.tehran_crane)
+        self.assertEqual((reservation.amount, reservation.released_at), (10, None))
+        self.assertEqual(mission.machinery_reservations.count(), 2)
+        self.tehran_moderator.decrease_machinery(self.crane_type)
+        self.tehran_crane.refresh_from_db()
+        self.assertEqual((self.tehran_crane.total_count, self.tehran_crane.get_available_count()), (99, 89))
+
+        mission.finish('Done')
+        self.assertFalse(mission.machinery_reservations.filter(released_at__isnull=True).exists())
+        self.tehran_crane.refresh_from_db()
+        self.assertEqual(self.tehran_crane.get_available_count(), 99)
+
+        MachinerySlot.objects.filter(machinery=self.tehran_crane).update(available_count=1)
+        self.assertIn('core.E002', [error.id for error in run_checks(tags=[Tags.database], databases=['default'])])
+        self.tehran_crane.refresh_available_count()
+        self.assertEqual(self.tehran_crane.get_available_count(), 99)
+        self.assertEqual(Machinery.annotate_reserved_count(Machinery.annotate_available_count(
+            Machinery.objects.filter(pk=self.tehran_crane.pk))).filter(
+            available_count=F('total_count') - F('reserved_count')).count(), 1)
+
+    def test_machinery_slots(self):
+        self.assertEqual(list(self.tehran_crane.slots.order_by('index').values_list('available_count', flat=True)),
+                         [25, 25, 25, 25])
+        self.assertTrue(self.tehran_crane.take(60))
+        self.assertEqual(self.tehran_crane.get_available_count(), 40)
+        self.assertTrue(str(self.tehran_crane).endswith(': 40/100'))
+        self.assertFalse(self.tehran_crane.take(41))
+        self.assertEqual(self.tehran_crane.get_available_count(), 40)
+        self.assertFalse(self.tehran_crane.slots.filter(available_count__lt=0).exists())
+
+        MachinerySlot.give(self.tehran_crane.pk, 60)
+        self.assertEqual(self.tehran_crane.get_available_count(), 100)
+        MachinerySlot.objects.filter(machinery=self.tehran_crane).delete()
+        MachinerySlot.give(self.tehran_crane.pk, 2)
+        self.assertEqual(self.tehran_crane.get_available_count(), 2)
+
+        self.tractor_type = MachineryType.objects.create(name='Tractor')
+        tractor = Machinery.objects.create(type=self.tractor_type, county=self.tehran, total_count=1)
+        mission = self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.wind_speciality, 1)],
+                                                  [(self.tractor_type, 1)])
+        mission.finish('Done')
+        self.tehran_moderator.decrease_machinery(self.tractor_type)
+        tractor.refresh_from_db()
+        self.assertEqual(tractor.total_count, 0)
+        self.assertEqual(mission.machinery_reservations.get().machinery, tractor)
+        with self.assertRaises(ResourceNotFoundError):
+            self.tehran_moderator.decrease_machinery(self.tractor_type)
+        with self.assertRaises(BusyResourceError):
+            tractor.decrease()
+        self.assertEqual(self.tehran_moderator.increase_machinery(self.tractor_type), tractor)
+        self.assertEqual(tractor.get_available_count(), 1)
+
+    def test_unassignable_issue_fails(self):
+        self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.water_speciality, 3)], [])
+        self.issue0.refresh_from_db()
+        self.assertEqual(self.issue0.state, Issue.State.FAILED)
+        self.assertFalse(PendingAssignment.objects.exists())
+
+    def locate_counties(self):
+        for county, lat, long in [(self.tehran, 1, 1), (self.shahrerey, 1.1, 1.1), (self.isfahan, 1.3, 1.3),
+                                  (self.shiraz, 5, 5)]:
+            county.location = Location(lat, long)
+            county.save()
+
+    def test_county_neighbour_index(self):
+        self.locate_counties()
+        with override_settings(DISPATCH_FALLBACK_COUNTIES=2):
+            self.assertEqual(CountyNeighbourIndex.get_instance().get_neighbour_ids(self.shahrerey.id),
+                             [self.tehran.id, self.isfahan.id])
+            self.assertEqual(self.shahrerey.get_dispatch_county_ids(),
+                             [self.shahrerey.id, self.tehran.id, self.isfahan.id])
+            self.assertEqual(self.mashhad.get_dispatch_county_ids(), [self.mashhad.id])
+            self.assertEqual(self.tehran.get_borrower_county_ids(), [self.shahrerey.id, self.isfahan.id])
+            self.khorasan.location = Location(5.1, 5.1)
+            self.khorasan.save()
+            # Mashhad and Neyshabur are both placed at Khorasan, having no centroids of their own
+            self.assertEqual(self.mashhad.get_dispatch_county_ids(),
+                             [self.mashhad.id, self.neyshabur.id, self.shiraz.id])
+            self.isfahan.location = Location(9, 9)
+            self.isfahan.save()
+            self.assertEqual(CountyNeighbourIndex.get_instance().get_neighbour_ids(self.shahrerey.id),
+                             [self.tehran.id, self.shiraz.id])
+        self.assertEqual(self.shahrerey.get_dispatch_county_ids(), [self.shahrerey.id])
+
+    def test_fallback_dispatch(self):
+        self.locate_counties()
+        with override_settings(DISPATCH_FALLBACK_COUNTIES=2):
+            mission = self.shahrerey_expert.accept_issue(self.issue1, self.animal_type, [(self.water_speciality, 2)],
+                                                         [(self.crane_type, 5)])
+            self.assertEqual(set(mission.service_teams.all()), set([self.tehran_water_team0, self.tehran_water_team1]))
+            self.tehran_crane.refresh_from_db()
+            self.assertEqual(self.tehran_crane.get_available_count(), 95)
+            self.assertFalse(TeamAvailability.objects.filter(county=self.tehran, speciality=self.water_speciality,
+                                                             idle_count__gt=0).exists())
+            self.assertTeamAvailabilityCounted()
+            mission.finish('Done')
+            self.tehran_crane.refresh_from_db()
+            self.assertEqual(self.tehran_crane.get_available_count(), 100)
+            self.assertTeamAvailabilityCounted()
+
+            mission = self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.water_speciality, 2)], [])
+            issue = self.citizen4.submit_issue(title='Icy road', description='The road is icy', county=self.shahrerey,
+                                               location=Location(1.1, 1.1), base64_image=None)
+            self.assertIsNone(self.shahrerey_expert.accept_issue(issue, self.animal_type,
+                                                                 [(self.water_speciality, 1)], []))
+            self.assertTrue(PendingAssignment.objects.filter(issue=issue).exists())
+            # The teams are released in Tehran, whose queue is empty, and are taken by the queue of Shahrerey
+            mission.finish('Done')
+            issue.refresh_from_db()
+            self.assertEqual(issue.state, Issue.State.ASSIGNED)
+            self.assertEqual(issue.mission.service_teams.get().county_id, self.tehran.id)
+            self.assertTeamAvailabilityCounted()
+
+        issue = self.citizen4.submit_issue(title='Another slippery road', description='The road is slippery too',
+                                           county=self.shahrerey, location=Location(1.1, 1.1), base64_image=None)
+        self.shahrerey_expert.accept_issue(issue, self.animal_type, [(self.water_speciality, 1)], [])
+        issue.refresh_from_db()
+        self.assertEqual(issue.state, Issue.State.FAILED)
+
     def test_return_machineries(self):
         crane_need = 10
         truck_need = 30
         self.mission = self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.wind_speciality, 1)],
                                                        [(self.crane_type, crane_need), (self.truck_type, truck_need)])
-        available_cranes = self.tehran.machinery_set.get(type=self.crane_type).available_count
-        available_trucks = self.tehran.machinery_set.get(type=self.truck_type).available_count
+        available_cranes = self.tehran.machinery_set.get(type=self.crane_type).get_available_count()
+        available_trucks = self.tehran.machinery_set.get(type=self.truck_type).get_available_count()
         self.tehran_wind_team.refresh_from_db()
         self.tehran_wind_team_servicemen[0].end_mission('The cow is caught alive')
         self.tehran_wind_team.refresh_from_db()
         self.assertEqual(available_cranes + crane_need,
-                         self.tehran.machinery_set.get(type=self.crane_type).available_count)
+                         self.tehran.machinery_set.get(type=self.crane_type).get_available_count())
         self.assertEqual(available_trucks + truck_need,
-                         self.tehran.machinery_set.get(type=self.truck_type).available_count)
+                         self.tehran.machinery_set.get(type=self.truck_type).get_available_count())
 
 
 class ModeratorTestCase(BaseTestCase):
@@ -499,6 +1138,21 @@ class ModeratorTestCase(BaseTestCase):
             [self.shiraz.region_ptr, self.khorasan.region_ptr])), set([self.issue2]))
         self.assertEqual(set(self.iran_moderator.get_issues([self.khorasan.region_ptr])), set([]))
 
+    def test_get_overlapping_issues(self):
+        self.setUpModerators()
+        self.setUpIssues()
+        regions = [self.tehran_province.region_ptr, self.tehran.region_ptr, self.shiraz.region_ptr, self.iran.region_ptr]
+        region_set = self.tehran_province_moderator.get_region_set(regions)
+        self.assertEqual(region_set.region_ids, [self.tehran_province.id])
+        region_set = self.iran_moderator.get_region_set(regions[:3])
+        self.assertEqual(region_set.region_ids, sorted([self.tehran_province.id, self.shiraz.id]))
+        RegionTree.get_instance()
+        with self.assertNumQueries(1):
+            self.assertEqual(list(self.iran_moderator.get_issues(regions[:3]).order_by('id')),
+                             [self.issue0, self.issue1, self.issue2])
+        with self.assertNumQueries(0):
+            self.assertEqual(list(self.tehran_moderator.get_issues([self.shiraz.region_ptr])), [])
+
     def test_view_issue(self):
         self.setUpModerators()
         self.setUpExperts()
@@ -561,7 +1215,7 @@ class ModeratorTestCase(BaseTestCase):
         self.snow_plow_type = MachineryType.objects.create(name='Snow Plow')
         self.bulldozer_type = MachineryType.objects.create(name='Bulldozer')
         self.grader_type = MachineryType.objects.create(name='Grader')
-        self.tractor = Machinery.objects.create(type=self.tractor_type, total_count=1, available_count=1,
+        self.tractor = Machinery.objects.create(type=self.tractor_type, total_count=1,
                                                 county=self.shahrerey)
         self.shahrerey.moderator.get_concrete().increase_machinery(self.tractor_type)
         self.tractor.refresh_from_db()
@@ -576,7 +1230,7 @@ class ModeratorTestCase(BaseTestCase):
         self.bulldozer = self.shahrerey.moderator.get_concrete().increase_machinery(self.bulldozer_type)
         self.bulldozer.refresh_from_db()
         self.assertEqual(self.bulldozer.total_count, 1)
-        self.assertEqual(self.bulldozer.available_count, 1)
+        self.assertEqual(self.bulldozer.get_available_count(), 1)
         self.assertEqual(self.bulldozer.county.get_concrete(), self.shahrerey)
         self.shahrerey.moderator.get_concrete().decrease_machinery(self.bulldozer_type)
         with self.assertRaises(ResourceNotFoundError):
@@ -604,6 +1258,23 @@ class RegionTestCase(BaseTestCase):
         self.assertEqual(list(including_regions),
                          [self.iran.region_ptr, self.tehran_province.region_ptr, self.tehran.region_ptr])
 
+    def test_get_included_regions(self):
+        included_regions = self.khorasan.region_ptr.get_included_regions()
+        self.assertEqual(set(included_regions),
+                         set([self.khorasan.region_ptr, self.mashhad.region_ptr, self.neyshabur.region_ptr]))
+        included_regions = self.mashhad.region_ptr.get_included_regions()
+        self.assertEqual(list(included_regions), [self.mashhad.region_ptr])
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.iran.region_ptr.get_included_regions()), 14)
+
+    def test_move_region(self):
+        self.tehran_province.super_region = None
+        self.tehran_province.save()
+        self.tehran.refresh_from_db()
+        self.assertEqual(list(self.tehran.region_ptr.get_including_regions()),
+                         [self.tehran_province.region_ptr, self.tehran.region_ptr])
+        self.assertFalse(self.tehran.region_ptr in self.iran.region_ptr.get_included_regions())
+
     def test_get_counties(self):
         counties = self.mashhad.get_counties()
         self.assertEqual(list(counties), [self.mashhad])
@@ -614,6 +1285,363 @@ class RegionTestCase(BaseTestCase):
                                              self.shiraz, self.marvdasht, self.neyshabur, self.mashhad]))
 
 
+    def test_get_resources(self):
+        self.assertEqual(set(self.iran.get_teams()), set(ServiceTeam.objects.all()))
+        self.assertEqual(set(self.tehran_province.region_ptr.get_issues()), set([self.issue0, self.issue1, self.issue2]))
+        self.assertEqual(set(self.shiraz.region_ptr.get_machineries()), set(self.shiraz.machinery_set.all()))
+        self.assertEqual(list(self.khorasan.get_missions()), [])
+
+    def test_get_resources_queries(self):
+        RegionTree.get_instance()
+        for region in [self.iran, self.tehran_province, self.tehran.region_ptr]:
+            with self.assertNumQueries(4):
+                list(region.get_teams())
+                list(region.get_machineries())
+                list(region.get_issues())
+                list(region.get_missions())
+
+
+    def test_region_keys(self):
+        self.assertEqual((self.issue1.province_id, self.issue1.country_id), (self.tehran_province.id, self.iran.id))
+        self.assertEqual((self.tehran_crane.province_id, self.tehran_crane.country_id),
+                         (self.tehran_province.id, self.iran.id))
+        self.shahrerey.super_region = self.khorasan.region_ptr
+        self.shahrerey.save()
+        self.assertEqual(set(self.khorasan.get_issues()), set([self.issue1]))
+        self.assertEqual(set(self.tehran_province.get_issues()), set([self.issue0, self.issue2]))
+        # The fixtures set the available machinery counts without reserving them
+        for machinery in Machinery.objects.all():
+            machinery.refresh_available_count()
+        self.assertEqual(run_checks(tags=[Tags.database], include_deployment_checks=False, databases=['default']), [])
+        ServiceTeam.objects.filter(county=self.shiraz).update(province_id=self.khorasan.id)
+        errors = run_checks(tags=[Tags.database], databases=['default'])
+        self.assertEqual([error.id for error in errors], ['core.E001'])
+        self.shiraz_province.update_region_keys()
+        self.assertEqual(run_checks(tags=[Tags.database], databases=['default']), [])
+        # A county moved by another worker, which the RegionTree of this one does not know of yet
+        RegionTree.get_instance()
+        Region.objects.filter(pk=self.damavand.id).update(super_region=self.khorasan.region_ptr)
+        self.issue0.county = self.damavand
+        self.issue0.save()
+        self.assertEqual((self.issue0.province_id, self.issue0.country_id), (self.khorasan.id, self.iran.id))
+        # The keys are not read again on the writes that keep the county
+        issue = Issue.objects.get(pk=self.issue1.pk)
+        with self.assertNumQueries(1):
+            issue.save()
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Issue.objects.create(title='Lost', description='In no county', reporter=self.citizen0,
+                                     county_id=0, location=Location(1, 1))
+
+
+class RegionTreeTestCase(BaseTestCase):
+    def test_lookups(self):
+        tree = RegionTree.get_instance()
+        self.assertEqual(tree.get_parent(self.mashhad.id).id, self.khorasan.id)
+        self.assertIsNone(tree.get_parent(self.iran.id))
+        self.assertEqual([node.id for node in tree.get_children(self.khorasan.id)], [self.mashhad.id, self.neyshabur.id])
+        self.assertEqual([node.id for node in tree.get_ancestors(self.shiraz.id)],
+                         [self.iran.id, self.shiraz_province.id, self.shiraz.id])
+        self.assertEqual(set(node.id for node in tree.get_descendants(self.tehran_province.id)),
+                         set([self.tehran_province.id, self.tehran.id, self.damavand.id, self.shahrerey.id]))
+        self.assertEqual(set(tree.get_county_ids(self.isfahan_province.id)), set([self.isfahan.id, self.khansar.id]))
+        self.assertEqual(tree.get_county_ids(self.isfahan.id), (self.isfahan.id,))
+        self.assertEqual(len(tree.get_county_ids(self.iran.id)), 9)
+        self.assertTrue(tree.includes(self.iran.id, self.marvdasht.id))
+        self.assertFalse(tree.includes(self.tehran_province.id, self.marvdasht.id))
+        self.assertEqual(tree.get_node(self.tehran.id).full_name, self.tehran.full_name)
+
+    def test_no_queries_once_loaded(self):
+        RegionTree.get_instance()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.tehran_province_moderator.can_moderate(self.damavand))
+            self.assertFalse(self.tehran_moderator.can_moderate(self.tehran_province))
+            self.assertEqual(self.tehran.region_ptr.get_concrete(), self.tehran)
+
+    def test_invalidation(self):
+        tree = RegionTree.get_instance()
+        self.assertIs(RegionTree.get_instance(), tree)
+        varamin = County.objects.create(name='Varamin', super_region=self.tehran_province.region_ptr)
+        self.assertTrue(RegionTree.get_instance().includes(self.tehran_province.id, varamin.id))
+
+    @override_settings(REGION_TREE_CHECK_INTERVAL=0)
+    def test_changes_of_other_workers(self):
+        tree = RegionTree.get_instance()
+        self.assertIs(RegionTree.get_instance(), tree)
+        RegionVersion.objects.update(value=F('value') + 1)
+        self.assertIsNot(RegionTree.get_instance(), tree)
+
+    def test_regions_created_since_the_check(self):
+        tree = RegionTree.get_instance()
+        varamin = County.objects.create(name='Varamin', super_region=self.tehran_province.region_ptr)
+        self.assertFalse(tree.contains(varamin.id))
+        self.assertEqual(tree.get_node(varamin.id).name, 'Varamin')
+        self.assertEqual([node.id for node in tree.get_descendants(varamin.id)], [varamin.id])
+        self.assertEqual(tree.get_parent(varamin.id).id, self.tehran_province.id)
+        with self.assertRaises(KeyError):
+            tree.get_node(0)
+        self.assertEqual(tree.get_county_ids(varamin.id), (varamin.id,))
+        self.assertTrue(tree.includes(self.tehran_province.id, varamin.id))
+        self.assertEqual(tree.get_children(varamin.id), ())
+        self.assertFalse(tree.includes(self.tehran_province.id, 0))
+
+
+class RegionTreeTransactionTestCase(TransactionTestCase):
+    def test_rolled_back_regions(self):
+        iran = Country.objects.create(name='Iran')
+        tehran_province = Province.objects.create(name='Tehran (P)', super_region=iran.region_ptr)
+        self.assertTrue(RegionTree.get_instance().contains(tehran_province.id))
+        with transaction.atomic():
+            varamin = County.objects.create(name='Varamin', super_region=tehran_province.region_ptr)
+            self.assertTrue(RegionTree.get_instance().includes(tehran_province.id, varamin.id))
+            transaction.set_rollback(True)
+        tree = RegionTree.get_instance()
+        self.assertFalse(tree.contains(varamin.id))
+        self.assertFalse(tree.provisional)
+        self.assertEqual(tree.get_county_ids(tehran_province.id), ())
+
+
+class RegionsListViewTestCase(BaseTestCase):
+    def test_payload(self):
+        response = self.client.get('/api/regions/')
+        data = json.loads(response.content)
+        self.assertEqual(data['id'], self.iran.id)
+        self.assertEqual([province['name'] for province in data['sub_regions']],
+                         ['Isfahan (P)', 'Khorasan', 'Shiraz (P)', 'Tehran (P)'])
+        self.assertEqual(data['sub_regions'][1]['sub_regions'],
+                         [{'id': self.mashhad.id, 'name': 'Mashhad', 'province': self.khorasan.id},
+                          {'id': self.neyshabur.id, 'name': 'Neyshabur', 'province': self.khorasan.id}])
+        compressed_response = self.client.get('/api/regions/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(compressed_response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed_response.content), response.content)
+        self.assertNotEqual(compressed_response['ETag'], response['ETag'])
+        refused_response = self.client.get('/api/regions/', HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+        self.assertFalse(refused_response.has_header('Content-Encoding'))
+        self.assertEqual(refused_response.content, response.content)
+        self.assertIn('Accept-Encoding', refused_response['Vary'])
+
+    def test_accepts_gzip(self):
+        for accept_encoding, accepted in [('', False), ('gzip', True), ('deflate, GZIP;q=0.5', True),
+                                          ('gzip;q=0', False), ('gzip; q=0.0, *', False), ('*;q=0.1', True),
+                                          ('*, gzip;q=0', False), ('identity, x-gzip', True), ('gzip;q=x', False),
+                                          ('gzipped', False)]:
+            self.assertEqual(RegionsListView.accepts_gzip(accept_encoding), accepted, accept_encoding)
+
+    def test_etag(self):
+        etag = self.client.get('/api/regions/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/regions/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        County.objects.create(name='Varamin', super_region=self.tehran_province.region_ptr)
+        response = self.client.get('/api/regions/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('Varamin', response.content.decode())
+
+
+class UpdateLocationsViewTestCase(BaseTestCase):
+    def test_update_locations(self):
+        serviceman = self.tehran_water_team0_servicemen[0]
+        self.client.force_login(serviceman.user)
+        fixes = [[1700000000, 35689200, 51389000], [5, 120, -40], [-3, 7, 7], [5, 95, -31]]
+        # The serviceman is loaded for the team the fixes are recorded in
+        with self.assertNumQueries(6):
+            response = self.client.post('/api/serviceman/update-locations/', {'fixes': fixes},
+                                        content_type='application/json')
+        self.assertEqual(json.loads(response.content), {'status': True})
+        serviceman.refresh_from_db()
+        self.assertEqual(serviceman.location, Location(Decimal('35.689422'), Decimal('51.388936')))
+
+        for fixes in [[], [[1700000000, 91000000, 0]], [[1700000000, 0]]]:
+            response = self.client.post('/api/serviceman/update-locations/', {'fixes': fixes},
+                                        content_type='application/json')
+            self.assertIn('fixes', json.loads(response.content))
+        serviceman.refresh_from_db()
+        self.assertEqual(serviceman.location, Location(Decimal('35.689422'), Decimal('51.388936')))
+
+
+class APIQueriesTestCase(BaseTestCase):
+    def report_issues(self, count):
+        for index in range(count):
+            user = User.objects.create(username='r%d' % index, phone_number='7%d' % index)
+            citizen = Citizen.objects.create(user=user)
+            citizen.submit_issue(title='Issue %d' % index, description='An issue', county=self.tehran,
+                                 location=Location(1, 1), base64_image=None)
+
+    def add_team_members(self, team, count):
+        for index in range(count):
+            user = User.objects.create(username='t%d-%d' % (team.pk, index), phone_number='5%d-%d' % (team.pk, index))
+            Serviceman.objects.create(user=user, team=team, lat=1, long=1)
+
+    def test_reported_issues(self):
+        self.client.force_login(self.tehran_expert.user)
+        for count in [0, 20]:
+            self.report_issues(count)
+            with self.assertNumQueries(5):
+                response = self.client.get('/api/expert/issues/')
+        issues = json.loads(response.content)
+        self.assertEqual(len(issues), 22)
+        self.assertEqual(issues[0]['reporter']['role'], 'CZ')
+
+    def test_issue_pages(self):
+        self.client.force_login(self.tehran_expert.user)
+        self.report_issues(5)
+        Issue.objects.filter(title='Issue 4').update(lat=35, long=51)
+        reported = list(Issue.objects.filter(county=self.tehran, state=Issue.State.REPORTED)
+                        .order_by('-created_at', '-id').values_list('id', flat=True))
+        ids, url = [], '/api/expert/issues/?page_size=3'
+        while url:
+            response = self.client.get(url)
+            ids += [issue['id'] for issue in json.loads(response.content)]
+            url = re.fullmatch(r'<(.*)>; rel="next"', response['Link']).group(1) if 'Link' in response else None
+        self.assertEqual(ids, reported)
+        self.assertNotEqual(reported[0], reported[-1])
+
+        response = self.client.get('/api/expert/issues/', {'bbox': '34,50,36,52'})
+        self.assertEqual([issue['title'] for issue in json.loads(response.content)], ['Issue 4'])
+        response = self.client.get('/api/expert/issues/', {'created_after': '2100-01-01T00:00:00Z'})
+        self.assertEqual(json.loads(response.content), [])
+        response = self.client.get('/api/expert/issues/', {'state': 'RJ'})
+        self.assertEqual(json.loads(response.content), [])
+        response = self.client.get('/api/expert/issues/', {'cursor': 'nonsense'})
+        self.assertIn('cursor', json.loads(response.content))
+        for bbox in ['1,2,3', 'NaN,2,3,4', '1,-Infinity,3,4', '1,2,1e30,4', '1,2,3,181']:
+            response = self.client.get('/api/expert/issues/', {'bbox': bbox})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('bbox', json.loads(response.content))
+
+    def test_mission(self):
+        self.client.force_login(self.tehran_water_team0_servicemen[0].user)
+        self.assertEqual(self.client.get('/api/serviceman/mission/').status_code, 404)
+        self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.water_speciality, 1)],
+                                        [(self.crane_type, 1)])
+        for count in [0, 10]:
+            self.add_team_members(self.tehran_water_team0, count)
+            self.add_team_members(self.tehran_water_team1, count)
+            with self.assertNumQueries(7):
+                response = self.client.get('/api/serviceman/mission/')
+        mission = json.loads(response.content)
+        self.assertEqual(mission['issue']['id'], self.issue0.id)
+        self.assertEqual(len(mission['service_teams'][0]['members']), 13)
+        self.assertEqual(mission['machinery_requirements'][0]['amount'], 1)
+
+    def test_team(self):
+        self.client.force_login(self.tehran_water_team0_servicemen[0].user)
+        for count in [0, 10]:
+            self.add_team_members(self.tehran_water_team0, count)
+            with self.assertNumQueries(5):
+                response = self.client.get('/api/serviceman/team/')
+        team = json.loads(response.content)
+        self.assertEqual(len(team['members']), 13)
+        self.assertEqual(team['members'][0]['user']['role'], 'SM')
+
+
+class PushTestCase(BaseTestCase):
+    def connect(self, path, user, origin=b'http://testserver'):
+        self.client.force_login(user)
+        cookie = '%s=%s' % (settings.SESSION_COOKIE_NAME, self.client.cookies[settings.SESSION_COOKIE_NAME].value)
+        headers = [(b'cookie', cookie.encode())]
+        if origin is not None:
+            headers.append((b'origin', origin))
+        return ApplicationCommunicator(websocket_application, {
+            'type': 'websocket', 'path': path, 'query_string': b'', 'headers': headers})
+
+    def connect_with_token(self, path, user, headers=(), subprotocols=(), query_string=b''):
+        key = Token.objects.get_or_create(user=user)[0].key
+        return ApplicationCommunicator(websocket_application, {
+            'type': 'websocket', 'path': path, 'query_string': query_string % {b'key': key.encode()},
+            'headers': [(name, value % {b'key': key.encode()}) for name, value in headers],
+            'subprotocols': [subprotocol % {'key': key} for subprotocol in subprotocols]})
+
+    def accept_issue(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.tehran_expert.accept_issue(self.issue0, self.animal_type, [(self.wind_speciality, 1)], [])
+
+    def post_locations(self):
+        self.client.force_login(self.tehran_wind_team_servicemen[1].user)
+        self.client.post('/api/serviceman/update-locations/', {'fixes': [[1700000000, 1500000, 1300000]]},
+                         content_type='application/json')
+
+    def test_team_counties(self):
+        team = self.tehran_wind_team
+        self.addCleanup(push.TeamCounties.forget, team.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(push.TeamCounties.get(team.pk), self.tehran.pk)
+            self.assertEqual(push.TeamCounties.get(team.pk), self.tehran.pk)
+        team.county = self.shiraz
+        with self.captureOnCommitCallbacks(execute=True):
+            team.save()
+        self.assertEqual(push.TeamCounties.get(team.pk), self.shiraz.pk)
+        with override_settings(PUSH_TEAM_COUNTY_TTL=0):
+            ServiceTeam.objects.filter(pk=team.pk).update(county=self.tehran)
+            self.assertEqual(push.TeamCounties.get(team.pk), self.tehran.pk)
+
+    def test_push(self):
+        self.addCleanup(push.TeamCounties.forget, self.tehran_wind_team.pk)
+
+        async def scenario():
+            serviceman = await sync_to_async(self.connect)('/ws/serviceman/', self.tehran_wind_team_servicemen[0].user)
+            await serviceman.send_input({'type': 'websocket.connect'})
+            self.assertEqual(await serviceman.receive_output(1), {'type': 'websocket.accept'})
+            dashboard = await sync_to_async(self.connect)('/ws/county/%d/' % self.tehran.id, self.tehran_expert.user)
+            await dashboard.send_input({'type': 'websocket.connect'})
+            self.assertEqual(await dashboard.receive_output(1), {'type': 'websocket.accept'})
+
+            mission = await sync_to_async(self.accept_issue)()
+            message = json.loads((await serviceman.receive_output(1))['text'])
+            self.assertEqual((message['type'], message['mission']['issue']['id']), ('mission', mission.issue_id))
+            await sync_to_async(self.post_locations)()
+            self.assertEqual(json.loads((await dashboard.receive_output(1))['text']), {
+                'type': 'location', 'serviceman': self.tehran_wind_team_servicemen[1].pk,
+                'team': self.tehran_wind_team.pk, 'lat': '1.500000', 'long': '1.300000'})
+            self.assertTrue(await serviceman.receive_nothing())
+
+            for communicator in [serviceman, dashboard]:
+                await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+                await communicator.wait(1)
+            self.assertFalse(push.broker.has_subscribers('county'))
+
+            for path, user in [('/ws/county/%d/' % self.shiraz.id, self.tehran_expert.user),
+                               ('/ws/serviceman/', self.tehran_expert.user),
+                               ('/ws/county/%d/' % self.shiraz.id, self.tehran_wind_team_servicemen[0].user)]:
+                communicator = await sync_to_async(self.connect)(path, user)
+                await communicator.send_input({'type': 'websocket.connect'})
+                self.assertEqual(await communicator.receive_output(1), {'type': 'websocket.close', 'code': 4403})
+                await communicator.wait(1)
+
+        async_to_sync(scenario)()
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def test_push_authentication(self):
+        user = self.tehran_wind_team_servicemen[0].user
+
+        async def handshake(communicator):
+            await communicator.send_input({'type': 'websocket.connect'})
+            output = await communicator.receive_output(1)
+            if output['type'] == 'websocket.accept':
+                await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(1)
+            return output
+
+        async def scenario():
+            # The session cookie is only taken from the pages of the allowed hosts
+            for origin in [b'http://evil.example', b'null', None]:
+                communicator = await sync_to_async(self.connect)('/ws/serviceman/', user, origin)
+                self.assertEqual(await handshake(communicator), {'type': 'websocket.close', 'code': 4403})
+
+            for kwargs, accepted in [
+                ({'headers': [(b'authorization', b'Token %(key)s')]}, {'type': 'websocket.accept'}),
+                ({'subprotocols': ['token', '%(key)s']}, {'type': 'websocket.accept', 'subprotocol': 'token'}),
+                ({'headers': [(b'authorization', b'Token %(key)s'), (b'origin', b'http://evil.example')]},
+                 {'type': 'websocket.close', 'code': 4403}),
+                ({'query_string': b'token=%(key)s'}, {'type': 'websocket.close', 'code': 4403}),
+            ]:
+                communicator = await sync_to_async(self.connect_with_token)('/ws/serviceman/', user, **kwargs)
+                self.assertEqual(await handshake(communicator), accepted)
+
+        async_to_sync(scenario)()
+
+
 class ScenarioTestCase1(BaseTestCase):
     def test_damavand(self):
         self.varamin = County.objects.create(name='Varamin', super_region=self.tehran_province.region_ptr)
@@ -626,7 +1654,7 @@ class ScenarioTestCase1(BaseTestCase):
         self.varamin_moderator.refresh_from_db()
         self.varamin_expert = self.varamin_moderator.get_concrete().assign_expert(self.kareem)
         self.roadroller_type = MachineryType.objects.create(name='Road Roller')
-        self.roadroller = Machinery.objects.create(type=self.roadroller_type, total_count=1, available_count=1,
+        self.roadroller = Machinery.objects.create(type=self.roadroller_type, total_count=1,
                                                 county=self.varamin)
         self.varamin_moderator.get_concrete().increase_machinery(self.roadroller_type)
         self.varamin_moderator.get_concrete().increase_machinery(self.roadroller_type)
@@ -17,6 +17,7 @@ urlpatterns = [
     path('api/serviceman/team/', api_views.ServiceTeamView.as_view()),
     path('api/serviceman/mission/', api_views.CurrentMissionView.as_view()),
     path('api/serviceman/update-location/', api_views.UpdateLocationView.as_view()),
+    path('api/serviceman/update-locations/', api_views.UpdateLocationsView.as_view()),
     path('api/serviceman/finish-mission/', api_views.FinishMissionView.as_view()),
     path('api/expert/issues/', api_views.ReportedIssuesView.as_view()),
     path('api/expert/accept-issue/', api_views.AcceptIssueView.as_view()),
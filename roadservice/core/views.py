@@ -11,7 +11,7 @@ from accounts.models import User, Role
 from core.exceptions import DuplicatedInfoError, BusyResourceError, ResourceNotFoundError, AccessDeniedError, \
     OccupiedUserError
 from core.forms import AssignModeratorForm, RegionMultipleFilterForm, SingleStringForm, TeamCustomForm, AssignExpertForm
-from core.models import Region, Issue, MissionType, Speciality, MachineryType, Machinery, ServiceTeam
+from core.models import Region, Issue, MissionType, Speciality, MachineryType, Machinery, ServiceTeam, RegionSet
 
 
 class Home(LoginRequiredMixin, UserPassesTestMixin, View):
@@ -24,9 +24,10 @@ class Home(LoginRequiredMixin, UserPassesTestMixin, View):
         if request.user.role.type == Role.Type.COUNTY_EXPERT:
             issues = request.user.role.get_concrete().get_issues()
         else:
+            moderator = request.user.role.get_concrete()
             if not regions:
-                regions = [request.user.role.get_concrete().region]
-            issues = request.user.role.get_concrete().get_issues(regions)
+                regions = RegionSet([moderator.region_id])
+            issues = moderator.get_issues(regions)
         context = {'issues': issues.order_by('-created_at'), 'form': form}
         return render(request=request,
                       template_name='core/dashboard.html',
@@ -41,8 +42,7 @@ class Home(LoginRequiredMixin, UserPassesTestMixin, View):
         regions = None
         if form.is_valid():
             messages.add_message(request, messages.INFO, 'جدول بروز شد!')
-            region_ids = form.cleaned_data.get('regions')
-            regions = [Region.objects.get(id=region_id) for region_id in region_ids]
+            regions = RegionSet(form.cleaned_data.get('regions'))
         else:
             messages.add_message(request, messages.ERROR, 'فرم نامعتبر است!')
         return self.process(request, form, regions)
@@ -78,13 +78,15 @@ class Resources(LoginRequiredMixin, UserPassesTestMixin, View):
             teams = request.user.role.get_concrete().get_teams()
             machineries = request.user.role.get_concrete().get_machineries()
         else:
+            moderator = request.user.role.get_concrete()
             if not regions:
-                regions = [request.user.role.get_concrete().region]
-            teams = request.user.role.get_concrete().get_teams(regions)
-            machineries = request.user.role.get_concrete().get_machineries(regions)
+                regions = RegionSet([moderator.region_id])
+            regions = moderator.get_region_set(regions)
+            teams = moderator.get_teams(regions)
+            machineries = moderator.get_machineries(regions)
         machinery_count = {machinery_type: {'total': 0, 'available': 0} for machinery_type in
                            MachineryType.objects.all()}
-        for machinery in machineries:
+        for machinery in Machinery.annotate_available_count(machineries):
             machinery_count[machinery.type]['total'] += machinery.total_count
             machinery_count[machinery.type]['available'] += machinery.available_count
         mission_types = MissionType.objects.all()
@@ -107,8 +109,7 @@ class Resources(LoginRequiredMixin, UserPassesTestMixin, View):
         regions = None
         if form.is_valid():
             messages.add_message(request, messages.INFO, 'جدول بروز شد!')
-            region_ids = form.cleaned_data.get('regions')
-            regions = [Region.objects.get(id=region_id) for region_id in region_ids]
+            regions = RegionSet(form.cleaned_data.get('regions'))
         else:
             messages.add_message(request, messages.ERROR, 'فرم نامعتبر است!')
         return self.process(request, form, regions)
@@ -1,5 +1,7 @@
 from django import forms
 
+from core.models import RegionTree
+
 
 class SingleRegionSelectForm(forms.Form):
     region = forms.ChoiceField(label='بخش')
@@ -7,7 +9,7 @@ class SingleRegionSelectForm(forms.Form):
     def __init__(self, *args, **kwargs):
         moderator = kwargs.pop('moderator')
         super().__init__(*args, **kwargs)
-        regions = moderator.region.get_included_regions()
+        regions = RegionTree.get_instance().get_descendants(moderator.region_id)
         region_choices = [(region.id, region.full_name) for region in regions]
         self.fields['region'].choices = region_choices
         self.fields['region'].widget.attrs['class'] = 'ui fluid right aligned search dropdown'
@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'roadservice.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from core.push import websocket_application  # noqa: E402, the apps must be loaded first
+
+
+async def application(scope, receive, send):
+    """Serves the websockets of core.push and everything else with Django"""
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -161,6 +161,56 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 ISSUE_IMAGE_LIMIT_MB = 5
 
+# The issues served per page by the issue listings, by default and at most
+ISSUE_PAGE_SIZE = 50
+ISSUE_PAGE_SIZE_LIMIT = 200
+
+# The most location fixes a serviceman may send in a single batch
+LOCATION_BATCH_LIMIT = 1000
+
+# Seconds each worker buffers the locations of the servicemen before writing them all at once, 0 writing every one
+# as it arrives
+LOCATION_FLUSH_INTERVAL = env.float('LOCATION_FLUSH_INTERVAL', default=0)
+
+# The location history is kept in full for LOCATION_HISTORY_FULL_HOURS, then downsampled to one fix per
+# LOCATION_HISTORY_INTERVAL seconds, and dropped after LOCATION_HISTORY_RETENTION_DAYS, see compactlocations
+LOCATION_HISTORY_FULL_HOURS = 24
+LOCATION_HISTORY_INTERVAL = 60
+LOCATION_HISTORY_RETENTION_DAYS = 90
+
+# How distances are measured: 'geodesic', 'haversine', 'equirectangular' or the dotted path of a DistanceBackend
+DISTANCE_BACKEND = env('DISTANCE_BACKEND', default='geodesic')
+
+# The radius in miles of the first box the idle teams near an issue are searched in, it is widened eightfold until
+# enough teams are found in it
+TEAM_SEARCH_RADIUS = env.float('TEAM_SEARCH_RADIUS', default=10)
+
+# How accepted issues get their teams: 'greedy' assigns the nearest idle teams to each issue as it is accepted,
+# 'batch' queues the issues and matches the queue of each county to its idle teams minimizing the total distance
+DISPATCH_MODE = env('DISPATCH_MODE', default='greedy')
+
+# Seconds a batch dispatch may spend on the optimal matchings before falling back to the greedy ones, shared equally
+# by the specialities it matches
+DISPATCH_TIME_BUDGET = env.float('DISPATCH_TIME_BUDGET', default=2)
+
+# How many of the nearest other counties, by the distance of their centroids, an issue may take the resources its
+# own county lacks from, 0 disabling the fallback
+DISPATCH_FALLBACK_COUNTIES = env.int('DISPATCH_FALLBACK_COUNTIES', default=0)
+
+# The rows the available units of every machinery are split across, so that concurrent assignments taking the
+# machinery rarely update the same row
+MACHINERY_SLOTS = env.int('MACHINERY_SLOTS', default=4)
+
+# Messages held for every websocket that is behind on reading them before the newer ones are dropped
+PUSH_QUEUE_SIZE = 100
+
+# Seconds each worker caches the county of a team to push the locations of its members to, the teams saved by the
+# worker itself being refreshed at once
+PUSH_TEAM_COUNTY_TTL = env.float('PUSH_TEAM_COUNTY_TTL', default=60)
+
+# Seconds between the checks each worker makes for region changes made by the other workers
+REGION_TREE_CHECK_INTERVAL = 5
+
 # Local settings
 try:
     from .local_settings import *